@@ -0,0 +1,274 @@
+import copy
+from collections import OrderedDict
+from functools import partial
+from operator import attrgetter
+
+import graphene
+import structlog
+from graphql.execution import ExecutionResult, execute
+from graphql.execution.middleware import MiddlewareManager
+from graphql.execution.values import get_argument_values
+from graphql.language.ast import (Argument, BooleanValue, Directive, Document, Field, FragmentDefinition,
+                                  FragmentSpread, InlineFragment, Name, OperationDefinition, SelectionSet, Variable)
+from graphql.type import GraphQLList, GraphQLNonNull, GraphQLObjectType
+
+from app.schema.schema import Doc, spacy_attr_resolver
+
+logger = structlog.get_logger("gracyql")
+
+# Executes a Doc selection set with a Doc as root value, when a compiled serializer fails
+doc_schema = graphene.Schema(query=Doc, auto_camelcase=False)
+
+
+class Uncompilable(Exception):
+    """A selection the compiler doesn't handle, it is left to graphene."""
+
+
+def has_variables(value):
+    if isinstance(value, Variable):
+        return True
+    return any(has_variables(child) for child in getattr(value, 'values', None) or getattr(value, 'fields', None) or ())
+
+
+def complete_leaf(serialize, value):
+    if value is None:
+        return None
+    serialized = serialize(value)
+    if serialized is None:
+        raise ValueError("Can't serialize %r" % (value,))
+    return serialized
+
+
+def complete_non_null(complete, value):
+    value = complete(value)
+    if value is None:
+        raise ValueError("Null value of a non null field")
+    return value
+
+
+def complete_list(complete_item, value):
+    if value is None:
+        return None
+    return [complete_item(item) for item in value]
+
+
+def complete_object(serialize, value):
+    if value is None:
+        return None
+    return serialize(value)
+
+
+def serialize_object(entries, obj):
+    return {key: complete(get(obj)) for key, get, complete in entries}
+
+
+class SelectionCompiler:
+    """
+    Compiles the selection set of an object type into a function building the same result dict as graphene,
+    calling the resolvers of the fields and the serializers of their types without the per field work of the executor.
+    The selections it can't reproduce statically (directives, arguments given by variables) raise Uncompilable.
+    """
+    def __init__(self, schema, fragments):
+        self.schema = schema
+        self.fragments = fragments
+
+    def applies(self, type_condition, type_):
+        if type_condition is None:
+            return True
+        condition = self.schema.get_type(type_condition.name.value)
+        return condition is type_ or condition in getattr(type_, 'interfaces', ())
+
+    def collect(self, type_, selection_sets, fields=None, visited=None):
+        """The field nodes by response key, merged and ordered as graphql-core does."""
+        fields = OrderedDict() if fields is None else fields
+        visited = set() if visited is None else visited
+        for selection_set in selection_sets:
+            for selection in selection_set.selections:
+                if selection.directives:
+                    raise Uncompilable("directives")
+                if isinstance(selection, Field):
+                    key = selection.alias.value if selection.alias else selection.name.value
+                    fields.setdefault(key, []).append(selection)
+                elif isinstance(selection, InlineFragment):
+                    if self.applies(selection.type_condition, type_):
+                        self.collect(type_, [selection.selection_set], fields, visited)
+                elif isinstance(selection, FragmentSpread):
+                    name = selection.name.value
+                    fragment = self.fragments.get(name)
+                    if name in visited or fragment is None:
+                        continue
+                    visited.add(name)
+                    if self.applies(fragment.type_condition, type_):
+                        self.collect(type_, [fragment.selection_set], fields, visited)
+        return fields
+
+    def compile_object(self, type_, selection_sets):
+        entries = []
+        for key, nodes in self.collect(type_, selection_sets).items():
+            name = nodes[0].name.value
+            if name == '__typename':
+                entries.append((key, partial(lambda name, obj: name, type_.name), lambda value: value))
+                continue
+            field = type_.fields[name]
+            entries.append((key, self.getter(field, nodes[0]), self.completer(field.type, nodes)))
+        return partial(serialize_object, entries)
+
+    def getter(self, field, node):
+        arguments = node.arguments or []
+        if any(has_variables(argument.value) for argument in arguments):
+            raise Uncompilable("variables")
+        args = get_argument_values(field.args, arguments, {})
+        resolver = field.resolver
+        if isinstance(resolver, partial) and resolver.func is spacy_attr_resolver and not args:
+            # spacy_attr_resolver prefers the string form of an attribute, decided once for the whole type
+            attname, default_value = resolver.args
+            if default_value is None:
+                return self.spacy_getter(attname)
+        if resolver is None:
+            raise Uncompilable("default resolver")
+        return lambda obj: resolver(obj, None, **args)
+
+    def spacy_getter(self, attname):
+        # The root type of the spaCy attributes is only known at runtime (Token or Span), cached per class
+        getters = {}
+
+        def get(obj):
+            cls = type(obj)
+            getter = getters.get(cls)
+            if getter is None:
+                getter = getters[cls] = attrgetter(attname + '_' if hasattr(obj, attname + '_') else attname)
+            return getter(obj)
+        return get
+
+    def completer(self, type_, nodes):
+        if isinstance(type_, GraphQLNonNull):
+            return partial(complete_non_null, self.completer(type_.of_type, nodes))
+        if isinstance(type_, GraphQLList):
+            return partial(complete_list, self.completer(type_.of_type, nodes))
+        if isinstance(type_, GraphQLObjectType):
+            return partial(complete_object, self.compile_object(type_, [node.selection_set for node in nodes]))
+        if hasattr(type_, 'serialize'):
+            return partial(complete_leaf, type_.serialize)
+        raise Uncompilable("abstract type %s" % type_)
+
+
+def skipped(selection_set):
+    """A selection set resolving only __typename, the original selections are kept (skipped) for the pipeline pruning."""
+    skip = Directive(name=Name('skip'), arguments=[Argument(name=Name('if'), value=BooleanValue(True))])
+    return SelectionSet(selections=[Field(name=Name('__typename')),
+                                    InlineFragment(type_condition=None, directives=[skip], selection_set=selection_set)])
+
+
+class CompiledQuery:
+    """
+    A query document whose Doc fields are serialized by compiled functions.
+    The Doc fields of the executed document only select __typename, a middleware collects the Docs they resolve
+    and their compiled results replace them in the response. A Doc whose compiled serializer fails
+    is executed by graphene, so that its data and errors are the ones of the original query.
+    """
+    def __init__(self, schema, document):
+        self.schema = schema
+        self.document = copy.deepcopy(document)
+        self.fragments = {definition.name.value: definition for definition in self.document.definitions
+                          if isinstance(definition, FragmentDefinition)}
+        self.compiler = SelectionCompiler(schema, self.fragments)
+        # Serializers and graphene fallback documents by Doc field node of the executed document
+        self.serializers = {}
+        self.doc_type = schema.get_type('Doc')
+        for definition in self.document.definitions:
+            if isinstance(definition, OperationDefinition) and definition.operation == 'query':
+                self.compile_selection(schema.get_query_type(), definition.selection_set)
+        if not self.serializers:
+            raise Uncompilable("no Doc field")
+
+    def collect_fields(self, selection_set, fields):
+        for selection in selection_set.selections:
+            if isinstance(selection, FragmentSpread):
+                # The Doc fields of a named fragment may be merged with others, left to graphene
+                raise Uncompilable("fragment spread above a Doc")
+            if selection.directives:
+                # The executed field nodes would depend on the variables
+                raise Uncompilable("directives above a Doc")
+            if isinstance(selection, InlineFragment):
+                self.collect_fields(selection.selection_set, fields)
+            elif selection.name.value != '__typename':
+                key = selection.alias.value if selection.alias else selection.name.value
+                fields.setdefault(key, []).append(selection)
+        return fields
+
+    def compile_selection(self, type_, selection_set):
+        fields = self.collect_fields(selection_set, OrderedDict())
+        for key, nodes in fields.items():
+            field_type = type_.fields[nodes[0].name.value].type
+            while isinstance(field_type, (GraphQLList, GraphQLNonNull)):
+                field_type = field_type.of_type
+            if field_type is self.doc_type:
+                selection_sets = [node.selection_set for node in nodes]
+                serialize = self.compiler.compile_object(field_type, selection_sets)
+                fallback = Document(definitions=[OperationDefinition(
+                    operation='query',
+                    selection_set=SelectionSet(selections=[s for ss in selection_sets for s in ss.selections]))]
+                    + list(self.fragments.values()))
+                for node in nodes:
+                    node.selection_set = skipped(node.selection_set)
+                self.serializers[id(nodes[0])] = (serialize, fallback)
+            elif isinstance(field_type, GraphQLObjectType):
+                self.compile_selection(field_type, SelectionSet(selections=[node for n in nodes
+                                                                            for node in n.selection_set.selections]))
+
+    def execute(self, context=None, variables=None, operation_name=None):
+        collector = DocCollector(self.serializers)
+        result = execute(self.schema, self.document, context_value=context, variable_values=variables,
+                         operation_name=operation_name, middleware=MiddlewareManager(collector, wrap_in_promise=False))
+        data = result.data
+        errors = list(result.errors or [])
+        for path, value in collector.results.items():
+            parent = data
+            for key in path[:-1]:
+                parent = parent[key] if parent is not None else None
+            if parent is not None and parent.get(path[-1]) is not None:
+                parent[path[-1]] = value
+        errors.extend(collector.errors)
+        return ExecutionResult(data=data, errors=errors or None, invalid=result.invalid)
+
+
+class DocCollector:
+    """Middleware serializing the Docs resolved by the compiled fields of a query execution."""
+    def __init__(self, serializers):
+        self.serializers = serializers
+        self.results = {}
+        self.errors = []
+
+    def resolve(self, next_, root, info, **args):
+        # next_ as the arguments of the fields (e.g. the next of Nlp.batch) are passed by name
+        value = next_(root, info, **args)
+        compiled = self.serializers.get(id(info.field_asts[0]))
+        if compiled is None or value is None:
+            return value
+        path = list(info.path)
+        if isinstance(value, (list, tuple)):
+            self.results[tuple(path)] = [None if doc is None else self.serialize(compiled, doc, path + [i])
+                                         for i, doc in enumerate(value)]
+        else:
+            self.results[tuple(path)] = self.serialize(compiled, value, path)
+        return value
+
+    def serialize(self, compiled, doc, path):
+        serialize, fallback = compiled
+        try:
+            return serialize(doc)
+        except Exception:
+            result = execute(doc_schema, fallback, root_value=doc)
+            for error in result.errors or []:
+                error.path = path + list(error.path or [])
+                self.errors.append(error)
+            return result.data
+
+
+def compile_query(schema, document):
+    """The compiled form of a query document, None if it has no Doc field the compiler can handle."""
+    try:
+        return CompiledQuery(schema, document)
+    except Uncompilable as e:
+        logger.debug("Query not compiled: %s" % e)
+        return None
@@ -0,0 +1,33 @@
+import fcntl
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def write_atomic(path: Path, data: bytes):
+    """
+    Replace the content of a file at once, readers see either the previous or the new content.
+    The temporary file is unique to the writer so that concurrent writers (threads or workers) of the same path
+    don't write into each other's file.
+    """
+    tmp = path.with_name('%s.%d.%s.tmp' % (path.name, os.getpid(), uuid.uuid4().hex))
+    try:
+        tmp.write_bytes(data)
+        os.replace(str(tmp), str(path))
+    except BaseException:
+        try:
+            tmp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+
+@contextmanager
+def file_lock(path: Path):
+    with open(str(path), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,3 +1,4 @@
+import gc
 import json
 import multiprocessing
 import os
@@ -8,6 +9,11 @@ host = os.getenv("APP_HOST", "0.0.0.0")
 port = os.getenv("APP_PORT", "8990")
 bind_env = os.getenv("BIND", None)
 use_loglevel = os.getenv("APP_LOG_LEVEL", "info")
+use_preload_app = os.getenv("PRELOAD_APP", "true").lower() in ("1", "true", "yes")
+# Workers are recycled once their resident memory grew by that many bytes, or after max_requests if > 0
+max_rss_growth = int(os.getenv("MAX_RSS_GROWTH", str(1024 * 1024 * 1024)))
+memory_check_interval = float(os.getenv("MEMORY_CHECK_INTERVAL", "10"))
+max_requests_str = os.getenv("MAX_REQUESTS", "0")
 if bind_env:
     use_bind = bind_env
 else:
@@ -29,13 +35,34 @@ bind = use_bind
 keepalive = 120
 errorlog = "-"
 timeout=1800
-max_requests=100
+max_requests = int(max_requests_str)
+max_requests_jitter = max(max_requests // 10, 0)
+preload_app = use_preload_app
+
+
+def when_ready(server):
+    if preload_app:
+        # The app is loaded by the master: load the models once before the workers are forked
+        from app.schema.schema import PRELOAD_MODELS, spacy_models
+        spacy_models.preload(PRELOAD_MODELS)
+        # Keeps the models out of the garbage collections of the workers, the collector writing to their pages
+        # would otherwise copy them in each worker
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    if max_rss_growth > 0:
+        from app.memory import RssMonitor
+        RssMonitor(max_rss_growth, memory_check_interval).start()
 
 # For debugging and testing
 log_data = {
     "loglevel": loglevel,
     "workers": workers,
     "bind": bind,
+    "preload_app": preload_app,
+    "max_requests": max_requests,
+    "max_rss_growth": max_rss_growth,
     # Additional, non-gunicorn variables
     "workers_per_core": workers_per_core,
     "host": host,
@@ -8,12 +8,12 @@ import structlog
 import uvicorn
 from starlette.applications import Starlette
 from starlette.config import Config
-from starlette.graphql import GraphQLApp
-from starlette.middleware.gzip import GZipMiddleware
 from starlette_prometheus import metrics, PrometheusMiddleware
 
 from app.logger import configure_logger
-from app.schema.schema import schema
+from app.persisted import load_allowlist, PersistedGraphQLApp, QueryDocuments
+from app.schema.schema import PRELOAD_MODELS, schema, spacy_models
+from app.stream import GraphQLStreamApp, StreamingGZipMiddleware
 
 # Config will be read from environment variables and/or ".env" files.
 config = Config(".env")
@@ -28,18 +28,27 @@ APP_LOG_LEVEL = config('APP_LOG_LEVEL', cast=str, default="info")
 APP_LOG_DIR = config('APP_LOG_DIR', cast=str, default="")
 APP_ACCESS_LOG = config('APP_ACCESS_LOG', cast=bool, default=False)
 RELOAD = config('RELOAD', cast=int, default=1000)
+# Number of parsed and validated query documents kept in memory, keyed by the sha256 hash of the queries
+QUERY_DOCUMENTS_SIZE = config('QUERY_DOCUMENTS_SIZE', cast=int, default=1000)
+# JSON file of pre-registered queries loaded at startup, and whether only them can be executed
+QUERY_ALLOWLIST = config('QUERY_ALLOWLIST', cast=str, default="")
+ALLOWLIST_ONLY = config('ALLOWLIST_ONLY', cast=bool, default=False)
+# Serialize the Doc fields of the queries with compiled functions instead of the graphene executor
+COMPILE_QUERIES = config('COMPILE_QUERIES', cast=bool, default=True)
 
 
 logger = configure_logger("gracyql", APP_LOG_DIR, uvicorn.config.LOG_LEVELS[APP_LOG_LEVEL])
 
 app = Starlette(debug=DEBUG)
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+app.add_middleware(StreamingGZipMiddleware, minimum_size=1000)
 app.add_middleware(PrometheusMiddleware)
 
 #app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
 
 @app.on_event('startup')
 def startup():
+    # No-op for the models already preloaded by the gunicorn master
+    spacy_models.preload(PRELOAD_MODELS)
     print('Ready to go')
 
 
@@ -48,7 +57,11 @@ def shutdown():
     print('Shutting down')
 
 
-app.add_route("/", GraphQLApp(schema))
+query_documents = QueryDocuments(schema, QUERY_DOCUMENTS_SIZE,
+                                 load_allowlist(QUERY_ALLOWLIST) if QUERY_ALLOWLIST else None, ALLOWLIST_ONLY,
+                                 COMPILE_QUERIES)
+app.add_route("/", PersistedGraphQLApp(schema, query_documents))
+app.add_route("/stream", GraphQLStreamApp(schema, query_documents), methods=["POST"])
 
 
 @app.route("/schema")
@@ -0,0 +1,48 @@
+import os
+import signal
+from threading import Event, Thread
+
+import structlog
+
+logger = structlog.get_logger("gracyql")
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss_bytes():
+    """Resident set size of the current process in bytes, 0 where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def terminate():
+    # Graceful shutdown: in-flight requests are completed and the master starts a new worker
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+class RssMonitor(Thread):
+    """
+    Watches the growth of the resident memory of a worker since it started
+    and asks it to exit once it grew by more than max_growth bytes.
+    """
+    def __init__(self, max_growth, interval, on_exceeded=terminate):
+        super().__init__(name="rss-monitor", daemon=True)
+        self.max_growth = max_growth
+        self.interval = interval
+        self.on_exceeded = on_exceeded
+        self.baseline = rss_bytes()
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            growth = rss_bytes() - self.baseline
+            if growth > self.max_growth:
+                logger.info("Worker %d grew by %d bytes since it started, recycling it" % (os.getpid(), growth))
+                self.on_exceeded()
+                return
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,193 @@
+import hashlib
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily
+
+# These metrics are registered on the default registry and are therefore served
+# by the starlette_prometheus /metrics/ route together with the HTTP ones.
+
+PIPELINE_RUNS = Counter(
+    "gracyql_pipeline_runs_total",
+    "Total count of pipeline runs (one per doc or batch request) by model.",
+    ["model"]
+)
+PRUNED_COMPONENTS = Counter(
+    "gracyql_pruned_components_total",
+    "Total count of pipeline runs where a component was skipped because the query did not need it, by model and component.",
+    ["model", "component"]
+)
+MICROBATCH_DOCS = Histogram(
+    "gracyql_microbatch_size",
+    "Histogram of the number of doc requests processed together by the micro-batching dispatcher, by model.",
+    ["model"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+MICROBATCH_WAIT = Histogram(
+    "gracyql_microbatch_wait_seconds",
+    "Histogram of the time doc requests spent waiting for their micro-batch to be dispatched (in seconds), by model.",
+    ["model"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5)
+)
+DOC_CACHE_HITS = Counter(
+    "gracyql_doc_cache_hits_total",
+    "Total count of documents found in the annotation cache, by cache.",
+    ["cache"]
+)
+DOC_CACHE_MISSES = Counter(
+    "gracyql_doc_cache_misses_total",
+    "Total count of documents not found in the annotation cache, by cache.",
+    ["cache"]
+)
+DOC_CACHE_EVICTIONS = Counter(
+    "gracyql_doc_cache_evictions_total",
+    "Total count of documents evicted from the annotation cache, by cache.",
+    ["cache"]
+)
+DOC_CACHE_BYTES = Gauge(
+    "gracyql_doc_cache_bytes",
+    "Gauge of the size of the serialized documents held by the annotation cache (in bytes), by cache.",
+    ["cache"]
+)
+DOC_CACHE_ENTRIES = Gauge(
+    "gracyql_doc_cache_entries",
+    "Gauge of the number of documents held by the annotation cache, by cache.",
+    ["cache"]
+)
+BATCHES_DROPPED = Counter(
+    "gracyql_batches_dropped_total",
+    "Total count of open batches dropped before being fully read, by reason (expired or evicted).",
+    ["reason"]
+)
+OPEN_BATCHES = Gauge(
+    "gracyql_open_batches",
+    "Gauge of the number of open batches."
+)
+OPEN_BATCHES_BYTES = Gauge(
+    "gracyql_open_batches_bytes",
+    "Gauge of the estimated memory held by the texts of the open batches still to be processed (in bytes)."
+)
+NLP_POOL_QUEUE = Gauge(
+    "gracyql_nlp_pool_queue",
+    "Gauge of the number of tasks submitted to the nlp process pool and not completed yet."
+)
+MODEL_RELOADS = Counter(
+    "gracyql_model_reloads_total",
+    "Total count of model reloads, by model and reason (the reload policy that triggered it).",
+    ["model", "reason"]
+)
+MODEL_EVICTIONS = Counter(
+    "gracyql_model_evictions_total",
+    "Total count of models evicted from the registry to stay within its memory budget, by model.",
+    ["model"]
+)
+MODELS_BYTES = Gauge(
+    "gracyql_models_bytes",
+    "Gauge of the estimated memory of the loaded base models (in bytes)."
+)
+QUERY_DOCUMENTS = Counter(
+    "gracyql_query_documents_total",
+    "Total count of query document lookups by result: allowlist, hit, miss (parsed and validated), "
+    "not_found (unknown persisted query hash) or rejected (not in the allowlist).",
+    ["result"]
+)
+COMPONENT_SECONDS = Histogram(
+    "gracyql_component_seconds",
+    "Histogram of the time spent in a pipeline component (in seconds), per doc with nlp(text) and per batch with nlp.pipe, "
+    "by model and component (tokenizer included).",
+    ["model", "component"],
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+PROCESSED_DOCS = Counter(
+    "gracyql_processed_docs_total",
+    "Total count of documents processed by the pipelines of the process, by model.",
+    ["model"]
+)
+PROCESSED_TOKENS = Counter(
+    "gracyql_processed_tokens_total",
+    "Total count of tokens processed by the pipelines of the process, by model.",
+    ["model"]
+)
+PROCESSED_CHARS = Counter(
+    "gracyql_processed_chars_total",
+    "Total count of characters processed by the pipelines of the process, by model.",
+    ["model"]
+)
+MODEL_LOAD_SECONDS = Histogram(
+    "gracyql_model_load_seconds",
+    "Histogram of the time to load a base model (in seconds), by model and kind (load or reload).",
+    ["model", "kind"],
+    buckets=(.1, .25, .5, 1, 2.5, 5, 10, 25, 50, 100)
+)
+QUERY_SECONDS = Histogram(
+    "gracyql_query_seconds",
+    "Histogram of the execution time of the GraphQL queries (in seconds) by phase: nlp (getting the annotated docs, "
+    "waits for the micro-batches, the process pool and the batch producers included) and graphql (the rest of the resolution).",
+    ["phase"]
+)
+
+# NLP time of the GraphQL execution in progress on each thread
+query_clock = threading.local()
+
+
+class NlpTime:
+    """Adds the time spent in a block to the NLP time of the query executed by the thread, nested blocks are counted once."""
+    def __enter__(self):
+        self.depth = getattr(query_clock, 'depth', 0)
+        query_clock.depth = self.depth + 1
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        query_clock.depth = self.depth
+        if not self.depth:
+            query_clock.nlp = getattr(query_clock, 'nlp', 0.0) + time.perf_counter() - self.start
+
+
+def timed_query(execute, *args, **kwargs):
+    """Run a GraphQL execution, observing the time spent getting the annotated docs apart from the rest."""
+    query_clock.nlp = 0.0
+    start = time.perf_counter()
+    try:
+        return execute(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        nlp = min(query_clock.nlp, elapsed)
+        QUERY_SECONDS.labels(phase='nlp').observe(nlp)
+        QUERY_SECONDS.labels(phase='graphql').observe(elapsed - nlp)
+
+
+def cfg_label(cfg):
+    """
+    Short and stable label of a normalized cfg: the raw cfgs would make labels of any length and content,
+    "default" for the empty cfg and the first 8 hex digits of its SHA-1 otherwise.
+    """
+    if cfg == '{}':
+        return 'default'
+    return hashlib.sha1(cfg.encode('utf-8')).hexdigest()[:8]
+
+
+class ModelsCollector:
+    """Collects the age, processed documents and vocab size of the loaded models at scrape time."""
+    def __init__(self, models):
+        self.models = models
+
+    def collect(self):
+        age = GaugeMetricFamily("gracyql_model_age_seconds",
+                                "Gauge of the time since the model was loaded (in seconds), by model and cfg.",
+                                labels=["model", "cfg"])
+        docs = GaugeMetricFamily("gracyql_model_documents",
+                                 "Gauge of the number of documents processed since the model was loaded, by model and cfg.",
+                                 labels=["model", "cfg"])
+        strings = GaugeMetricFamily("gracyql_model_strings",
+                                    "Gauge of the number of strings in the StringStore of the model, by model and cfg.",
+                                    labels=["model", "cfg"])
+        now = time.time()
+        for (model, cfg), entry in list(self.models.models.items()):
+            labels = [model, cfg_label(cfg)]
+            age.add_metric(labels, now - entry.loaded_at)
+            docs.add_metric(labels, entry.count)
+            strings.add_metric(labels, len(entry.nlp.vocab.strings))
+        yield age
+        yield docs
+        yield strings
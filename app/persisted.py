@@ -0,0 +1,176 @@
+import hashlib
+import json
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+import structlog
+from graphql import parse, validate
+from graphql.error import GraphQLError, format_error
+from graphql.execution import execute
+from starlette import status
+from starlette.background import BackgroundTasks
+from starlette.concurrency import run_in_threadpool
+from starlette.graphql import GraphQLApp
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+
+from app.compiler import compile_query
+from app.metrics import QUERY_DOCUMENTS, timed_query
+
+logger = structlog.get_logger("gracyql")
+
+# Error expected by the automatic persisted queries clients (e.g. Apollo) to send the query along with its hash
+NOT_FOUND = "PersistedQueryNotFound"
+
+
+def query_hash(query):
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+def load_allowlist(path):
+    """Queries of an allowlist file: a JSON object mapping their sha256 hashes to them, or a JSON list of queries."""
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if isinstance(entries, list):
+        entries = {query_hash(query): query for query in entries}
+    return entries
+
+
+# A validated query document, and its compiled form when it has one
+QueryDocument = namedtuple('QueryDocument', ['document', 'compiled'])
+
+
+class QueryDocuments:
+    """
+    Parsed and validated query documents keyed by the sha256 hash of their text:
+    a pinned allowlist loaded at startup, and an LRU cache of max_size documents for the other queries.
+    With allowlist_only, only the queries of the allowlist can be executed.
+    With compile_queries, the Doc fields of the queries are also compiled into serializers (see app.compiler).
+    """
+    def __init__(self, schema, max_size, allowlist=None, allowlist_only=False, compile_queries=False):
+        self.schema = schema
+        self.max_size = max_size
+        self.allowlist_only = allowlist_only
+        self.compile_queries = compile_queries
+        self.documents = OrderedDict()
+        self.lock = Lock()
+        self.pinned = {}
+        for hash_, query in (allowlist or {}).items():
+            if query_hash(query) != hash_:
+                raise ValueError("The hash %s of the allowlist doesn't match its query" % hash_)
+            document, errors = self.compile(query)
+            if errors:
+                raise ValueError("Invalid query %s in the allowlist: %s" % (hash_, errors[0]))
+            self.pinned[hash_] = document
+        if self.pinned:
+            logger.info("Loaded %d allowed queries" % len(self.pinned))
+
+    def compile(self, query):
+        try:
+            document = parse(query)
+        except GraphQLError as e:
+            return None, [e]
+        errors = validate(self.schema, document)
+        if errors:
+            return None, errors
+        return QueryDocument(document, compile_query(self.schema, document) if self.compile_queries else None), []
+
+    def get(self, query=None, hash_=None):
+        """The QueryDocument of a query given by its text and/or its hash, and the errors preventing its execution."""
+        if query is not None:
+            digest = query_hash(query)
+            if hash_ is not None and hash_ != digest:
+                return None, [GraphQLError("provided sha does not match query")]
+            hash_ = digest
+        elif hash_ is None:
+            return None, [GraphQLError("No GraphQL query found in the request")]
+        document = self.pinned.get(hash_)
+        if document is not None:
+            QUERY_DOCUMENTS.labels(result='allowlist').inc()
+            return document, []
+        if self.allowlist_only:
+            QUERY_DOCUMENTS.labels(result='rejected').inc()
+            return None, [GraphQLError("Query %s is not allowed" % hash_)]
+        with self.lock:
+            document = self.documents.get(hash_)
+            if document is not None:
+                self.documents.move_to_end(hash_)
+        if document is not None:
+            QUERY_DOCUMENTS.labels(result='hit').inc()
+            return document, []
+        if query is None:
+            QUERY_DOCUMENTS.labels(result='not_found').inc()
+            return None, [GraphQLError(NOT_FOUND, extensions={"code": "PERSISTED_QUERY_NOT_FOUND"})]
+        QUERY_DOCUMENTS.labels(result='miss').inc()
+        document, errors = self.compile(query)
+        if errors:
+            return None, errors
+        with self.lock:
+            self.documents[hash_] = document
+            while len(self.documents) > self.max_size:
+                self.documents.popitem(last=False)
+        return document, []
+
+
+class PersistedGraphQLApp(GraphQLApp):
+    """
+    GraphQLApp executing the documents of a QueryDocuments, so that a query is only parsed and validated once
+    (and its Doc fields serialized by compiled functions when they could be compiled), and supporting automatic persisted queries: the clients can send the sha256 hash of a query in
+    extensions.persistedQuery.sha256Hash instead of its text once it has been sent with it.
+    """
+    def __init__(self, schema, documents: QueryDocuments, **kwargs):
+        super().__init__(schema, **kwargs)
+        self.documents = documents
+
+    async def handle_graphql(self, request: Request) -> Response:
+        if request.method in ("GET", "HEAD"):
+            if "text/html" in request.headers.get("Accept", ""):
+                return await super().handle_graphql(request)
+            data = request.query_params
+        elif request.method == "POST":
+            content_type = request.headers.get("Content-Type", "")
+            if "application/json" in content_type:
+                data = await request.json()
+            elif "application/graphql" in content_type:
+                body = await request.body()
+                data = {"query": body.decode()}
+            elif "query" in request.query_params or "extensions" in request.query_params:
+                data = request.query_params
+            else:
+                return PlainTextResponse("Unsupported Media Type", status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        else:
+            return PlainTextResponse("Method Not Allowed", status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        try:
+            # JSON encoded in the parameters of a GET request
+            variables = self.json_param(data.get("variables"))
+            extensions = self.json_param(data.get("extensions")) or {}
+        except ValueError:
+            return PlainTextResponse("Invalid variables or extensions", status_code=status.HTTP_400_BAD_REQUEST)
+        hash_ = (extensions.get("persistedQuery") or {}).get("sha256Hash")
+        query_document, errors = self.documents.get(data.get("query"), hash_)
+        if errors:
+            # The clients only send the text of the query after this error if it comes with a 200 status
+            not_found = len(errors) == 1 and str(errors[0]) == NOT_FOUND
+            return JSONResponse({"data": None, "errors": [format_error(error) for error in errors]},
+                                status_code=status.HTTP_200_OK if not_found else status.HTTP_400_BAD_REQUEST)
+
+        background = BackgroundTasks()
+        context = {"request": request, "background": background}
+        if query_document.compiled is not None:
+            result = await run_in_threadpool(timed_query, query_document.compiled.execute, context, variables,
+                                             data.get("operationName"))
+        else:
+            result = await run_in_threadpool(timed_query, execute, self.schema, query_document.document,
+                                             context_value=context, variable_values=variables,
+                                             operation_name=data.get("operationName"))
+        response_data = {"data": result.data}
+        if result.errors:
+            response_data["errors"] = [format_error(error) for error in result.errors]
+        return JSONResponse(response_data,
+                            status_code=status.HTTP_400_BAD_REQUEST if result.errors else status.HTTP_200_OK,
+                            background=background)
+
+    @staticmethod
+    def json_param(value):
+        return json.loads(value) if isinstance(value, str) else value
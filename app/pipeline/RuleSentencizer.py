@@ -1,11 +1,78 @@
-from collections import defaultdict
+import hashlib
+import json
+from collections import OrderedDict, defaultdict
+from threading import Lock
 
+import numpy
 import plac
 import spacy
+from spacy.attrs import IS_SPACE, SENT_START
 from spacy.matcher.matcher import Matcher
 from spacy.tokens.doc import Doc
+from spacy.util import minibatch
+from spacy.vocab import Vocab
 import yaml
 
+
+# Docs of at least that many tokens are sentencized on arrays, shorter ones token by token
+ARRAY_MIN_TOKENS = 1000
+
+# Token.is_sent_start values of the SENT_START attribute
+SENT_START_VALUES = {1: True, -1: False, 0: None}
+
+
+def rules_key(rules):
+    """Hash of a rule set, identical rules written in a different key order get the same hash."""
+    source = json.dumps(rules, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class MatcherCache:
+    """
+    LRU cache of the split and join matchers compiled from rule sets, keyed by the hash of their rules.
+    The matchers only compare hashes and read the token strings from the doc's vocab, so they are compiled
+    on a private Vocab: the pattern strings don't end up in the StringStore of the models,
+    and the same matchers serve every model, cfg variant and reload.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, rules):
+        key = rules_key(rules)
+        with self.lock:
+            matchers = self.entries.get(key)
+            if matchers is not None:
+                self.entries.move_to_end(key)
+                return matchers
+        matchers = self.compile(rules)
+        with self.lock:
+            # Kept if another thread compiled the same rules meanwhile
+            matchers = self.entries.setdefault(key, matchers)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return matchers
+
+    @staticmethod
+    def compile(rules):
+        vocab = Vocab()
+        matchers = []
+        for name in ("split", "join"):
+            patterns = rules.get(name, None)
+            matcher = None
+            if patterns:
+                matcher = Matcher(vocab)
+                matcher.add(name, None, *patterns)
+            matchers.append(matcher)
+        return tuple(matchers)
+
+
+# Compiled matchers of the rule sets used by the process, the sentencizers keep their own evicted ones
+matcher_cache = MatcherCache(256)
+
+
 class RuleSentencizer(object):
     """
     Simple component that correct some over-segmentation errors of the sentencizer using exception rules.
@@ -34,20 +101,25 @@ class RuleSentencizer(object):
     nlp.add_pipe(custom)
     """
     name = "rule_sentencizer"
+    # Length from which the boundaries are computed on arrays, see app/tests/bench_sentencizer.py
+    array_min_tokens = ARRAY_MIN_TOKENS
     split_matcher = None
     join_matcher = None
+    # Hash of the rules, None without rules
+    rules_hash = None
     def __init__(self, nlp, **cfg):
         if self.name in cfg:
-            split_patterns = cfg[self.name].get('split', None)
-            if split_patterns:
-                self.split_matcher = Matcher(nlp.vocab)
-                self.split_matcher.add("split", None, *split_patterns)
-            join_patterns = cfg[self.name].get('join', None)
-            if join_patterns:
-                self.join_matcher = Matcher(nlp.vocab)
-                self.join_matcher.add("join", None, *join_patterns)
+            self.split_matcher, self.join_matcher = matcher_cache.get(cfg[self.name])
+            self.rules_hash = rules_key(cfg[self.name])
 
     def __call__(self, doc : Doc):
+        # The arrays have a fixed cost per doc, only worth it on long docs
+        if len(doc) >= self.array_min_tokens:
+            return self.sentencize_arrays(doc)
+        return self.sentencize_tokens(doc)
+
+    def sentencize_tokens(self, doc : Doc):
+        """Apply the matches one by one to the tokens."""
         save_parsed = doc.is_parsed
         doc.is_parsed = False
         if self.split_matcher:
@@ -66,7 +138,6 @@ class RuleSentencizer(object):
                         token.is_sent_start = False
         if doc.is_sentenced:
             # Trim starting spaces
-            sent_start = None
             for sent in doc.sents:
                 sentlen = len(sent)
                 first_non_space = 0
@@ -79,6 +150,139 @@ class RuleSentencizer(object):
         doc.is_parsed = save_parsed if doc.is_sentenced else True
         return doc
 
+    def pipe(self, docs, batch_size=1000):
+        """
+        Sentencize the docs by batches of batch_size: the docs of at least array_min_tokens tokens of a batch are
+        processed together on their arrays so that their fixed cost is paid once per batch, the other ones token by
+        token like in __call__.
+        """
+        for batch in minibatch(docs, size=batch_size):
+            long_docs = [doc for doc in batch if len(doc) >= self.array_min_tokens]
+            if long_docs:
+                self.sentencize_batch(long_docs)
+            for doc in batch:
+                if len(doc) < self.array_min_tokens:
+                    self.sentencize_tokens(doc)
+            yield from batch
+
+    def sentencize_arrays(self, doc : Doc):
+        return self.sentencize_batch([doc])[0]
+
+    def sentencize_batch(self, docs):
+        """
+        Same boundaries as sentencize_tokens, computed on the SENT_START arrays of the docs put end to end:
+        the matches only read or write the sent_start of their own tokens so their effects can be applied per token.
+        """
+        saved_parsed = [doc.is_parsed for doc in docs]
+        for doc in docs:
+            doc.is_parsed = False
+        # Position of the first token of each doc in the arrays, and the total length
+        offsets = numpy.cumsum([0] + [len(doc) for doc in docs])
+        original = doc_arrays(docs, SENT_START).view('int64')
+        sent_starts = original.copy()
+        if self.split_matcher:
+            self.apply_splits(sent_starts, self.match(self.split_matcher, docs, offsets))
+            if self.join_matcher:
+                # The join rules may test IS_SENT_START on the split boundaries
+                self.write(docs, offsets, original, sent_starts)
+                original = sent_starts.copy()
+        if self.join_matcher:
+            self.apply_joins(sent_starts, self.match(self.join_matcher, docs, offsets))
+        sentenced = self.sentenced(sent_starts, offsets)
+        not_empty = offsets[1:] > offsets[:-1]
+        if (sentenced & not_empty).any():
+            self.trim_spaces(sent_starts, doc_arrays(docs, IS_SPACE).astype(bool),
+                             offsets[:-1][sentenced & not_empty], offsets[1:][sentenced & not_empty])
+        self.write(docs, offsets, original, sent_starts)
+        for doc, save_parsed, doc_sentenced in zip(docs, saved_parsed, self.sentenced(sent_starts, offsets).tolist()):
+            doc.is_parsed = save_parsed if doc_sentenced else True
+        return docs
+
+    @staticmethod
+    def sentenced(sent_starts, offsets):
+        """Doc.is_sentenced of each (not parsed) doc, from the number of boundaries set after its first token."""
+        set_ = (sent_starts != 0).astype('int64')
+        set_[offsets[:-1][offsets[1:] > offsets[:-1]]] = 0
+        counts = numpy.concatenate(([0], numpy.cumsum(set_)))
+        return (offsets[1:] - offsets[:-1] < 2) | (counts[offsets[1:]] > counts[offsets[:-1]])
+
+    @staticmethod
+    def match(matcher, docs, offsets):
+        """Starts and ends of the matches in the arrays of the docs, with the first token of their doc."""
+        matches = [(offset + start, offset + end, offset)
+                   for doc, offset in zip(docs, offsets.tolist()) for match_id, start, end in matcher(doc)]
+        return numpy.array(matches, dtype='int64').reshape(-1, 3).T
+
+    @staticmethod
+    def apply_splits(sent_starts, matches):
+        """Each match starts a sentence at its last token and clears a sentence start on the token before it."""
+        starts, ends, firsts = matches
+        if not len(ends):
+            return
+        order = numpy.arange(len(ends))
+        # Index of the last match setting or clearing the start of each token, -1 if none
+        last_set = numpy.full(len(sent_starts), -1)
+        numpy.maximum.at(last_set, ends - 1, order)
+        last_clear = numpy.full(len(sent_starts), -1)
+        # Only inside the doc of the match
+        cleared = ends - 2 >= firsts
+        numpy.maximum.at(last_clear, ends[cleared] - 2, order[cleared])
+        # A clear only applies to a start, set before by an earlier match or present from the start
+        was_start = sent_starts == 1
+        is_set = last_set >= 0
+        sent_starts[is_set] = 1
+        sent_starts[(last_clear > last_set) & (is_set | was_start)] = -1
+
+    @staticmethod
+    def apply_joins(sent_starts, matches):
+        """Sentence starts inside a match are removed."""
+        starts, ends, firsts = matches
+        if not len(ends):
+            return
+        cover = numpy.zeros(len(sent_starts) + 1, dtype='int64')
+        numpy.add.at(cover, starts, 1)
+        numpy.add.at(cover, ends, -1)
+        covered = numpy.cumsum(cover[:-1]) > 0
+        sent_starts[covered & (sent_starts == 1)] = -1
+
+    @staticmethod
+    def trim_spaces(sent_starts, is_space, doc_starts, doc_ends):
+        """
+        Move the start of each sentence of the given (non empty) docs to its first non space token,
+        unless it only has spaces.
+        """
+        n = len(sent_starts)
+        # Tokens of the given docs, but their first ones that always start a sentence
+        inside = numpy.zeros(n + 1, dtype='int64')
+        numpy.add.at(inside, doc_starts + 1, 1)
+        numpy.add.at(inside, doc_ends, -1)
+        inside = numpy.cumsum(inside[:-1]) > 0
+        starts = numpy.union1d(doc_starts, numpy.flatnonzero(inside & (sent_starts == 1)))
+        # Each sentence ends at the next start or at the end of its doc
+        bounds = numpy.union1d(starts, doc_ends)
+        ends = bounds[numpy.searchsorted(bounds, starts, side='right')]
+        # Index of the first non space token at or after each token, n if none
+        indices = numpy.where(is_space, n, numpy.arange(n))
+        next_non_space = numpy.minimum.accumulate(indices[::-1])[::-1]
+        firsts = next_non_space[starts]
+        moved = (firsts > starts) & (firsts < ends)
+        sent_starts[starts[moved]] = -1
+        sent_starts[firsts[moved]] = 1
+
+    @staticmethod
+    def write(docs, offsets, original, sent_starts):
+        # Only the changed tokens, Doc.from_array reads the whole array element by element
+        changed = numpy.flatnonzero(sent_starts != original)
+        doc_indices = numpy.searchsorted(offsets, changed, side='right') - 1
+        for i, d in zip(changed.tolist(), doc_indices.tolist()):
+            docs[d][i - offsets[d]].is_sent_start = SENT_START_VALUES[sent_starts[i]]
+
+
+def doc_arrays(docs, attr):
+    """The values of an attribute for the tokens of the docs, end to end."""
+    return numpy.concatenate([doc.to_array(attr).reshape(-1) for doc in docs] +
+                             [numpy.zeros(0, dtype='uint64')])
+
 
 def main():
     sent_config = yaml.safe_load(open("example.yaml", 'r'))
@@ -0,0 +1,97 @@
+import threading
+from time import perf_counter
+
+from app.metrics import COMPONENT_SECONDS, PROCESSED_CHARS, PROCESSED_DOCS, PROCESSED_TOKENS
+
+# Time of the timed calls made by the one in progress on this thread: with nlp.pipe a component pulls its docs
+# from the generator of the previous one, that time is not its own
+clock = threading.local()
+
+
+class OwnTime:
+    """Time spent in a block, minus the time of the timed blocks run inside it."""
+    def __enter__(self):
+        self.outer = getattr(clock, 'nested', 0.0)
+        clock.nested = 0.0
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = perf_counter() - self.start
+        self.seconds = elapsed - clock.nested
+        clock.nested = self.outer + elapsed
+
+
+class TimedComponent:
+    """
+    Wraps a pipeline component to observe the time spent in it in the gracyql_component_seconds histogram,
+    once per doc with nlp(text) and once per batch with nlp.pipe. Any other attribute is the one of the component.
+    """
+    def __init__(self, component, model, name):
+        self.component = component
+        self.name = name
+        self.seconds = COMPONENT_SECONDS.labels(model=model, component=name)
+
+    def __getattr__(self, name):
+        if name == 'component':
+            raise AttributeError(name)
+        return getattr(self.component, name)
+
+    def __call__(self, doc, **kwargs):
+        with OwnTime() as timer:
+            doc = self.component(doc, **kwargs)
+        self.seconds.observe(timer.seconds)
+        return doc
+
+    def pipe(self, docs, **kwargs):
+        if hasattr(self.component, 'pipe'):
+            docs = self.component.pipe(docs, **kwargs)
+        else:
+            # Same as the fallback of Language.pipe, these arguments are only meant for pipe
+            kwargs.pop('n_threads', None)
+            kwargs.pop('batch_size', None)
+            docs = (self.component(doc, **kwargs) for doc in docs)
+        seconds = 0.0
+        count = 0
+        try:
+            while True:
+                with OwnTime() as timer:
+                    doc = next(docs, None)
+                seconds += timer.seconds
+                if doc is None:
+                    return
+                count += 1
+                yield doc
+        finally:
+            if count:
+                self.seconds.observe(seconds)
+
+
+class TimedTokenizer(TimedComponent):
+    """Also counts the documents, tokens and characters processed by the model."""
+    def __init__(self, tokenizer, model):
+        super().__init__(tokenizer, model, 'tokenizer')
+        self.docs = PROCESSED_DOCS.labels(model=model)
+        self.tokens = PROCESSED_TOKENS.labels(model=model)
+        self.chars = PROCESSED_CHARS.labels(model=model)
+
+    def __call__(self, text, **kwargs):
+        doc = super().__call__(text, **kwargs)
+        self.docs.inc()
+        self.tokens.inc(len(doc))
+        self.chars.inc(len(text))
+        return doc
+
+    def pipe(self, texts, **kwargs):
+        for doc in super().pipe(texts, **kwargs):
+            self.docs.inc()
+            self.tokens.inc(len(doc))
+            self.chars.inc(len(doc.text))
+            yield doc
+
+
+def timed_pipeline(nlp, model):
+    """Wrap the tokenizer and the components of a loaded pipeline, in place."""
+    nlp.tokenizer = TimedTokenizer(nlp.tokenizer, model)
+    nlp.pipeline = [(name, TimedComponent(component, model, name)) for name, component in nlp.pipeline]
+    return nlp
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+
+import structlog
+
+from app.metrics import DOC_CACHE_BYTES, DOC_CACHE_ENTRIES, DOC_CACHE_EVICTIONS, DOC_CACHE_HITS, DOC_CACHE_MISSES
+from app.schema.serialization import SERIALIZATION_VERSION
+
+logger = structlog.get_logger("gracyql")
+
+
+@lru_cache(maxsize=1024)
+def normalize_cfg(cfg):
+    """Canonical form of a JSON cfg string, semantically identical cfgs get the same form."""
+    overrides = json.loads(cfg) if cfg else {}
+    return json.dumps(overrides, sort_keys=True, separators=(',', ':'))
+
+
+def doc_key(model, cfg, disable, text, version=None, rules=None):
+    """
+    Content address of the Doc produced by a model with the given cfg and disabled components,
+    the version of the model package and the hash of the resolved sentencizer rules (named rule sets are in the cfg
+    by name) so that an upgraded model or an edited rule set doesn't read the entries of the previous one.
+    """
+    source = json.dumps([model, normalize_cfg(cfg), sorted(set(disable)), text, SERIALIZATION_VERSION, version, rules],
+                        ensure_ascii=False)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class DocCache:
+    """In-memory LRU cache of serialized Docs bounded by their total size in bytes."""
+    name = "memory"
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+        if data is None:
+            DOC_CACHE_MISSES.labels(cache=self.name).inc()
+        else:
+            DOC_CACHE_HITS.labels(cache=self.name).inc()
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        evicted = 0
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= len(previous)
+            self.entries[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                _, data = self.entries.popitem(last=False)
+                self.nbytes -= len(data)
+                evicted += 1
+            DOC_CACHE_BYTES.labels(cache=self.name).set(self.nbytes)
+            DOC_CACHE_ENTRIES.labels(cache=self.name).set(len(self.entries))
+        if evicted:
+            DOC_CACHE_EVICTIONS.labels(cache=self.name).inc(evicted)
+
+
+class DiskDocCache:
+    """
+    SQLite cache of serialized Docs shared by all the workers of a host and surviving their restarts.
+    When its content grows over max_bytes, the least recently used documents are deleted down to 90% of it.
+    Errors of the store are logged and handled as misses, they never fail a request.
+    """
+    name = "disk"
+    # Access times are only refreshed if older than this, to avoid a write on every hit
+    touch_interval = 60
+    compact_every = 100
+
+    def __init__(self, path, max_bytes):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.puts = 0
+        # Short lived connection, connections must not be inherited by forked workers
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # Must be set before the table is created to be able to give space back to the file system
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS docs "
+                         "(key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, atime REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS docs_atime ON docs (atime)")
+        finally:
+            conn.close()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        data = None
+        try:
+            conn = self.connection()
+            row = conn.execute("SELECT data, atime FROM docs WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                data, atime = row
+                now = time.time()
+                if now - atime > self.touch_interval:
+                    conn.execute("UPDATE docs SET atime = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.warning("Failed to read from the disk cache %s: %s" % (self.path, e))
+        if data is None:
+            DOC_CACHE_MISSES.labels(cache=self.name).inc()
+        else:
+            DOC_CACHE_HITS.labels(cache=self.name).inc()
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        try:
+            self.connection().execute("INSERT OR REPLACE INTO docs (key, data, size, atime) VALUES (?, ?, ?, ?)",
+                                      (key, data, len(data), time.time()))
+            self.puts += 1
+            if self.puts % self.compact_every == 0:
+                self.compact()
+        except sqlite3.Error as e:
+            logger.warning("Failed to write to the disk cache %s: %s" % (self.path, e))
+
+    def compact(self):
+        conn = self.connection()
+        # Serializes the compactions of all the workers
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            total, count = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM docs").fetchone()
+            evicted = 0
+            if total > self.max_bytes:
+                excess = total - int(self.max_bytes * 0.9)
+                keys = []
+                for key, size in conn.execute("SELECT key, size FROM docs ORDER BY atime"):
+                    keys.append((key,))
+                    excess -= size
+                    total -= size
+                    if excess <= 0:
+                        break
+                conn.executemany("DELETE FROM docs WHERE key = ?", keys)
+                evicted = len(keys)
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        if evicted:
+            conn.execute("PRAGMA incremental_vacuum")
+            DOC_CACHE_EVICTIONS.labels(cache=self.name).inc(evicted)
+        DOC_CACHE_BYTES.labels(cache=self.name).set(total)
+        DOC_CACHE_ENTRIES.labels(cache=self.name).set(count - evicted)
+
+
+class TieredDocCache:
+    """Chain of caches from the fastest to the slowest, hits in a slower cache are copied into the faster ones."""
+    def __init__(self, caches):
+        self.caches = caches
+
+    def get(self, key):
+        for i, cache in enumerate(self.caches):
+            data = cache.get(key)
+            if data is not None:
+                for faster in self.caches[:i]:
+                    faster.put(key, data)
+                return data
+        return None
+
+    def put(self, key, data):
+        for cache in self.caches:
+            cache.put(key, data)
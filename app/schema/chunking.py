@@ -0,0 +1,78 @@
+import re
+
+import numpy
+
+# Preferred places to split a text, in order: after a paragraph break, after a sentence end, after a space
+CHUNK_BOUNDARIES = [
+    re.compile(r'\n[^\S\n]*\n\s*'),
+    re.compile(r'[.!?]["\'»)\]]*\s+'),
+    re.compile(r'\s+'),
+]
+
+
+def split_text(text, chunk_size):
+    """
+    Consecutive chunks of at most chunk_size characters of a text, split on the best boundary found
+    in the second half of each chunk so that the chunks keep similar sizes. The chunks joined are the text.
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > chunk_size:
+        end = start + chunk_size
+        cut = None
+        for boundary in CHUNK_BOUNDARIES:
+            for match in boundary.finditer(text, start + chunk_size // 2, end):
+                cut = match.end()
+            if cut is not None:
+                break
+        if cut is None or cut <= start:
+            # Not even a space, the text is cut in the middle of a word
+            cut = end
+        chunks.append(text[start:cut])
+        start = cut
+    chunks.append(text[start:])
+    return chunks
+
+
+def merge_msgs(msgs):
+    """
+    Serialized form (see serialization.doc_to_msg) of the Doc made of the docs of consecutive chunks of a text.
+    The heads are relative and no sentence or entity crosses a chunk, so the token attributes are only concatenated,
+    the first token of each chunk starts a sentence.
+    """
+    attrs = [attr for attr in msgs[0]["attrs"] if all(attr in msg["attrs"] for msg in msgs)]
+    arrays = []
+    sent_starts = []
+    lengths = []
+    for msg in msgs:
+        length = len(msg["words"])
+        columns = [msg["attrs"].index(attr) for attr in attrs]
+        arrays.append(numpy.asarray(msg["array"]).reshape(length, -1)[:, columns])
+        starts = numpy.array(msg["sent_starts"]).reshape(length)
+        if length:
+            starts[0] = 1
+        sent_starts.append(starts)
+        lengths.append(length)
+    total = sum(lengths) or 1
+    weights = [length / total for length in lengths]
+    cats = {}
+    for msg, weight in zip(msgs, weights):
+        for label, score in msg["cats"].items():
+            cats[label] = cats.get(label, 0.0) + score * weight
+    tensors = [msg["tensor"] for msg, length in zip(msgs, lengths) if length]
+    tensor = None
+    if tensors and all(t is not None and numpy.ndim(t) == 2 and t.shape[1] == tensors[0].shape[1] for t in tensors):
+        tensor = numpy.concatenate(tensors)
+    return {
+        "words": [word for msg in msgs for word in msg["words"]],
+        "spaces": [space for msg in msgs for space in msg["spaces"]],
+        "attrs": attrs,
+        "array": numpy.concatenate(arrays),
+        "sent_starts": numpy.concatenate(sent_starts),
+        "is_parsed": all(msg["is_parsed"] for msg in msgs),
+        "is_tagged": all(msg["is_tagged"] for msg in msgs),
+        "strings": sorted(set(string for msg in msgs for string in msg["strings"])),
+        "cats": cats,
+        "sentiment": sum(msg["sentiment"] * weight for msg, weight in zip(msgs, weights)),
+        "tensor": tensor,
+    }
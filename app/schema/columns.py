@@ -0,0 +1,150 @@
+import numpy
+from spacy.attrs import (CLUSTER, DEP, ENT_IOB, ENT_TYPE, HEAD, IDX, IS_ALPHA, IS_ASCII, IS_BRACKET, IS_CURRENCY,
+                         IS_DIGIT, IS_LEFT_PUNCT, IS_LOWER, IS_PUNCT, IS_QUOTE, IS_RIGHT_PUNCT, IS_SPACE,
+                         IS_STOP, IS_TITLE, IS_UPPER, LANG, LEMMA, LENGTH, LIKE_EMAIL, LIKE_NUM, LIKE_URL, LOWER, NORM,
+                         ORTH, POS, PREFIX, SENT_START, SHAPE, SPACY, SUFFIX, TAG)
+
+# Key of the attribute arrays cached in Doc.user_data, shared by all the spans of a doc
+COLUMNS_KEY = ('gracyql', 'columns')
+
+# String attributes, as hashes (or symbols) of the vocab strings
+STRING_COLUMNS = {
+    'text': ORTH,
+    'orth': ORTH,
+    'lemma': LEMMA,
+    'pos': POS,
+    'tag': TAG,
+    'dep': DEP,
+    'ent_type': ENT_TYPE,
+    'norm': NORM,
+    'lower': LOWER,
+    'shape': SHAPE,
+    'prefix': PREFIX,
+    'suffix': SUFFIX,
+    'lang': LANG,
+}
+
+BOOLEAN_COLUMNS = {
+    'is_alpha': IS_ALPHA,
+    'is_ascii': IS_ASCII,
+    'is_digit': IS_DIGIT,
+    'is_lower': IS_LOWER,
+    'is_upper': IS_UPPER,
+    'is_title': IS_TITLE,
+    'is_punct': IS_PUNCT,
+    'is_left_punct': IS_LEFT_PUNCT,
+    'is_right_punct': IS_RIGHT_PUNCT,
+    'is_space': IS_SPACE,
+    'is_bracket': IS_BRACKET,
+    'is_quote': IS_QUOTE,
+    'is_currency': IS_CURRENCY,
+    'like_url': LIKE_URL,
+    'like_num': LIKE_NUM,
+    'like_email': LIKE_EMAIL,
+    'is_stop': IS_STOP,
+}
+
+# Same strings as Token.ent_iob_
+IOB_STRINGS = ("", "I", "O", "B")
+
+# Arguments filtering the tokens: a list of values of a string attribute, or the value of a boolean one
+STRING_FILTERS = {
+    'pos_in': POS,
+    'tag_in': TAG,
+    'dep_in': DEP,
+    'lemma_in': LEMMA,
+    'ent_type_in': ENT_TYPE,
+}
+
+BOOLEAN_FILTERS = {
+    'is_stop': IS_STOP,
+    'is_punct': IS_PUNCT,
+    'is_space': IS_SPACE,
+    'is_alpha': IS_ALPHA,
+}
+
+
+def doc_column(doc, attr):
+    """The values of an attribute for all the tokens of a doc, extracted once per doc with Doc.to_array."""
+    columns = doc.user_data.get(COLUMNS_KEY)
+    if columns is None:
+        columns = doc.user_data[COLUMNS_KEY] = {}
+    column = columns.get(attr)
+    if column is None:
+        column = columns[attr] = doc.to_array([attr]).reshape(len(doc))
+    return column
+
+
+def filter_tokens(doc, start, end, filters):
+    """The indices of the tokens [start, end) of a doc matching all the given filters, evaluated on whole columns."""
+    mask = numpy.ones(end - start, dtype=bool)
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name in STRING_FILTERS:
+            column = doc_column(doc, STRING_FILTERS[name])[start:end]
+            strings = doc.vocab.strings
+            mask &= numpy.isin(column, numpy.asarray([strings[label] for label in value], dtype=column.dtype))
+        else:
+            mask &= doc_column(doc, BOOLEAN_FILTERS[name])[start:end].astype(bool) == value
+    return numpy.flatnonzero(mask) + start
+
+
+def encode_labels(labels, values):
+    """Dictionary encoding of a column: the value of the i-th token is labels[codes[i]]."""
+    uniques, codes = numpy.unique(values, return_inverse=True)
+    return {'labels': [labels(value) for value in uniques.tolist()], 'codes': codes.tolist()}
+
+
+class TokenColumns:
+    """Attributes of the tokens [start, end) of a doc as parallel arrays, one value per token."""
+    def __init__(self, doc, start, end):
+        self.doc = doc
+        self.start = start
+        self.end = end
+
+    def column(self, attr):
+        return doc_column(self.doc, attr)[self.start:self.end]
+
+    def size(self):
+        return self.end - self.start
+
+    def id(self):
+        return list(range(self.start, self.end))
+
+    def start_(self):
+        return self.column(IDX).tolist()
+
+    def end_(self):
+        return (self.column(IDX) + self.column(LENGTH)).tolist()
+
+    def head(self):
+        # Heads are stored as signed offsets relative to the token
+        return (numpy.arange(self.start, self.end) + self.column(HEAD).view('int64')).tolist()
+
+    def cluster(self):
+        return self.column(CLUSTER).tolist()
+
+    def whitespace(self):
+        return encode_labels(lambda value: " " if value else "", self.column(SPACY))
+
+    def ent_iob(self):
+        return encode_labels(lambda value: IOB_STRINGS[value], self.column(ENT_IOB))
+
+    def is_sent_start(self):
+        # Same values as Token.is_sent_start, None when the boundary is unknown
+        return [None if value == 0 else value == 1 for value in self.column(SENT_START).view('int64').tolist()]
+
+    def is_oov(self):
+        # Not a lexeme flag in every spaCy version, depends on the vectors in recent ones
+        return [token.is_oov for token in self.doc[self.start:self.end]]
+
+    def resolve(self, name):
+        if name in STRING_COLUMNS:
+            strings = self.doc.vocab.strings
+            return encode_labels(lambda value: strings[value], self.column(STRING_COLUMNS[name]))
+        if name in BOOLEAN_COLUMNS:
+            return self.column(BOOLEAN_COLUMNS[name]).astype(bool).tolist()
+        if name in ('start', 'end'):
+            name += '_'
+        return getattr(self, name)()
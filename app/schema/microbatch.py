@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Thread
+from time import monotonic
+
+import structlog
+
+from app.metrics import MICROBATCH_DOCS, MICROBATCH_WAIT
+from app.schema.serialization import deserialize_doc
+
+logger = structlog.get_logger("gracyql")
+
+
+class MicroBatcher:
+    """
+    Dispatcher collecting the single doc requests that arrive within a short window
+    and running them through one nlp.pipe call.
+    Requests are grouped by (model, cfg, disable), a group is flushed as soon as it reaches max_size
+    or when its oldest request has waited max_wait_ms.
+    The micro-batches are sent to the process pool when one is given.
+    """
+    def __init__(self, models, max_wait_ms, max_size, workers=1, pool=None):
+        self.models = models
+        self.pool = pool
+        self.max_wait = max_wait_ms / 1000
+        self.max_size = max_size
+        self.pending = OrderedDict()
+        self.cond = Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="microbatch")
+        self.thread = None
+
+    def submit(self, model, cfg, disable, text):
+        """Queue a text and return a Future that will hold its Doc."""
+        key = (model, cfg, tuple(disable))
+        future = Future()
+        with self.cond:
+            if self.thread is None:
+                # Started lazily so that no thread is running in a process that will fork
+                self.thread = Thread(target=self.run, name="microbatch-dispatcher", daemon=True)
+                self.thread.start()
+            self.pending.setdefault(key, []).append((text, future, monotonic()))
+            self.cond.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Groups are ordered by arrival, the first one holds the oldest request
+                key, requests = next(iter(self.pending.items()))
+                deadline = requests[0][2] + self.max_wait
+                while len(requests) < self.max_size:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = requests[:self.max_size]
+                if len(requests) > self.max_size:
+                    self.pending[key] = requests[self.max_size:]
+                else:
+                    del self.pending[key]
+            self.executor.submit(self.process, key, batch)
+
+    def process(self, key, batch):
+        model, cfg, disable = key
+        now = monotonic()
+        MICROBATCH_DOCS.labels(model=model).observe(len(batch))
+        for text, future, queued in batch:
+            MICROBATCH_WAIT.labels(model=model).observe(now - queued)
+        try:
+            # Documents are already counted by the resolvers
+            nlp = self.models.get_model(model, cfg, 0)
+            texts = [text for text, future, queued in batch]
+            if self.pool is not None:
+                docs = [deserialize_doc(nlp.vocab, data)
+                        for data in self.pool.submit(model, cfg, disable, texts, len(batch)).result()]
+            else:
+                docs = list(nlp.pipe(texts, batch_size=len(batch), disable=list(disable)))
+        except Exception as e:
+            logger.exception("Failed to process a batch of %d documents with model %s" % (len(batch), model))
+            for text, future, queued in batch:
+                future.set_exception(e)
+            return
+        for (text, future, queued), doc in zip(batch, docs):
+            future.set_result(doc)
@@ -0,0 +1,102 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+
+import structlog
+
+from app.metrics import NLP_POOL_QUEUE
+from app.schema.serialization import serialize_doc
+
+logger = structlog.get_logger("gracyql")
+
+# Registry of the models loaded by a pool process
+worker_models = None
+
+
+def init_worker(models_factory, preload):
+    global worker_models
+    worker_models = models_factory()
+    worker_models.preload(preload)
+
+
+def pipe_texts(model, cfg, disable, texts, batch_size):
+    """Run in a pool process: annotate the texts and return the serialized docs."""
+    nlp = worker_models.get_model(model, cfg, len(texts))
+    docs = nlp.pipe(texts, batch_size=batch_size or len(texts), disable=list(disable), cleanup=True)
+    return [serialize_doc(doc) for doc in docs]
+
+
+class NlpPool:
+    """
+    Pool of processes each holding its own copy of the models, so that the spaCy work
+    runs outside of the web process and its GIL.
+    Texts are sent to the processes which send back serialized docs,
+    the GraphQL fields are then resolved on the deserialized docs in the web process.
+    """
+    def __init__(self, processes, models_factory, preload=()):
+        self.processes = processes
+        self.models_factory = models_factory
+        self.preload = list(preload)
+        self.executor = None
+        self.lock = Lock()
+        self.queued = 0
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # Started lazily so that no process is running in a process that will fork.
+                # Spawned, forking a process holding threads and models is not safe
+                self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=init_worker, initargs=(self.models_factory, self.preload))
+            return self.executor
+
+    def submit(self, model, cfg, disable, texts, batch_size=None):
+        """Queue texts and return a Future that will hold their serialized docs."""
+        executor = self.get_executor()
+        try:
+            future = executor.submit(pipe_texts, model, cfg, tuple(disable), texts, batch_size)
+        except BrokenProcessPool:
+            # A process died (e.g. killed by the OOM killer), start a new pool
+            logger.warning("NLP process pool is broken, restarting it")
+            with self.lock:
+                if self.executor is executor:
+                    self.executor = None
+            executor.shutdown(wait=False)
+            future = self.get_executor().submit(pipe_texts, model, cfg, tuple(disable), texts, batch_size)
+        with self.lock:
+            self.queued += 1
+            NLP_POOL_QUEUE.set(self.queued)
+        future.add_done_callback(self.done)
+        return future
+
+    def imap(self, model, cfg, disable, batches, batch_size=None, max_pending=None):
+        """
+        Serialized docs of each batch of texts, in order. The batches are processed in parallel
+        with at most max_pending of them (twice the number of processes by default) queued at once.
+        """
+        max_pending = max_pending or 2 * self.processes
+        pending = deque()
+        try:
+            for texts in batches:
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+                pending.append(self.submit(model, cfg, disable, texts, batch_size))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def done(self, future):
+        with self.lock:
+            self.queued -= 1
+            NLP_POOL_QUEUE.set(self.queued)
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
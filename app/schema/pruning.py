@@ -0,0 +1,98 @@
+from graphql.language.ast import FragmentSpread, InlineFragment
+
+# Pipeline components we know how to reason about, any other component is always run.
+PRUNABLE_COMPONENTS = ('tagger', 'parser', 'ner', 'textcat')
+
+# Sentence boundaries can come from the parser or from a sentence segmentation component
+SENTENCES = 'sents'
+
+FIELD_COMPONENTS = {
+    # Tagger
+    'pos': {'tagger'},
+    'tag': {'tagger'},
+    'lemma': {'tagger'},
+    # Arguments filtering the tokens on these attributes
+    'pos_in': {'tagger'},
+    'tag_in': {'tagger'},
+    'lemma_in': {'tagger'},
+    'dep_in': {'parser'},
+    'ent_type_in': {'ner'},
+    # Dependency parser
+    'dep': {'parser'},
+    'head': {'parser'},
+    'left_edge': {'parser'},
+    'right_edge': {'parser'},
+    'children': {'parser'},
+    'ancestors': {'parser'},
+    'conjuncts': {'parser'},
+    'subtree': {'parser'},
+    'rights': {'parser'},
+    'lefts': {'parser'},
+    'root': {'parser'},
+    'noun_chunks': {'tagger', 'parser'},
+    'sents': {SENTENCES},
+    'is_sent_start': {SENTENCES},
+    # Named entity recognizer
+    'ents': {'ner'},
+    'ent_type': {'ner'},
+    'ent_iob': {'ner'},
+    # Text categorizer
+    'cats': {'textcat'},
+}
+
+# Without static vectors in the vocab, vectors are computed from the doc.tensor set by the tagger
+VECTOR_FIELDS = ('vector', 'vector_b64', 'vector_matrix', 'has_vector', 'vector_norm')
+
+
+def selected_fields(info):
+    """Return the names of all the fields selected below the field being resolved and of their arguments,
+    fragments included."""
+    names = set()
+    stack = [field_ast.selection_set for field_ast in info.field_asts]
+    while stack:
+        selection_set = stack.pop()
+        if selection_set is None:
+            continue
+        for selection in selection_set.selections:
+            if isinstance(selection, FragmentSpread):
+                fragment = info.fragments.get(selection.name.value)
+                if fragment is not None:
+                    stack.append(fragment.selection_set)
+            elif isinstance(selection, InlineFragment):
+                stack.append(selection.selection_set)
+            else:
+                names.add(selection.name.value)
+                names.update(argument.name.value for argument in selection.arguments or ())
+                stack.append(selection.selection_set)
+    return names
+
+
+def has_sentence_segmenter(nlp):
+    """Check whether the pipeline sets sentence boundaries without the parser."""
+    if 'sentencizer' in nlp.pipe_names:
+        return True
+    if 'rule_sentencizer' in nlp.pipe_names:
+        return nlp.get_pipe('rule_sentencizer').split_matcher is not None
+    return False
+
+
+def required_components(nlp, fields):
+    """Compute the smallest set of prunable components needed to resolve the given fields."""
+    required = set()
+    for name in fields:
+        required.update(FIELD_COMPONENTS.get(name, ()))
+        if name in VECTOR_FIELDS and not nlp.vocab.vectors.size:
+            required.add('tagger')
+    if SENTENCES in required:
+        required.discard(SENTENCES)
+        if not has_sentence_segmenter(nlp):
+            required.add('parser')
+    return required
+
+
+def pruned_components(nlp, info, disable):
+    """Merge the explicitly disabled components with the ones the query does not need."""
+    required = required_components(nlp, selected_fields(info))
+    pruned = [name for name in nlp.pipe_names
+              if name in PRUNABLE_COMPONENTS and name not in required and name not in disable]
+    return list(disable) + pruned, pruned
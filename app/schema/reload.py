@@ -0,0 +1,81 @@
+import time
+
+from app.memory import rss_bytes
+
+
+class CountPolicy:
+    """Reload a model after it processed max_docs documents."""
+    name = "count"
+
+    def __init__(self, max_docs):
+        self.max_docs = max_docs
+
+    def reason(self, entry):
+        return self.name if entry.count >= self.max_docs else None
+
+
+class StringsPolicy:
+    """Reload a model once its StringStore grew by max_strings strings, the vocab of a model never shrinks."""
+    name = "strings"
+
+    def __init__(self, max_strings):
+        self.max_strings = max_strings
+
+    def reason(self, entry):
+        return self.name if len(entry.nlp.vocab.strings) - entry.strings >= self.max_strings else None
+
+
+class RssPolicy:
+    """Reload a model once the resident memory of the process grew by max_growth bytes since it was loaded."""
+    name = "rss"
+
+    def __init__(self, max_growth):
+        self.max_growth = max_growth
+
+    def reason(self, entry):
+        return self.name if rss_bytes() - entry.rss >= self.max_growth else None
+
+
+class AgePolicy:
+    """Reload a model max_age seconds after it was loaded."""
+    name = "age"
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+
+    def reason(self, entry):
+        return self.name if time.time() - entry.loaded_at >= self.max_age else None
+
+
+class AnyPolicy:
+    """Reload a model as soon as one of the policies asks for it."""
+    def __init__(self, policies):
+        self.policies = policies
+
+    def reason(self, entry):
+        for policy in self.policies:
+            reason = policy.reason(entry)
+            if reason:
+                return reason
+        return None
+
+
+POLICIES = {policy.name: policy for policy in (CountPolicy, StringsPolicy, RssPolicy, AgePolicy)}
+
+
+def parse_reload_policy(value):
+    """
+    Reload policy from comma separated name:threshold pairs, e.g. "strings:1000000,rss:536870912,age:86400".
+    A model is reloaded as soon as one of the thresholds is reached, "none" or an empty value never reloads.
+    """
+    policies = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item or item == "none":
+            continue
+        name, _, threshold = item.partition(':')
+        if name not in POLICIES or not threshold:
+            raise ValueError("Invalid reload policy %s, expected one of %s followed by :threshold" % (
+                item, ", ".join(POLICIES)))
+        policies.append(POLICIES[name](float(threshold)))
+    return AnyPolicy(policies)
@@ -0,0 +1,59 @@
+import json
+import re
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+
+import structlog
+import yaml
+
+from app.pipeline.RuleSentencizer import RuleSentencizer
+
+logger = structlog.get_logger("gracyql")
+
+RULES_NAME = re.compile(r'^[\w.-]+$')
+RULES_EXTENSIONS = ('.yaml', '.yml', '.json')
+
+
+class RuleFiles:
+    """
+    Sentencizer rule sets stored as YAML (or JSON) files of a directory and referenced by their name,
+    e.g. "example" for example.yaml (see app/pipeline/example.yaml).
+    The files are read once per process, a changed file is only seen after a restart.
+    """
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory else None
+        self.rules = {}
+        self.lock = Lock()
+
+    def load(self, name):
+        """The split and join rules of a named rule set."""
+        with self.lock:
+            rules = self.rules.get(name)
+        if rules is not None:
+            return rules
+        if self.directory is None:
+            raise ValueError("Rule set %s can't be loaded, RULES_DIR is not configured" % name)
+        if not RULES_NAME.match(name) or name.startswith('.'):
+            raise ValueError("Invalid rule set name %s" % name)
+        for extension in RULES_EXTENSIONS:
+            path = self.directory / (name + extension)
+            if path.is_file():
+                break
+        else:
+            raise ValueError("Unknown rule set %s" % name)
+        logger.info("Load rule set %s" % name, path=str(path))
+        with path.open('r', encoding='utf-8') as f:
+            data = yaml.safe_load(f) or {}
+        # Either the rules themselves or a cfg holding them as in example.yaml
+        rules = data.get(RuleSentencizer.name, data)
+        with self.lock:
+            return self.rules.setdefault(name, rules)
+
+
+@lru_cache(maxsize=1024)
+def rules_cfg(cfg, rules):
+    """The cfg with the sentencizer rules replaced by a reference to a named rule set."""
+    overrides = json.loads(cfg) if cfg else {}
+    overrides[RuleSentencizer.name] = rules
+    return json.dumps(overrides, sort_keys=True, separators=(',', ':'))
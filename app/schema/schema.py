@@ -1,22 +1,110 @@
+import copy
 import itertools
 import json
+import sys
+import time
 import uuid
+import weakref
+from collections import OrderedDict, deque
+from functools import partial
+from pathlib import Path
 
 import gc
 import graphene
 import spacy
+import srsly
 import structlog
 from graphene.types.resolver import dict_resolver
 from graphql import GraphQLError
-from threading import RLock
+from prometheus_client import REGISTRY
+from starlette.config import Config
+from threading import Condition, Lock, RLock, Thread
 
 # from app.schema.ICUSentencizer import ICUSentencizer
 # from app.schema.PunktSentencizer import PunktSentencizer
 # from app.schema.SentenceCorrector import SentenceCorrector
 #from app.pipeline.PunktSentencizer import PunktSentencizer
+from app.memory import rss_bytes
+from app.metrics import (BATCHES_DROPPED, cfg_label, MODEL_EVICTIONS, MODEL_LOAD_SECONDS, MODEL_RELOADS, MODELS_BYTES,
+                         ModelsCollector, NlpTime, OPEN_BATCHES, OPEN_BATCHES_BYTES, PIPELINE_RUNS, PRUNED_COMPONENTS)
 from app.pipeline.RuleSentencizer import RuleSentencizer
+from app.pipeline.TimedComponent import TimedComponent, timed_pipeline
+from app.schema.cache import DiskDocCache, DocCache, TieredDocCache, doc_key, normalize_cfg
+from app.schema.chunking import merge_msgs, split_text
+from app.schema.columns import BOOLEAN_FILTERS, filter_tokens, STRING_FILTERS, TokenColumns
+from app.schema.microbatch import MicroBatcher
+from app.schema.pool import NlpPool
+from app.schema.pruning import pruned_components, required_components, selected_fields
+from app.schema.reload import CountPolicy, parse_reload_policy
+from app.schema.rules import RuleFiles, rules_cfg
+from app.schema.serialization import deserialize_doc, doc_from_msg, doc_to_msg, serialize_doc
+from app.schema.snapshot import ModelSnapshots
+from app.schema.spool import SpoolBatchDocs
+from app.schema.tree import span_relatives, span_root, token_relatives
+from app.schema.vectors import doc_vectors, encode_vectors
 logger = structlog.get_logger("gracyql")
 
+
+def parse_models(value):
+    """(model, cfg) pairs from a JSON list of names or [name, cfg] pairs, or from comma separated names."""
+    value = value.strip()
+    if not value:
+        return []
+    if not value.startswith('['):
+        return [(name.strip(), '{}') for name in value.split(',') if name.strip()]
+    models = []
+    for entry in json.loads(value):
+        if isinstance(entry, str):
+            models.append((entry, '{}'))
+        else:
+            model, cfg = entry
+            models.append((model, cfg if isinstance(cfg, str) else json.dumps(cfg)))
+    return models
+
+
+# Config will be read from environment variables and/or ".env" files.
+config = Config(".env")
+
+# Models loaded and warmed up at startup, before the workers are forked when the app is preloaded
+PRELOAD_MODELS = config('PRELOAD_MODELS', cast=parse_models, default="")
+# When to reload a model to give back the memory it accumulated (see app/schema/reload.py)
+RELOAD_POLICY = config('RELOAD_POLICY', cast=parse_reload_policy, default="count:1000")
+# Estimated memory in bytes of the loaded models, the least recently used ones are evicted beyond that, unbounded if 0
+MODELS_MEMORY = config('MODELS_MEMORY', cast=int, default=0)
+# Snapshots of the loaded models to reload them faster, kept in memory and/or in a directory shared by the workers
+SNAPSHOT_MEMORY = config('SNAPSHOT_MEMORY', cast=bool, default=False)
+# Size in bytes of the snapshots kept in memory, the least recently used ones are dropped beyond that
+SNAPSHOT_MEMORY_SIZE = config('SNAPSHOT_MEMORY_SIZE', cast=int, default=1024 * 1024 * 1024)
+SNAPSHOT_DIR = config('SNAPSHOT_DIR', cast=str, default="")
+# Directory of the named rule_sentencizer rule sets, referenced with the rules argument of nlp
+RULES_DIR = config('RULES_DIR', cast=str, default="")
+# Number of processes running the pipelines out of the web process, in-process if 0
+NLP_PROCESSES = config('NLP_PROCESSES', cast=int, default=0)
+# Batches of at least that many texts are spread over the NLP processes, smaller ones run in the web process
+BATCH_PARALLEL_THRESHOLD = config('BATCH_PARALLEL_THRESHOLD', cast=int, default=0)
+# Micro-batching of single doc requests, disabled unless a wait window is configured
+MICROBATCH_WAIT_MS = config('MICROBATCH_WAIT_MS', cast=float, default=0)
+MICROBATCH_SIZE = config('MICROBATCH_SIZE', cast=int, default=32)
+MICROBATCH_WORKERS = config('MICROBATCH_WORKERS', cast=int, default=1)
+# Size in bytes of the in-memory cache of annotated documents, disabled if 0
+DOC_CACHE_SIZE = config('DOC_CACHE_SIZE', cast=int, default=0)
+# Directory of the on-disk cache of annotated documents shared by the workers, disabled if empty
+DOC_CACHE_DIR = config('DOC_CACHE_DIR', cast=str, default="")
+DOC_CACHE_DISK_SIZE = config('DOC_CACHE_DISK_SIZE', cast=int, default=1024 * 1024 * 1024)
+# Open batches: idle time to live in seconds, max count and max estimated memory in bytes
+BATCH_TTL = config('BATCH_TTL', cast=float, default=600)
+MAX_BATCHES = config('MAX_BATCHES', cast=int, default=100)
+BATCH_MEMORY = config('BATCH_MEMORY', cast=int, default=512 * 1024 * 1024)
+# Directory where the batches are produced so that any worker of the host can serve their pages, in memory if empty
+BATCH_SPOOL_DIR = config('BATCH_SPOOL_DIR', cast=str, default="")
+# Number of documents a batch producer may process ahead of the client, in-memory batches are only processed
+# when their pages are requested if 0
+BATCH_LOOKAHEAD = config('BATCH_LOOKAHEAD', cast=int, default=100)
+# Estimated memory in bytes of the documents an in-memory batch may process ahead of the client, unbounded if 0
+BATCH_LOOKAHEAD_BYTES = config('BATCH_LOOKAHEAD_BYTES', cast=int, default=64 * 1024 * 1024)
+# Maximum batch_size of the streamed batches, nlp.pipe yields the first doc once that many texts are processed
+STREAM_BATCH_SIZE = config('STREAM_BATCH_SIZE', cast=int, default=16)
+
 #from pympler import tracker, summary, muppy
 #tr = tracker.SummaryTracker()
 
@@ -27,8 +115,79 @@ def spacy_attr_resolver(attname, default_value, root, info, **args):
         return getattr(root, attname, default_value)
 
 
-def load_model(model, cfg):
+def token_columns_resolver(attname, default_value, root, info, **args):
+    return root.resolve(attname)
+
+
+def page_arguments():
+    """Arguments paginating a list field."""
+    return {
+        'offset': graphene.Int(default_value=0, description="The number of items skipped."),
+        'limit': graphene.Int(description="The maximum number of items returned, all of them if not set."),
+    }
+
+
+def token_filter_arguments():
+    """Arguments of the token lists, the tokens are filtered on the attribute columns of the doc, then paginated."""
+    arguments = {name: graphene.List(graphene.String, description="Only the tokens whose %s is one of these values."
+                                                                  % name[:-len('_in')])
+                 for name in STRING_FILTERS}
+    arguments.update({name: graphene.Boolean(description="Only the tokens whose %s is this value." % name)
+                      for name in BOOLEAN_FILTERS})
+    arguments.update(page_arguments())
+    return arguments
+
+
+def page(offset, limit):
+    if offset < 0 or (limit is not None and limit < 0):
+        raise GraphQLError("offset and limit can't be negative")
+    return slice(offset, None if limit is None else offset + limit)
+
+
+def filtered_tokens(doc, start, end, offset, limit, filters):
+    """The tokens [start, end) of a doc matching the filter arguments, only the ones of the page are created."""
+    indices = filter_tokens(doc, start, end, filters)[page(offset, limit)]
+    return [doc[i] for i in indices.tolist()]
+
+
+def filtered_ents(ents, offset, limit, label_in=None):
+    if label_in is not None:
+        labels = set(label_in)
+        ents = [ent for ent in ents if ent.label_ in labels]
+    return list(ents)[page(offset, limit)]
+
+
+def split_cfg(cfg):
+    """Split a cfg into the overrides of the base model and the rules of its sentencizer."""
     overrides = json.loads(cfg) if cfg else {}
+    rules = {}
+    if RuleSentencizer.name in overrides:
+        rules[RuleSentencizer.name] = overrides.pop(RuleSentencizer.name)
+        if isinstance(rules[RuleSentencizer.name], str):
+            # Named rule set of RULES_DIR
+            rules[RuleSentencizer.name] = rule_files.load(rules[RuleSentencizer.name])
+    return overrides, rules
+
+
+def load_model(model, cfg):
+    overrides, rules = split_cfg(cfg)
+    return variant_model(load_base_model(model, overrides), rules, model)
+
+
+def variant_model(base, rules, model):
+    """A pipeline sharing the vocab, tokenizer and components of a base model, with its own (timed) sentencizer."""
+    nlp = copy.copy(base)
+    nlp.pipeline = list(base.pipeline)
+    nlp.meta = dict(base.meta)
+    #sentencizer = PunktSentencizer(nlp, **overrides)
+    sentencizer = RuleSentencizer(nlp, **rules)
+    #sentencizer = ICUSentencizer(nlp, **overrides)
+    #nlp.add_pipe(sentencizer, first=True)
+    nlp.add_pipe(TimedComponent(sentencizer, model, RuleSentencizer.name), name=RuleSentencizer.name)
+    return nlp
+
+
+def load_base_model(model, overrides):
     # overrides2 = defaultdict(dict)
     # overrides2["rule_sentencizer"]["split"] = [
     #     # Split on double line breaks
@@ -40,74 +199,531 @@ def load_model(model, cfg):
     #     # Une indemnité de 100. 000 Frs
     #     [{"IS_DIGIT": True}, {"IS_PUNCT" : True}, {"IS_SENT_START": True, "IS_DIGIT": True}]
     # ]
-    logger.info("Load model %s"%model, cfg=cfg)
-    nlp = spacy.load(model, **overrides)
-    #sentencizer = PunktSentencizer(nlp, **overrides)
-    sentencizer = RuleSentencizer(nlp, **overrides)
-    #sentencizer = ICUSentencizer(nlp, **overrides)
-    #nlp.add_pipe(sentencizer, first=True)
-    nlp.add_pipe(sentencizer)
-    return nlp
+    cfg = normalize_cfg(json.dumps(overrides))
+    nlp = model_snapshots.load((model, cfg)) if model_snapshots is not None else None
+    if nlp is None:
+        logger.info("Load model %s"%model, cfg=cfg)
+        nlp = spacy.load(model, **overrides)
+        if model_snapshots is not None:
+            model_snapshots.save((model, cfg), nlp)
+    # Wrapped once loaded, the snapshots keep the plain components
+    return timed_pipeline(nlp, model)
+
+
+def effective_disable(nlp, info, nlp_args):
+    """Components to disable for this query: the explicit ones plus the ones the selection set doesn't need."""
+    model, disable = nlp_args['model'], nlp_args['disable']
+    PIPELINE_RUNS.labels(model=model).inc()
+    if not nlp_args.get('prune', True):
+        return disable
+    disable, pruned = pruned_components(nlp, info, disable)
+    if pruned:
+        logger.debug("Pruned components %s of model %s" % (pruned, model))
+        for name in pruned:
+            PRUNED_COMPONENTS.labels(model=model, component=name).inc()
+    return disable
+
+
+def check_pruned(batch_, info):
+    """The pages of a batch can't select fields needing the components pruned when its texts were submitted."""
+    if not batch_.pruned:
+        return
+    required = required_components(spacy_models.get_model(batch_.model, batch_.cfg, 0), selected_fields(info))
+    missing = [name for name in batch_.pruned if name in required]
+    if missing:
+        raise GraphQLError('Batch %s is processed without the %s components, its texts must be submitted again '
+                           'selecting these fields or with prune: false!' % (batch_.uuid_, ', '.join(missing)))
+
+
+WARM_UP_TEXTS = ["This is a warm up sentence.", "Another one, to run the whole pipeline twice!"]
+
+
+class BaseModel:
+    """A model loaded without its sentencizer, shared by all the cfg variants that only differ by their sentencizer rules."""
+    def __init__(self, key, nlp, nbytes):
+        self.key = key
+        self.nlp = nlp
+        # Estimated from the growth of the process memory while it was loaded
+        self.nbytes = nbytes
+
+
+class ModelEntry:
+    def __init__(self, nlp, base=None):
+        self.nlp = nlp
+        self.base = base
+        self.reloading = False
+        self.reset()
+
+    def reset(self):
+        # The reload policies look at the growth since then
+        self.count = 0
+        self.loaded_at = time.time()
+        self.strings = len(self.nlp.vocab.strings)
+        self.rss = rss_bytes()
 
 
 class SpacyModels:
-    def __init__(self, reload):
-        self.models = {}
-        self.reload = reload
+    """Registry of loaded models.
+    Cached models are looked up without any lock, the lock is only taken to load a missing model or to schedule a reload.
+    Reloads are done on a background thread: the new instance is built next to the old one and swapped in once ready,
+    in-flight requests keep their reference to the old instance which is freed when they are done with it.
+    When to reload is decided by a reload policy, a number of documents is a CountPolicy.
+    Models are keyed by their normalized cfg, the cfgs only differing by their rule_sentencizer rules share one base model.
+    Beyond max_bytes of base models, the least recently used models are evicted."""
+    def __init__(self, reload, max_bytes=0):
+        self.models = OrderedDict()
+        self.bases = weakref.WeakValueDictionary()
+        self.reload = CountPolicy(reload) if isinstance(reload, int) else reload
+        self.max_bytes = max_bytes
         self.rlock = RLock()
+        self.load_locks = {}
 
     def get_model(self, model, cfg, num=1):
+        key = (model, normalize_cfg(cfg))
+        entry = self.models.get(key)
+        if entry is None:
+            entry = self.load(key)
+        else:
+            try:
+                self.models.move_to_end(key)
+            except KeyError:
+                # Evicted meanwhile, still usable by this request
+                pass
+        nlp = entry.nlp
+        logger.info("About to process %d documents with model %s" % (num, nlp.meta['name']))
+        # Not atomic, a few documents may be missed under contention which is fine for a reload threshold
+        entry.count += num
+        if not entry.reloading:
+            reason = self.reload.reason(entry)
+            if reason:
+                self.schedule_reload(key, entry, reason)
+        return nlp
+
+    def load(self, key):
+        model, cfg = key
+        overrides, rules = split_cfg(cfg)
+        base_key = (model, normalize_cfg(json.dumps(overrides)))
+        with self.rlock:
+            load_lock = self.load_locks.setdefault(base_key, Lock())
+        # Only requests for the same missing base model wait for it to be loaded
+        with load_lock:
+            entry = self.models.get(key)
+            if entry is None:
+                base = self.bases.get(base_key)
+                if base is None:
+                    base = self.load_base(base_key, overrides)
+                entry = ModelEntry(variant_model(base.nlp, rules, model), base)
+                self.models[key] = entry
+                # The cfg label of the model metrics
+                logger.info("Model %s ready" % model, cfg=cfg, cfg_label=cfg_label(cfg))
+                self.evict()
+        return entry
+
+    def load_base(self, base_key, overrides, kind='load'):
+        before = rss_bytes()
+        with MODEL_LOAD_SECONDS.labels(model=base_key[0], kind=kind).time():
+            nlp = load_base_model(base_key[0], overrides)
+        base = BaseModel(base_key, nlp, max(rss_bytes() - before, 0))
+        logger.info("Model %s loaded/reloaded" % nlp.meta['name'])
+        self.bases[base_key] = base
+        return base
+
+    def used_bytes(self):
+        bases = {id(entry.base): entry.base for entry in list(self.models.values()) if entry.base is not None}
+        return sum(base.nbytes for base in bases.values())
+
+    def evict(self):
+        """Evict the least recently used models until the base models still in use fit in max_bytes."""
         with self.rlock:
-            key = (model, cfg)
+            used = self.used_bytes()
+            # The last model is the one being loaded
+            while self.max_bytes and used > self.max_bytes and len(self.models) > 1:
+                (model, cfg), entry = self.models.popitem(last=False)
+                logger.info("Evicted model %s" % model, cfg=cfg)
+                MODEL_EVICTIONS.labels(model=model).inc()
+                used = self.used_bytes()
+            MODELS_BYTES.set(used)
+
+    def preload(self, models):
+        """Load and warm up the given (model, cfg) pairs, so that no request waits for them."""
+        for model, cfg in models:
+            key = (model, normalize_cfg(cfg))
             if key in self.models:
-                nlp, count = self.models[key]
-                logger.info("About to process %d documents with model %s" % (num, nlp.meta['name']))
-                if count % self.reload == 0:
-                    del nlp
-                    del self.models[key]
-                    gc.collect()
-                    nlp = load_model(model, cfg)
-                    logger.info("Model %s loaded/reloaded"%nlp.meta['name'])
-                self.models[key] = (nlp, count+num)
-            else:
-                nlp = load_model(model, cfg)
-                logger.info("About to process %d documents with model %s" % (num, nlp.meta['name']))
-                logger.info("Model %s loaded/reloaded"%nlp.meta['name'])
-                self.models[key] = (nlp, num)
-        return nlp
+                continue
+            nlp = self.load(key).nlp
+            # A first run allocates what the components initialize lazily
+            list(nlp.pipe(WARM_UP_TEXTS))
+            logger.info("Model %s warmed up" % nlp.meta['name'])
+
+    def schedule_reload(self, key, entry, reason):
+        with self.rlock:
+            if entry.reloading:
+                return
+            entry.reloading = True
+        logger.info("Reloading model %s (%s)" % (key[0], reason), cfg=key[1])
+        MODEL_RELOADS.labels(model=key[0], reason=reason).inc()
+        Thread(target=self.reload_model, args=(key, entry), name="reload-%s" % key[0], daemon=True).start()
+
+    def reload_model(self, key, entry):
+        model, cfg = key
+        overrides, rules = split_cfg(cfg)
+        try:
+            base = self.load_base(entry.base.key if entry.base is not None else (model, normalize_cfg(json.dumps(overrides))),
+                                  overrides, 'reload')
+        except Exception:
+            logger.exception("Failed to reload model %s" % key[0], cfg=key[1])
+            # Tried again once the thresholds are reached again
+            entry.reset()
+            entry.reloading = False
+            return
+        name = base.nlp.meta['name']
+        with self.rlock:
+            # Atomic swaps, the next lookups get the new instances.
+            # All the variants of the previous base model move to the new one so that it can be freed
+            for other_key, other in list(self.models.items()):
+                if other is entry or (other.base is not None and other.base is entry.base):
+                    self.models[other_key] = ModelEntry(variant_model(base.nlp, split_cfg(other_key[1])[1], other_key[0]), base)
+            self.evict()
+        weakref.finalize(entry.nlp, logger.info, "Previous instance of model %s released" % name)
+        del entry
+        gc.collect()
+
+# Rough size in bytes of the C struct of a token of a Doc
+TOKEN_BYTES = 128
+
+
+def doc_nbytes(doc):
+    """Estimated memory held by a processed Doc."""
+    return len(doc) * TOKEN_BYTES + (doc.tensor.nbytes if doc.tensor is not None else 0)
+
 
 class BatchSlice:
-    def __init__(self, doc_generator, max):
+    def __init__(self, doc_generator, max, nbytes=0, model=None, cfg=None, pruned=()):
         self.uuid_ = uuid.uuid4()
         self.gen = doc_generator
         self.max = max
+        self.model = model
+        self.cfg = cfg
+        # Components pruned for the query submitting the texts, the docs of all the pages are processed without them
+        self.pruned = list(pruned)
         self.id = 0
+        # Estimated memory held by the texts still to be processed
+        self.nbytes = nbytes
+        self.last_access = time.monotonic()
+        self.lock = Lock()
+        # Documents processed ahead of the client, once prefetch is started
+        self.buffer = None
+        self.buffered_bytes = 0
+        self.ready = Condition()
+        self.produced = False
+        self.closed = False
+        self.error = None
+
+    def prefetch(self, lookahead, lookahead_bytes=0):
+        """
+        Process the documents in a background thread, up to lookahead documents and, if not 0,
+        lookahead_bytes of their estimated memory ahead of the client, so that the pages are ready when requested.
+        """
+        self.buffer = deque()
+        Thread(target=self.produce, args=(lookahead, lookahead_bytes), name="batch-%s" % self.uuid_, daemon=True).start()
+
+    def produce(self, lookahead, lookahead_bytes):
+        try:
+            for doc in self.gen:
+                nbytes = doc_nbytes(doc)
+                with self.ready:
+                    if self.closed:
+                        break
+                    self.buffer.append((doc, nbytes))
+                    self.buffered_bytes += nbytes
+                    self.ready.notify_all()
+                    # Backpressure: wait for the client to catch up
+                    while not self.closed and (len(self.buffer) >= lookahead or
+                                               lookahead_bytes and self.buffered_bytes >= lookahead_bytes):
+                        self.ready.wait()
+                    if self.closed:
+                        break
+        except Exception as e:
+            logger.exception("Failed to process batch %s" % self.uuid_)
+            self.error = e
+        finally:
+            # Closed by the thread running it, a generator can't be closed while it runs in another thread
+            self.gen.close()
+            with self.ready:
+                self.produced = True
+                self.ready.notify_all()
+        if self.closed:
+            logger.info("Batch %s closed, stopping its producer" % self.uuid_)
 
     def next(self, next):
-        self.id += next
-        return itertools.islice(self.gen, 0, next)
+        # Materialized under the lock, the generator can't be consumed by two concurrent requests
+        with self.lock, NlpTime():
+            if self.buffer is None:
+                docs = list(itertools.islice(self.gen, 0, next))
+            else:
+                docs = self.take(next)
+            self.id += next
+        return docs
+
+    def take(self, next):
+        docs = []
+        with self.ready:
+            while len(docs) < next:
+                if self.buffer:
+                    doc, nbytes = self.buffer.popleft()
+                    self.buffered_bytes -= nbytes
+                    docs.append(doc)
+                    self.ready.notify_all()
+                elif self.produced:
+                    if self.error is not None:
+                        raise GraphQLError('Batch %s failed: %s' % (self.uuid_, self.error))
+                    break
+                else:
+                    self.ready.wait()
+        return docs
 
     def has_next(self):
         return self.id < self.max
 
+    def remaining_bytes(self):
+        return self.nbytes * max(self.max - self.id, 0) // max(self.max, 1) + self.buffered_bytes
+
+    def close(self):
+        if self.buffer is not None:
+            with self.ready:
+                self.closed = True
+                self.buffer.clear()
+                self.buffered_bytes = 0
+                self.ready.notify_all()
+            return
+        # If the batch is being read, the generator is released with the last reference to it
+        if self.lock.acquire(blocking=False):
+            try:
+                self.gen.close()
+            finally:
+                self.lock.release()
+
+
 class BatchDocs:
-    def __init__(self):
-        self.batches = {}
+    """
+    Store of the open batches, in least recently used order.
+    Batches idle for more than ttl seconds expire, and the least recently used ones are evicted
+    when there are more than max_batches of them or when their estimated memory exceeds max_bytes.
+    With a lookahead, the documents of each batch are processed in the background ahead of the client.
+    """
+    def __init__(self, ttl, max_batches, max_bytes, max_dropped=1000, lookahead=0, lookahead_bytes=0):
+        self.batches = OrderedDict()
+        self.lookahead = lookahead
+        self.lookahead_bytes = lookahead_bytes
+        self.ttl = ttl
+        self.max_batches = max_batches
+        self.max_bytes = max_bytes
+        # Recently dropped batch ids and the reason why, to report a meaningful error
+        self.dropped = OrderedDict()
+        self.max_dropped = max_dropped
+        self.lock = RLock()
 
     def get(self, uuid_):
         if isinstance(uuid_, str):
             uuid_ = uuid.UUID(uuid_)
-        return self.batches.get(uuid_, None)
+        with self.lock:
+            self.expire()
+            batch = self.batches.get(uuid_, None)
+            if batch is not None:
+                batch.last_access = time.monotonic()
+                self.batches.move_to_end(uuid_)
+        return batch
+
+    def dropped_reason(self, uuid_):
+        if isinstance(uuid_, str):
+            uuid_ = uuid.UUID(uuid_)
+        with self.lock:
+            return self.dropped.get(uuid_, None)
 
     def add(self, batch : BatchSlice):
-        self.batches[batch.uuid_] = batch
+        with self.lock:
+            self.expire()
+            self.batches[batch.uuid_] = batch
+            if self.lookahead > 0:
+                batch.prefetch(self.lookahead, self.lookahead_bytes)
+            while len(self.batches) > 1 and (len(self.batches) > self.max_batches or
+                                             sum(b.remaining_bytes() for b in self.batches.values()) > self.max_bytes):
+                self.drop(next(iter(self.batches.values())), 'evicted')
+            self.update_metrics()
+        return batch
 
     def remove(self, batch : BatchSlice):
-        if batch.uuid_ in self.batches:
-            del self.batches[batch.uuid_]
+        with self.lock:
+            if batch.uuid_ in self.batches:
+                del self.batches[batch.uuid_]
+            self.update_metrics()
+        batch.close()
+
+    def expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self.batches:
+            batch = next(iter(self.batches.values()))
+            if batch.last_access > deadline:
+                break
+            self.drop(batch, 'expired')
+        self.update_metrics()
+
+    def drop(self, batch : BatchSlice, reason):
+        del self.batches[batch.uuid_]
+        batch.close()
+        self.dropped[batch.uuid_] = reason
+        if len(self.dropped) > self.max_dropped:
+            self.dropped.popitem(last=False)
+        BATCHES_DROPPED.labels(reason=reason).inc()
+        logger.info("Batch %s %s" % (batch.uuid_, reason))
+
+    def update_metrics(self):
+        OPEN_BATCHES.set(len(self.batches))
+        OPEN_BATCHES_BYTES.set(sum(b.remaining_bytes() for b in self.batches.values()))
+
+
+rule_files = RuleFiles(RULES_DIR)
+model_snapshots = ModelSnapshots(SNAPSHOT_MEMORY, SNAPSHOT_DIR, SNAPSHOT_MEMORY_SIZE) \
+    if SNAPSHOT_MEMORY or SNAPSHOT_DIR else None
+spacy_models = SpacyModels(reload=RELOAD_POLICY, max_bytes=MODELS_MEMORY)
+REGISTRY.register(ModelsCollector(spacy_models))
+if BATCH_SPOOL_DIR:
+    batch_docs = SpoolBatchDocs(BATCH_SPOOL_DIR, spacy_models, BATCH_TTL, BATCH_LOOKAHEAD, MAX_BATCHES, BATCH_MEMORY)
+else:
+    batch_docs = BatchDocs(BATCH_TTL, MAX_BATCHES, BATCH_MEMORY, lookahead=BATCH_LOOKAHEAD,
+                           lookahead_bytes=BATCH_LOOKAHEAD_BYTES)
+nlp_pool = NlpPool(NLP_PROCESSES, partial(SpacyModels, reload=spacy_models.reload, max_bytes=spacy_models.max_bytes),
+                   PRELOAD_MODELS) if NLP_PROCESSES > 0 else None
+microbatcher = MicroBatcher(spacy_models, MICROBATCH_WAIT_MS, MICROBATCH_SIZE,
+                            MICROBATCH_WORKERS, nlp_pool) if MICROBATCH_WAIT_MS > 0 else None
+
+
+def create_doc_cache():
+    caches = []
+    if DOC_CACHE_SIZE > 0:
+        caches.append(DocCache(DOC_CACHE_SIZE))
+    if DOC_CACHE_DIR:
+        cache_dir = Path(DOC_CACHE_DIR)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        caches.append(DiskDocCache(cache_dir / "docs.sqlite", DOC_CACHE_DISK_SIZE))
+    return TieredDocCache(caches) if caches else None
+
+
+doc_cache = create_doc_cache()
+
+
+def process_doc(nlp, nlp_args, disable, text):
+    """Annotate a single text, going through the doc cache, the micro-batching dispatcher and the process pool when enabled."""
+    with NlpTime():
+        return annotate_doc(nlp, nlp_args, disable, text)
+
+
+def cache_key(nlp, nlp_args, disable, text):
+    return doc_key(nlp_args['model'], nlp_args['cfg'], disable, text, nlp.meta.get('version'),
+                   nlp.get_pipe(RuleSentencizer.name).rules_hash)
+
+
+def annotate_doc(nlp, nlp_args, disable, text):
+    key = None
+    if doc_cache is not None:
+        key = cache_key(nlp, nlp_args, disable, text)
+        data = doc_cache.get(key)
+        if data is not None:
+            return deserialize_doc(nlp.vocab, data)
+    data = None
+    if microbatcher is not None:
+        doc = microbatcher.submit(nlp_args['model'], nlp_args['cfg'], disable, text).result()
+    elif nlp_pool is not None:
+        data = nlp_pool.submit(nlp_args['model'], nlp_args['cfg'], disable, [text]).result()[0]
+        doc = deserialize_doc(nlp.vocab, data)
+    else:
+        doc = nlp(text, disable=disable)
+    if key is not None:
+        doc_cache.put(key, data if data is not None else serialize_doc(doc))
+    return doc
+
+
+def process_chunked_doc(nlp, nlp_args, disable, text, chunk_size):
+    """
+    Annotate a long text by chunks of at most chunk_size characters, processed in parallel by the process pool
+    when enabled, and merge them back into one Doc. Only the small token arrays of the processed chunks are kept.
+    """
+    with NlpTime():
+        return annotate_chunked_doc(nlp, nlp_args, disable, text, chunk_size)
+
+
+def annotate_chunked_doc(nlp, nlp_args, disable, text, chunk_size):
+    chunks = split_text(text, min(chunk_size, nlp.max_length))
+    if len(chunks) == 1:
+        return process_doc(nlp, nlp_args, disable, text)
+    if nlp_pool is not None:
+        results = nlp_pool.imap(nlp_args['model'], nlp_args['cfg'], disable, ([chunk] for chunk in chunks))
+        msgs = [srsly.msgpack_loads(data) for datas in results for data in datas]
+    else:
+        msgs = [doc_to_msg(doc) for doc in nlp.pipe(chunks, batch_size=1, disable=disable, cleanup=True)]
+    return doc_from_msg(nlp.vocab, merge_msgs(msgs))
+
+
+def process_batch(nlp, nlp_args, disable, texts, batch_size):
+    """Annotate texts lazily, only the texts missing from the doc cache are sent to nlp.pipe."""
+    if doc_cache is None:
+        return pipe(nlp, nlp_args, disable, texts, batch_size)
+    return cached_pipe(nlp, nlp_args, disable, texts, batch_size)
+
+
+def pipe(nlp, nlp_args, disable, texts, batch_size):
+    if nlp_pool is None or len(texts) < BATCH_PARALLEL_THRESHOLD:
+        return nlp.pipe(texts, batch_size=batch_size, disable=disable, cleanup=True)
+    return pooled_pipe(nlp, nlp_args, disable, texts, batch_size)
+
+
+def pooled_pipe(nlp, nlp_args, disable, texts, batch_size):
+    """
+    Annotate texts in the process pool, split in chunks of at most batch_size texts processed in parallel and read in order.
+    Four chunks per process at least so that the processes share the work and the first docs are ready sooner.
+    """
+    size = min(batch_size or len(texts), -(-len(texts) // (4 * nlp_pool.processes))) or 1
+    chunks = (texts[start:start + size] for start in range(0, len(texts), size))
+    results = nlp_pool.imap(nlp_args['model'], nlp_args['cfg'], disable, chunks, size)
+    try:
+        for datas in results:
+            for data in datas:
+                yield deserialize_doc(nlp.vocab, data)
+    finally:
+        # Cancels the chunks still queued when the batch is dropped
+        results.close()
+
+
+def cached_pipe(nlp, nlp_args, disable, texts, batch_size):
+    keys = [cache_key(nlp, nlp_args, disable, text) for text in texts]
+    cached = [doc_cache.get(key) for key in keys]
+    missed = [text for text, data in zip(texts, cached) if data is None]
+    docs = pipe(nlp, nlp_args, disable, missed, batch_size)
+    for key, data in zip(keys, cached):
+        if data is None:
+            doc = next(docs)
+            doc_cache.put(key, serialize_doc(doc))
+            yield doc
+        else:
+            yield deserialize_doc(nlp.vocab, data)
 
-spacy_models = SpacyModels(reload=1000)
-batch_docs = BatchDocs()
+
+class VectorDtype(graphene.Enum):
+    """Encoding of the vector components, little-endian IEEE 754 floats."""
+    float32 = '<f4'
+    float16 = '<f2'
+
+
+class VectorMatrix(graphene.ObjectType):
+    """The vectors of all the tokens of a document as one row-major matrix."""
+
+    class Meta:
+        default_resolver = dict_resolver
+
+    rows = graphene.Int(description="The number of rows, one per token.")
+    dims = graphene.Int(description="The number of dimensions of the vectors.")
+    dtype = graphene.Field(VectorDtype)
+    data = graphene.String(description="Base64 of the rows * dims components.")
 
 
 class Container(graphene.Interface):
@@ -119,8 +735,14 @@ class Container(graphene.Interface):
     vector = graphene.List(graphene.Float, description="A real-valued meaning representation.")
     vector_norm = graphene.Float(description="""The L2 norm of the document’s vector representation.""")
 
+    vector_b64 = graphene.String(dtype=VectorDtype(default_value=VectorDtype.float32.value),
+                                 description="The vector as base64 of its components, a compact alternative to vector.")
+
     def resolve_vector(self, info):
-        return [float(x) for x in self.vector]
+        return self.vector.tolist()
+
+    def resolve_vector_b64(self, info, dtype):
+        return encode_vectors(self.vector, dtype)
 
 
 class Token(graphene.ObjectType):
@@ -192,6 +814,84 @@ class Token(graphene.ObjectType):
     rights = graphene.List(lambda: Token)
     lefts = graphene.List(lambda: Token)
 
+    # Taken from the tree index of the doc, each spaCy property walks the tree again for each token
+    def resolve_children(self, info):
+        return token_relatives(self, 'children')
+
+    def resolve_ancestors(self, info):
+        return token_relatives(self, 'ancestors')
+
+    def resolve_conjuncts(self, info):
+        return token_relatives(self, 'conjuncts')
+
+    def resolve_subtree(self, info):
+        return token_relatives(self, 'subtree')
+
+    def resolve_rights(self, info):
+        return token_relatives(self, 'rights')
+
+    def resolve_lefts(self, info):
+        return token_relatives(self, 'lefts')
+
+
+class LabelColumn(graphene.ObjectType):
+    """A dictionary encoded string attribute: the value of the i-th token is labels[codes[i]]."""
+
+    class Meta:
+        default_resolver = dict_resolver
+
+    labels = graphene.List(graphene.String, description="The distinct values of the attribute.")
+    codes = graphene.List(graphene.Int, description="For each token, the index of its value in labels.")
+
+
+class TokenTable(graphene.ObjectType):
+    """The attributes of a sequence of tokens as parallel arrays, one value per token.
+    Much faster to produce and much smaller than a list of Token objects on long documents."""
+
+    class Meta:
+        default_resolver = token_columns_resolver
+
+    size = graphene.Int(description="The number of tokens.")
+    id = graphene.List(graphene.Int, description="The indices of the tokens within the parent document.")
+    start = graphene.List(graphene.Int, description="The starting character offsets of the tokens.")
+    end = graphene.List(graphene.Int, description="The ending character offsets of the tokens.")
+    head = graphene.List(graphene.Int, description="The indices of the syntactic parents of the tokens within the parent document.")
+    text = graphene.Field(LabelColumn)
+    orth = graphene.Field(LabelColumn)
+    pos = graphene.Field(LabelColumn)
+    tag = graphene.Field(LabelColumn)
+    lemma = graphene.Field(LabelColumn)
+    whitespace = graphene.Field(LabelColumn)
+    ent_type = graphene.Field(LabelColumn)
+    ent_iob = graphene.Field(LabelColumn)
+    norm = graphene.Field(LabelColumn)
+    lower = graphene.Field(LabelColumn)
+    shape = graphene.Field(LabelColumn)
+    prefix = graphene.Field(LabelColumn)
+    suffix = graphene.Field(LabelColumn)
+    dep = graphene.Field(LabelColumn)
+    lang = graphene.Field(LabelColumn)
+    is_sent_start = graphene.List(graphene.Boolean)
+    is_alpha = graphene.List(graphene.Boolean)
+    is_ascii = graphene.List(graphene.Boolean)
+    is_digit = graphene.List(graphene.Boolean)
+    is_lower = graphene.List(graphene.Boolean)
+    is_upper = graphene.List(graphene.Boolean)
+    is_title = graphene.List(graphene.Boolean)
+    is_punct = graphene.List(graphene.Boolean)
+    is_left_punct = graphene.List(graphene.Boolean)
+    is_right_punct = graphene.List(graphene.Boolean)
+    is_space = graphene.List(graphene.Boolean)
+    is_bracket = graphene.List(graphene.Boolean)
+    is_quote = graphene.List(graphene.Boolean)
+    is_currency = graphene.List(graphene.Boolean)
+    like_url = graphene.List(graphene.Boolean)
+    like_num = graphene.List(graphene.Boolean)
+    like_email = graphene.List(graphene.Boolean)
+    is_oov = graphene.List(graphene.Boolean)
+    is_stop = graphene.List(graphene.Boolean)
+    cluster = graphene.List(graphene.Int)
+
 
 class Span(graphene.ObjectType):
     """A slice from a Doc object."""
@@ -213,19 +913,44 @@ class Span(graphene.ObjectType):
     label = graphene.String()
     lemma = graphene.String()
     # Span references
-    ents = graphene.List(lambda: Span)
+    ents = graphene.List(lambda: Span, label_in=graphene.List(graphene.String), **page_arguments())
+
+    def resolve_ents(self, info, offset, limit=None, label_in=None):
+        return filtered_ents(self.ents, offset, limit, label_in)
+
     # Token references
-    tokens = graphene.List(Token)
+    tokens = graphene.List(Token, **token_filter_arguments())
+
+    def resolve_tokens(self, info, offset, limit=None, **filters):
+        return filtered_tokens(self.doc, self.start, self.end, offset, limit, filters)
+
+    token_table = graphene.Field(TokenTable, description="The attributes of the tokens of the span as parallel arrays.")
 
-    def resolve_tokens(self, info):
-        return list(self)
+    def resolve_token_table(self, info):
+        return TokenColumns(self.doc, self.start, self.end)
 
     root = graphene.Field(Token)
+
+    def resolve_root(self, info):
+        return span_root(self)
+
     conjuncts = graphene.List(Token)
     subtree = graphene.List(Token)
     rights = graphene.List(Token)
     lefts = graphene.List(Token)
 
+    def resolve_conjuncts(self, info):
+        return span_relatives(self, 'conjuncts')
+
+    def resolve_subtree(self, info):
+        return span_relatives(self, 'subtree')
+
+    def resolve_rights(self, info):
+        return span_relatives(self, 'rights')
+
+    def resolve_lefts(self, info):
+        return span_relatives(self, 'lefts')
+
 
 class Cat(graphene.ObjectType):
     """Categories applied to whole document (label, score), or to spans (start, end, label, score)."""
@@ -267,23 +992,31 @@ class Doc(graphene.ObjectType):
         interfaces = (Container,)
 
     id = graphene.Int(default_value=0)
-    tokens = graphene.List(Token, description="The tokens of the document.")
+    tokens = graphene.List(Token, description="The tokens of the document.", **token_filter_arguments())
 
-    def resolve_tokens(self, info):
-        return list(self)
+    def resolve_tokens(self, info, offset, limit=None, **filters):
+        return filtered_tokens(self, 0, len(self), offset, limit, filters)
+
+    token_table = graphene.Field(TokenTable, description="The attributes of the tokens of the document as parallel arrays.")
+
+    def resolve_token_table(self, info):
+        return TokenColumns(self, 0, len(self))
 
     sents = graphene.List(Span, description="""The the sentences in the document.
     Sentence spans have no label. To improve accuracy on informal texts, spaCy calculates sentence boundaries from the syntactic dependency parse.
-    If the parser is disabled, the sents iterator will be unavailable.""")
+    If the parser is disabled, the sents iterator will be unavailable.""", **page_arguments())
 
-    def resolve_sents(self, info):
-        return list(self.sents)
+    def resolve_sents(self, info, offset, limit=None):
+        selected = page(offset, limit)
+        return list(itertools.islice(self.sents, selected.start, selected.stop))
 
     ents = graphene.List(Span,
-                         description="The named entities in the document. Returns a list of named entity Span objects, if the entity recognizer has been applied.")
+                         description="The named entities in the document. Returns a list of named entity Span objects, if the entity recognizer has been applied.",
+                         label_in=graphene.List(graphene.String, description="Only the entities with one of these labels."),
+                         **page_arguments())
 
-    def resolve_ents(self, info):
-        return list(self.ents)
+    def resolve_ents(self, info, offset, limit=None, label_in=None):
+        return filtered_ents(self.ents, offset, limit, label_in)
 
     noun_chunks = graphene.List(Span,
                                 description="""The base noun phrases in the document.
@@ -298,6 +1031,13 @@ class Doc(graphene.ObjectType):
     def resolve_cats(self, info):
         return list(self.cats.items())
 
+    vector_matrix = graphene.Field(VectorMatrix, dtype=VectorDtype(default_value=VectorDtype.float32.value),
+                                   description="The vectors of all the tokens in one contiguous buffer.")
+
+    def resolve_vector_matrix(self, info, dtype):
+        matrix = doc_vectors(self)
+        return {'rows': matrix.shape[0], 'dims': matrix.shape[1], 'dtype': dtype, 'data': encode_vectors(matrix, dtype)}
+
 
 class ModelMeta(graphene.ObjectType):
     class Meta:
@@ -328,11 +1068,19 @@ class Nlp(graphene.ObjectType):
         nlp = spacy_models.get_model(self['model'], self['cfg'], 0)
         return nlp.meta
 
-    doc = graphene.Field(Doc, text=graphene.String(required=True))
+    doc = graphene.Field(Doc, text=graphene.String(required=True),
+                         chunk_size=graphene.Int(required=False, default_value=None,
+                                                 description="Split longer texts into chunks of at most that many "
+                                                             "characters processed in parallel."))
 
-    def resolve_doc(self, info, text):
+    def resolve_doc(self, info, text, chunk_size=None):
         nlp = spacy_models.get_model(self['model'], self['cfg'])
-        return nlp(text, disable=self['disable'])
+        if chunk_size is not None:
+            if chunk_size < 1:
+                raise GraphQLError('chunk_size must be positive!')
+            if len(text) > chunk_size:
+                return process_chunked_doc(nlp, self, effective_disable(nlp, info, self), text, chunk_size)
+        return process_doc(nlp, self, effective_disable(nlp, info, self), text)
 
     batch = graphene.Field(Batch, texts=graphene.List(graphene.String, required=False, default_value=None),
                          batch_id=graphene.String(required=False, default_value=None),
@@ -345,13 +1093,30 @@ class Nlp(graphene.ObjectType):
             texts = args['texts']
             batch_size = args.get('batch_size', len(texts))
             nlp = spacy_models.get_model(self['model'], self['cfg'], len(texts))
-            batch_ = BatchSlice(nlp.pipe(texts, batch_size=batch_size, disable=self['disable'], cleanup=True), len(texts))
-            batch_docs.add(batch_)
+            disable = effective_disable(nlp, info, self)
+            if isinstance(info.context, dict) and 'stream' in info.context:
+                # Streamed by GraphQLStreamApp as they are processed, no pagination.
+                # nlp.pipe runs each component on batch_size texts before yielding any of them
+                batch_size = min(batch_size or len(texts), STREAM_BATCH_SIZE)
+                info.context['stream']['docs'] = process_batch(nlp, self, disable, texts, batch_size)
+                return { 'batch_id' : None, 'docs' : [] }
+            if batch_docs.lookahead > 0:
+                # nlp.pipe runs each component on batch_size texts before yielding any of them:
+                # fed by lookahead texts at most, the producer stays about lookahead docs ahead of the client
+                batch_size = min(batch_size or len(texts), batch_docs.lookahead)
+            batch_ = BatchSlice(process_batch(nlp, self, disable, texts, batch_size), len(texts),
+                                sum(sys.getsizeof(text) for text in texts), self['model'], self['cfg'],
+                                [name for name in disable if name not in self['disable']])
+            batch_ = batch_docs.add(batch_)
         elif 'batch_id' in args:
             batch_ = batch_docs.get(args.get('batch_id'))
             if batch_:
+                check_pruned(batch_, info)
                 if not batch_.has_next():
                     batch_docs.remove(batch_)
+            elif batch_docs.dropped_reason(args.get('batch_id')):
+                raise GraphQLError('Batch %s has %s, its texts must be submitted again!' % (
+                    args.get('batch_id'), batch_docs.dropped_reason(args.get('batch_id'))))
             else:
                 raise GraphQLError('Invalid batch_id %s or batch is exhausted!'%args.get('batch_id'))
         else:
@@ -370,10 +1135,16 @@ class Nlp(graphene.ObjectType):
 class Query(graphene.ObjectType):
     nlp = graphene.Field(Nlp, model=graphene.String(required=False, default_value='en'),
                          disable=graphene.List(graphene.String, required=False, default_value=[]),
-                         cfg=graphene.String(required=False, default_value='{}'))
-
-    def resolve_nlp(self, info, model, disable, cfg):
-        return { 'model' : model, 'cfg' : cfg, 'disable' : disable }
+                         cfg=graphene.String(required=False, default_value='{}'),
+                         rules=graphene.String(required=False, default_value=None,
+                                               description="Name of a rule set of RULES_DIR for the rule_sentencizer."),
+                         prune=graphene.Boolean(required=False, default_value=True,
+                                                description="Skip the pipeline components the query does not need."))
+
+    def resolve_nlp(self, info, model, disable, cfg, prune, rules=None):
+        if rules:
+            cfg = rules_cfg(cfg, rules)
+        return { 'model' : model, 'cfg' : cfg, 'disable' : disable, 'prune' : prune }
 
 
 schema = graphene.Schema(query=Query, auto_camelcase=False)
@@ -0,0 +1,64 @@
+import numpy
+import srsly
+from spacy.attrs import DEP, ENT_IOB, ENT_TYPE, HEAD, LEMMA, POS, SENT_START, TAG
+from spacy.tokens.doc import Doc
+
+# Version of the serialized form, part of the doc cache keys so that the entries of a previous form are not read
+SERIALIZATION_VERSION = 2
+
+
+def serialize_doc(doc: Doc) -> bytes:
+    """
+    Compact binary form of a processed Doc.
+    Unlike Doc.to_bytes it keeps the sentence boundaries set after the parser (e.g. by the rule_sentencizer),
+    the categories and the strings used by the annotations, so that it can be loaded against any vocab of the same model.
+    """
+    return srsly.msgpack_dumps(doc_to_msg(doc))
+
+
+def deserialize_doc(vocab, data: bytes) -> Doc:
+    """Load a Doc serialized with serialize_doc against the given vocab."""
+    return doc_from_msg(vocab, srsly.msgpack_loads(data))
+
+
+def doc_to_msg(doc: Doc) -> dict:
+    # TAG and POS even without a tagger: the tokenizer tags the whitespace tokens with _SP and SPACE
+    attrs = [LEMMA, ENT_IOB, ENT_TYPE, TAG, POS]
+    if doc.is_parsed:
+        attrs.extend([HEAD, DEP])
+    strings = set()
+    for token in doc:
+        strings.update((token.lemma_, token.tag_, token.dep_, token.ent_type_))
+    strings.discard('')
+    msg = {
+        "words": [token.text for token in doc],
+        "spaces": [bool(token.whitespace_) for token in doc],
+        "attrs": attrs,
+        "array": doc.to_array(attrs),
+        "sent_starts": doc.to_array([SENT_START]),
+        "is_parsed": doc.is_parsed,
+        "is_tagged": doc.is_tagged,
+        "strings": sorted(strings),
+        "cats": doc.cats,
+        "sentiment": doc.sentiment,
+        "tensor": doc.tensor,
+    }
+    return msg
+
+
+def doc_from_msg(vocab, msg: dict) -> Doc:
+    for string in msg["strings"]:
+        vocab.strings.add(string)
+    doc = Doc(vocab, words=msg["words"], spaces=msg["spaces"])
+    if len(doc):
+        doc.from_array(msg["attrs"], msg["array"])
+        # from_array recomputes the sentence starts from the heads of a parsed doc, restore the serialized ones
+        doc.is_parsed = False
+        doc.from_array([SENT_START], msg["sent_starts"])
+        doc.is_parsed = msg["is_parsed"]
+        doc.is_tagged = msg["is_tagged"]
+    doc.cats = msg["cats"]
+    doc.sentiment = msg["sentiment"]
+    if msg["tensor"] is not None and msg["tensor"].size:
+        doc.tensor = numpy.asarray(msg["tensor"])
+    return doc
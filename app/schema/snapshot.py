@@ -0,0 +1,124 @@
+import hashlib
+import json
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+
+import spacy
+import srsly
+import structlog
+from spacy.tokenizer import Tokenizer
+from spacy.util import get_data_path, get_lang_class, get_model_meta, get_package_path, is_package
+
+from app.files import write_atomic
+from app.schema.cache import normalize_cfg
+
+logger = structlog.get_logger("gracyql")
+
+
+def snapshot_model(nlp):
+    """Binary form of a loaded pipeline, None if one of its components can't be rebuilt from its name."""
+    factories = type(nlp).factories
+    if any(name not in factories for name in nlp.pipe_names):
+        return None
+    return srsly.msgpack_dumps({
+        "lang": nlp.lang,
+        "meta": nlp.meta,
+        "pipe_names": nlp.pipe_names,
+        "nlp": nlp.to_bytes(),
+    })
+
+
+def restore_model(data):
+    """Rebuild a pipeline from its snapshot: the components are created empty then filled from their bytes."""
+    msg = srsly.msgpack_loads(data)
+    cls = get_lang_class(msg["lang"])
+    vocab = cls.Defaults.create_vocab()
+    # The tokenizer comes from the bytes, building the default one first would compile its special cases twice
+    nlp = cls(vocab=vocab, make_doc=Tokenizer(vocab), meta=msg["meta"])
+    for name in msg["pipe_names"]:
+        nlp.add_pipe(nlp.create_pipe(name), name=name)
+    return nlp.from_bytes(msg["nlp"])
+
+
+def model_version(model):
+    """Version of the model data a name would be loaded from by spacy.load (shortcut link, package or path), None if unknown."""
+    data_path = get_data_path()
+    paths = [data_path / model] if data_path is not None else []
+    if is_package(model):
+        paths.append(get_package_path(model))
+    paths.append(Path(model))
+    for path in paths:
+        try:
+            return get_model_meta(path)['version']
+        except (IOError, KeyError, ValueError):
+            continue
+    return None
+
+
+class ModelSnapshots:
+    """
+    Snapshots of the loaded models, kept in memory and/or in a directory shared by the workers,
+    so that reloading a model doesn't go through spacy.load and its package again.
+    The memory keeps the most recently used snapshots up to max_bytes.
+    Snapshots on disk are keyed by the spaCy and model versions that wrote them, an upgrade doesn't restore stale ones.
+    """
+    def __init__(self, memory, directory=None, max_bytes=1024 * 1024 * 1024):
+        self.memory = OrderedDict() if memory else None
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.lock = Lock()
+        self.directory = Path(directory) if directory else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key):
+        model, cfg = key
+        source = json.dumps([model, normalize_cfg(cfg), spacy.__version__, model_version(model)])
+        return self.directory / (hashlib.sha1(source.encode('utf-8')).hexdigest() + '.snapshot')
+
+    def load(self, key):
+        """The model restored from its snapshot, None if there is none."""
+        data = None
+        if self.memory is not None:
+            with self.lock:
+                data = self.memory.get(key)
+                if data is not None:
+                    self.memory.move_to_end(key)
+        if data is None and self.directory is not None:
+            try:
+                data = self.path(key).read_bytes()
+            except FileNotFoundError:
+                pass
+        if data is None:
+            return None
+        logger.info("Restore model %s from its snapshot" % key[0], cfg=key[1])
+        try:
+            return restore_model(data)
+        except Exception:
+            logger.exception("Failed to restore model %s from its snapshot" % key[0], cfg=key[1])
+            return None
+
+    def save(self, key, nlp):
+        data = snapshot_model(nlp)
+        if data is None:
+            logger.info("Model %s has components that can't be snapshotted" % key[0], cfg=key[1])
+            return
+        if self.memory is not None:
+            self.keep(key, data)
+        if self.directory is not None:
+            write_atomic(self.path(key), data)
+
+    def keep(self, key, data):
+        with self.lock:
+            previous = self.memory.pop(key, None)
+            if previous is not None:
+                self.nbytes -= len(previous)
+            if len(data) > self.max_bytes:
+                return
+            self.memory[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                evicted_key, evicted = self.memory.popitem(last=False)
+                self.nbytes -= len(evicted)
+                logger.info("Evicted the snapshot of model %s from memory" % evicted_key[0], cfg=evicted_key[1])
@@ -0,0 +1,217 @@
+import json
+import shutil
+import time
+import uuid
+from pathlib import Path
+from threading import Thread
+
+import structlog
+from graphql import GraphQLError
+
+from app.files import file_lock, write_atomic
+from app.metrics import BATCHES_DROPPED, OPEN_BATCHES, OPEN_BATCHES_BYTES
+from app.schema.serialization import deserialize_doc, serialize_doc
+
+logger = structlog.get_logger("gracyql")
+
+# A producer not updating its heartbeat for that long is considered gone (e.g. its worker was recycled)
+PRODUCER_TIMEOUT = 30
+POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.1
+# Suffix of the tombstone of a dropped batch, the file holds the reason
+TOMBSTONE = '.dropped'
+
+
+class SpoolBatch:
+    """
+    A batch whose documents are produced into a spool directory shared by all the workers of a host.
+    Any worker can read its pages: the read cursor is kept in the directory and updated under a file lock.
+    """
+    def __init__(self, path: Path, models):
+        self.path = path
+        self.models = models
+        meta = json.loads((path / 'meta.json').read_text())
+        self.uuid_ = uuid.UUID(path.name)
+        self.model = meta['model']
+        self.cfg = meta['cfg']
+        self.max = meta['max']
+        self.nbytes = meta.get('nbytes', 0)
+        self.pruned = meta.get('pruned', [])
+
+    def locked(self):
+        return file_lock(self.path / 'lock')
+
+    def cursor(self):
+        return int((self.path / 'cursor').read_text())
+
+    def next(self, next):
+        with self.locked():
+            start = self.cursor()
+            end = min(start + next, self.max)
+            write_atomic(self.path / 'cursor', str(end).encode())
+        nlp = self.models.get_model(self.model, self.cfg, 0)
+        return [deserialize_doc(nlp.vocab, self.wait_for(i)) for i in range(start, end)]
+
+    def wait_for(self, i):
+        doc_path = self.path / ('%d.doc' % i)
+        interval = POLL_INTERVAL
+        while True:
+            try:
+                data = doc_path.read_bytes()
+                doc_path.unlink()
+                return data
+            except FileNotFoundError:
+                pass
+            error_path = self.path / 'error'
+            if error_path.exists():
+                raise GraphQLError('Batch %s failed: %s' % (self.uuid_, error_path.read_text()))
+            if time.time() - (self.path / 'heartbeat').stat().st_mtime > PRODUCER_TIMEOUT:
+                raise GraphQLError('Batch %s is no longer processed, its texts must be submitted again!' % self.uuid_)
+            time.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    def has_next(self):
+        try:
+            return self.cursor() < self.max
+        except FileNotFoundError:
+            return False
+
+    def remaining_bytes(self):
+        # Same estimate as BatchSlice: the texts still to be read are held by the producer
+        return self.nbytes * max(self.max - self.cursor(), 0) // max(self.max, 1)
+
+
+class SpoolBatchDocs:
+    """
+    Batch store backed by a spool directory, so that batch pages can be served by any worker of the host.
+    The worker receiving the texts runs a producer thread that writes the serialized documents
+    up to lookahead documents ahead of the read cursor.
+    Batches not read for ttl seconds expire, and the least recently read ones are evicted when the host has more than
+    max_batches of them or when the estimated memory of their texts exceeds max_bytes, which also bounds the producers.
+    The directory is the state shared by the workers, a tombstone is kept for ttl seconds to report a dropped batch.
+    """
+    def __init__(self, root, models, ttl, lookahead, max_batches=100, max_bytes=512 * 1024 * 1024):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.models = models
+        self.ttl = ttl
+        self.lookahead = lookahead
+        self.max_batches = max_batches
+        self.max_bytes = max_bytes
+
+    def batch_path(self, uuid_):
+        if isinstance(uuid_, str):
+            uuid_ = uuid.UUID(uuid_)
+        return self.root / str(uuid_)
+
+    def get(self, uuid_):
+        self.expire()
+        path = self.batch_path(uuid_)
+        try:
+            return SpoolBatch(path, self.models)
+        except FileNotFoundError:
+            return None
+
+    def dropped_reason(self, uuid_):
+        path = self.batch_path(uuid_)
+        try:
+            return path.with_name(path.name + TOMBSTONE).read_text()
+        except FileNotFoundError:
+            return None
+
+    def add(self, batch):
+        self.expire()
+        path = self.batch_path(batch.uuid_)
+        path.mkdir()
+        (path / 'heartbeat').touch()
+        write_atomic(path / 'cursor', b'0')
+        write_atomic(path / 'meta.json', json.dumps({'model': batch.model, 'cfg': batch.cfg, 'max': batch.max,
+                                                     'nbytes': batch.nbytes, 'pruned': batch.pruned}).encode())
+        self.evict()
+        Thread(target=self.produce, args=(path, batch), name="spool-%s" % batch.uuid_, daemon=True).start()
+        return SpoolBatch(path, self.models)
+
+    def remove(self, batch):
+        shutil.rmtree(str(batch.path), ignore_errors=True)
+
+    def produce(self, path: Path, batch):
+        try:
+            reader = SpoolBatch(path, self.models)
+            for i, doc in enumerate(batch.gen):
+                # Backpressure: wait for the client to catch up
+                while i >= reader.cursor() + self.lookahead:
+                    (path / 'heartbeat').touch()
+                    time.sleep(MAX_POLL_INTERVAL)
+                write_atomic(path / ('%d.doc' % i), serialize_doc(doc))
+                (path / 'heartbeat').touch()
+        except FileNotFoundError:
+            # The batch has been removed or has expired
+            logger.info("Batch %s removed, stopping its producer" % batch.uuid_)
+        except Exception as e:
+            logger.exception("Failed to produce batch %s" % batch.uuid_)
+            try:
+                write_atomic(path / 'error', str(e).encode())
+            except FileNotFoundError:
+                pass
+        finally:
+            batch.gen.close()
+
+    def expire(self):
+        now = time.time()
+        for path in self.root.iterdir():
+            try:
+                if path.name.endswith(TOMBSTONE):
+                    if now - path.stat().st_mtime > self.ttl:
+                        path.unlink()
+                elif path.is_dir() and now - (path / 'cursor').stat().st_mtime > self.ttl:
+                    self.drop(path, 'expired')
+            except FileNotFoundError:
+                # Concurrently removed by another worker
+                pass
+        self.update_metrics(self.open_batches())
+
+    def open_batches(self):
+        """The batches of the directory, least recently read first."""
+        batches = []
+        for path in self.root.iterdir():
+            if path.is_dir():
+                try:
+                    batches.append((path.joinpath('cursor').stat().st_mtime, SpoolBatch(path, self.models)))
+                except FileNotFoundError:
+                    # Being created or removed by another worker
+                    pass
+        return [batch for last_access, batch in sorted(batches, key=lambda entry: entry[0])]
+
+    def evict(self):
+        # Under a lock of the directory, the workers adding batches at the same time evict them once
+        with file_lock(self.root / 'lock'):
+            batches = self.open_batches()
+            sizes = {}
+            for batch in batches:
+                try:
+                    sizes[batch.uuid_] = batch.remaining_bytes()
+                except FileNotFoundError:
+                    sizes[batch.uuid_] = 0
+            # The last one is the batch being added
+            while len(batches) > 1 and (len(batches) > self.max_batches or sum(sizes.values()) > self.max_bytes):
+                batch = batches.pop(0)
+                del sizes[batch.uuid_]
+                self.drop(batch.path, 'evicted')
+        self.update_metrics(batches)
+
+    def drop(self, path: Path, reason):
+        # The producer of the batch, in any worker, stops once its directory is gone
+        write_atomic(path.with_name(path.name + TOMBSTONE), reason.encode())
+        shutil.rmtree(str(path), ignore_errors=True)
+        BATCHES_DROPPED.labels(reason=reason).inc()
+        logger.info("Batch %s %s" % (path.name, reason))
+
+    def update_metrics(self, batches):
+        remaining = 0
+        for batch in batches:
+            try:
+                remaining += batch.remaining_bytes()
+            except FileNotFoundError:
+                pass
+        OPEN_BATCHES.set(len(batches))
+        OPEN_BATCHES_BYTES.set(remaining)
@@ -0,0 +1,168 @@
+import numpy
+from spacy.attrs import DEP, HEAD, IS_PUNCT, IS_SPACE
+from spacy.symbols import conj
+
+from app.schema.columns import doc_column
+
+# Key of the dependency tree index cached in Doc.user_data, shared by all the tokens and spans of a doc
+TREE_KEY = ('gracyql', 'tree')
+
+
+class DocTree:
+    """
+    Index of the dependency tree of a doc, built once in linear time from its HEAD column.
+    The children of the tokens are one array sorted by head then position with the offsets of each head (CSR),
+    and the subtree of each token is a slice of one in-order traversal of the doc
+    (subtrees of the left children, the token, subtrees of the right children: the order of Token.subtree).
+    """
+    def __init__(self, doc):
+        n = len(doc)
+        positions = numpy.arange(n)
+        heads = positions + doc_column(doc, HEAD).view('int64')
+        is_child = heads != positions
+        children = positions[is_child]
+        parents = heads[is_child]
+        self.heads = heads.tolist()
+        self.children = children[numpy.argsort(parents, kind='stable')].tolist()
+        self.offsets = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(parents, minlength=n))]).tolist()
+        self.n_lefts = numpy.bincount(parents[children < parents], minlength=n).tolist()
+        self.order = []
+        self.starts = [0] * n
+        self.ends = [0] * n
+        # Number of heads up to the root of each token
+        self.depths = [0] * n
+        for root in positions[~is_child].tolist():
+            self.traverse(root)
+        if len(self.order) != n:
+            raise ValueError("The heads of the doc have a cycle")
+
+    def traverse(self, root):
+        # Iterative in-order traversal, a token is expanded (-1), emitted (-2) then closed (-3)
+        order, starts, ends, depths = self.order, self.starts, self.ends, self.depths
+        offsets, n_lefts, children = self.offsets, self.n_lefts, self.children
+        stack = [(root, -1)]
+        while stack:
+            token, step = stack.pop()
+            if step == -2:
+                order.append(token)
+            elif step == -3:
+                ends[token] = len(order)
+            else:
+                starts[token] = len(order)
+                middle = offsets[token] + n_lefts[token]
+                depth = depths[token] + 1
+                stack.append((token, -3))
+                for child in reversed(children[middle:offsets[token + 1]]):
+                    depths[child] = depth
+                    stack.append((child, -1))
+                stack.append((token, -2))
+                for child in reversed(children[offsets[token]:middle]):
+                    depths[child] = depth
+                    stack.append((child, -1))
+
+    def children_of(self, i):
+        return self.children[self.offsets[i]:self.offsets[i + 1]]
+
+    def lefts_of(self, i):
+        return self.children[self.offsets[i]:self.offsets[i] + self.n_lefts[i]]
+
+    def rights_of(self, i):
+        return self.children[self.offsets[i] + self.n_lefts[i]:self.offsets[i + 1]]
+
+    def subtree_of(self, i):
+        return self.order[self.starts[i]:self.ends[i]]
+
+    def ancestors_of(self, i):
+        heads = self.heads
+        ancestors = []
+        while heads[i] != i:
+            i = heads[i]
+            ancestors.append(i)
+        return ancestors
+
+    def conjuncts_of(self, i, deps):
+        # Same walk as Token.conjuncts: up to the first token of the coordination, then down its conj right children
+        start = i
+        while self.heads[start] != start and deps[start] == conj:
+            start = self.heads[start]
+        output = [start]
+        for word in output:
+            output.extend(child for child in self.rights_of(word) if deps[child] == conj)
+        return [word for word in output if word != i]
+
+    def span_root(self, start, end, weak):
+        # Same choice as Span.root: a sentence root of the span, else the first of the tokens closest to a root,
+        # the weak tokens (spaces and punctuations) without children coming last
+        root = -1
+        best = n = len(self.heads)
+        for i in range(start, end):
+            head = self.heads[i]
+            if head == i:
+                return i
+            if start <= head < end:
+                continue
+            distance = n - 1 if weak[i] and self.offsets[i] == self.offsets[i + 1] else self.depths[i]
+            if distance < best:
+                root, best = i, distance
+        return start if root == -1 else root
+
+    def span_lefts(self, start, end):
+        # Same order as Span.lefts: the tokens of the span from right to left
+        return [left for i in range(end - 1, start - 1, -1) for left in self.lefts_of(i) if left < start]
+
+    def span_rights(self, start, end):
+        return [right for i in range(start, end) for right in self.rights_of(i) if right >= end]
+
+    def span_subtree(self, start, end):
+        subtree = [token for left in self.span_lefts(start, end) for token in self.subtree_of(left)]
+        subtree.extend(range(start, end))
+        subtree.extend(token for right in self.span_rights(start, end) for token in self.subtree_of(right))
+        return subtree
+
+
+def doc_tree(doc):
+    """The DocTree of a doc, built on first use and cached in Doc.user_data, None if it can't be indexed."""
+    if TREE_KEY not in doc.user_data:
+        try:
+            doc.user_data[TREE_KEY] = DocTree(doc)
+        except ValueError:
+            doc.user_data[TREE_KEY] = None
+    return doc.user_data[TREE_KEY]
+
+
+def weak_tokens(doc):
+    return doc_column(doc, IS_SPACE) | doc_column(doc, IS_PUNCT)
+
+
+def token_relatives(token, name):
+    """
+    The tokens related to a token by its children, lefts, rights, subtree, ancestors or conjuncts attribute,
+    taken from the DocTree of its doc instead of walking the tree for each token.
+    """
+    doc = token.doc
+    tree = doc_tree(doc)
+    if tree is None or name in doc.user_token_hooks:
+        return list(getattr(token, name))
+    if name == 'conjuncts':
+        return [doc[i] for i in tree.conjuncts_of(token.i, doc_column(doc, DEP))]
+    return [doc[i] for i in getattr(tree, name + '_of')(token.i)]
+
+
+def span_root(span):
+    doc = span.doc
+    tree = doc_tree(doc)
+    if tree is None or 'root' in doc.user_span_hooks:
+        return span.root
+    return doc[tree.span_root(span.start, span.end, weak_tokens(doc))]
+
+
+def span_relatives(span, name):
+    """The tokens related to a span by its lefts, rights, subtree or conjuncts attribute, from the DocTree of its doc."""
+    doc = span.doc
+    tree = doc_tree(doc)
+    if tree is None or 'root' in doc.user_span_hooks or 'conjuncts' in doc.user_token_hooks:
+        return list(getattr(span, name))
+    if name == 'conjuncts':
+        root = tree.span_root(span.start, span.end, weak_tokens(doc))
+        return [doc[i] for i in tree.conjuncts_of(root, doc_column(doc, DEP))]
+    return [doc[i] for i in getattr(tree, 'span_' + name)(span.start, span.end)]
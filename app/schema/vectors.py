@@ -0,0 +1,32 @@
+import base64
+
+import numpy
+from spacy.attrs import ORTH
+
+from app.schema.columns import doc_column
+
+
+def encode_vectors(vectors, dtype):
+    """Base64 of the raw little-endian buffer of a vector or a matrix, converted to the given numpy dtype."""
+    return base64.b64encode(numpy.ascontiguousarray(vectors, dtype=dtype).tobytes()).decode('ascii')
+
+
+def doc_vectors(doc):
+    """
+    The vectors of all the tokens of a doc as one (tokens, dims) matrix, the same values as Token.vector.
+    Rows are gathered in one go from the vocab vectors, or taken from the doc.tensor without static vectors.
+    """
+    if 'vector' in doc.user_token_hooks:
+        return numpy.asarray([token.vector for token in doc], dtype='f')
+    vectors = doc.vocab.vectors
+    if not vectors.size:
+        if doc.tensor.size:
+            return doc.tensor
+        return numpy.zeros((len(doc), 0), dtype='f')
+    orths = doc_column(doc, ORTH).tolist()
+    rows = numpy.asarray(vectors.find(keys=orths))
+    matrix = vectors.data[rows]
+    # Unknown words, the vocab may still compute their vector (e.g. from subwords)
+    for i in numpy.where(rows < 0)[0].tolist():
+        matrix[i] = doc.vocab.get_vector(orths[i])
+    return matrix
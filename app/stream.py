@@ -0,0 +1,152 @@
+import json
+
+import graphene
+from graphql import format_error, get_operation_ast, parse, validate
+from graphql.error import GraphQLError
+from graphql.execution import execute
+from graphql.language.ast import Document, Field, OperationDefinition
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.schema.schema import Doc
+
+# Path of the documents in the queries that can be streamed
+DOCS_PATH = ('nlp', 'batch', 'docs')
+
+
+def find_field(selection_set, name):
+    for selection in selection_set.selections:
+        if isinstance(selection, Field) and selection.name.value == name:
+            return selection
+    return None
+
+
+class StreamingGZipMiddleware(GZipMiddleware):
+    """
+    Gzip the responses except the ones of the streaming paths: the GzipFile of the Starlette middleware is only
+    flushed at the end of a streamed response, so the documents would not reach the client one by one.
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, stream_paths=("/stream",)) -> None:
+        super().__init__(app, minimum_size)
+        self.stream_paths = stream_paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"] in self.stream_paths:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+class GraphQLStreamApp:
+    """
+    Streams the result of a nlp { batch(texts: ...) { docs { ... } } } query, writing each document
+    as soon as nlp.pipe yields it, as NDJSON lines or Server-Sent Events if the client accepts text/event-stream.
+    The query is parsed and validated once, or taken from the query documents of the app when given,
+    then the docs selection set is executed against each document.
+    Documents are only processed when the client is ready to receive them, so the server memory stays constant.
+    """
+    def __init__(self, schema: graphene.Schema, documents=None):
+        self.schema = schema
+        self.documents = documents
+        # Executes a docs selection set with a Doc as root value
+        self.doc_schema = graphene.Schema(query=Doc, auto_camelcase=False)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        request = Request(scope, receive=receive)
+        response = await self.handle_stream(request)
+        await response(scope, receive, send)
+
+    async def handle_stream(self, request: Request):
+        if request.method != "POST":
+            return PlainTextResponse("Method Not Allowed", status_code=status.HTTP_405_METHOD_NOT_ALLOWED)
+        content_type = request.headers.get("Content-Type", "")
+        if "application/json" in content_type:
+            data = await request.json()
+        elif "application/graphql" in content_type:
+            body = await request.body()
+            data = {"query": body.decode()}
+        else:
+            return PlainTextResponse("Unsupported Media Type", status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        hash_ = ((data.get("extensions") or {}).get("persistedQuery") or {}).get("sha256Hash")
+        if "query" not in data and not (hash_ and self.documents is not None):
+            return PlainTextResponse("No GraphQL query found in the request", status_code=status.HTTP_400_BAD_REQUEST)
+        variables = data.get("variables")
+        operation_name = data.get("operationName")
+
+        if self.documents is not None:
+            query_document, errors = self.documents.get(data.get("query"), hash_)
+            document = query_document.document if query_document is not None else None
+        else:
+            try:
+                document = parse(data["query"])
+            except GraphQLError as e:
+                return self.error_response([e])
+            errors = validate(self.schema, document)
+        if errors:
+            return self.error_response(errors)
+        doc_document = self.docs_document(document, operation_name)
+        if doc_document is None:
+            return self.error_response([GraphQLError("Only nlp { batch(texts: ...) { docs { ... } } } queries can be streamed")])
+
+        context = {"request": request, "stream": {}}
+        result = await run_in_threadpool(execute, self.schema, document, context_value=context,
+                                         variable_values=variables, operation_name=operation_name)
+        if result.errors:
+            return self.error_response(result.errors)
+        docs = context["stream"].get("docs")
+        if docs is None:
+            return self.error_response([GraphQLError("Only batches of texts can be streamed")])
+
+        sse = "text/event-stream" in request.headers.get("Accept", "")
+        return StreamingResponse(self.stream(docs, doc_document, variables, sse),
+                                 media_type="text/event-stream" if sse else "application/x-ndjson")
+
+    def docs_document(self, document, operation_name):
+        """Build a document whose operation is the docs selection set of the query, with the same fragments."""
+        operation = get_operation_ast(document, operation_name)
+        if operation is None or operation.operation != 'query':
+            return None
+        field = operation
+        for name in DOCS_PATH:
+            field = find_field(field.selection_set, name)
+            if field is None or field.selection_set is None:
+                return None
+        fragments = [definition for definition in document.definitions if not isinstance(definition, OperationDefinition)]
+        return Document(definitions=[OperationDefinition(operation='query', selection_set=field.selection_set,
+                                                         variable_definitions=operation.variable_definitions)]
+                                    + fragments)
+
+    def next_result(self, docs, doc_document, variables):
+        doc = next(docs, None)
+        if doc is None:
+            return None
+        return execute(self.doc_schema, doc_document, root_value=doc, variable_values=variables)
+
+    async def stream(self, docs, doc_document, variables, sse):
+        docs = iter(docs)
+        i = 0
+        try:
+            while True:
+                # Pulled one at a time: no document is processed before the previous one has been sent
+                result = await run_in_threadpool(self.next_result, docs, doc_document, variables)
+                if result is None:
+                    break
+                payload = {"id": i, "data": result.data}
+                if result.errors:
+                    payload["errors"] = [format_error(error) for error in result.errors]
+                line = json.dumps(payload)
+                yield ("event: doc\ndata: %s\n\n" % line) if sse else (line + "\n")
+                i += 1
+            if sse:
+                yield "event: end\ndata: {}\n\n"
+        finally:
+            if hasattr(docs, 'close'):
+                docs.close()
+
+    def error_response(self, errors):
+        return JSONResponse({"data": None, "errors": [format_error(error) for error in errors]},
+                            status_code=status.HTTP_400_BAD_REQUEST)
@@ -1,38 +1,78 @@
+import multiprocessing
 import random
-import spacy
-import plac
-import psutil
 import sys
+import time
 
-def load_data():
-    return ["This is a fake test document number %d."%i for i in random.sample(range(10_000), 1_000)]
-
+import plac
 
-class ReloadableNlp:
-    def __init__(self, model, reload=1000):
-        self.nlp = spacy.load(model)
+from app.memory import rss_bytes
 
-    def get_nlp(self):
-        return self.nlp
 
+def load_data(n=1_000, vocab=1_000_000):
+    # Unseen numbers and words keep adding strings to the StringStore, as real traffic does
+    return ["This is a fake test document number %d about ref%d." % (i, random.randrange(vocab))
+            for i in random.sample(range(10_000), n)]
 
 
-def parse_texts(reloadable, texts, iterations=10_000):
+def parse_texts(models, model, texts, iterations=10_000):
     for i in range(iterations):
-        for doc in reloadable.get_nlp().pipe(texts):
+        # Looked up before each batch, as the resolvers do on each request
+        nlp = models.get_model(model, '{}', len(texts))
+        for doc in nlp.pipe(texts):
             yield doc
 
+
+def soak(policy, model, iterations, report):
+    """Run the soak loop with a reload policy and report its throughput and memory."""
+    from app.schema.reload import parse_reload_policy
+    from app.schema.schema import SpacyModels
+
+    models = SpacyModels(reload=parse_reload_policy(policy))
+    reloaded = []
+    schedule_reload = models.schedule_reload
+
+    def count_reload(key, entry, reason):
+        reloaded.append(reason)
+        schedule_reload(key, entry, reason)
+    models.schedule_reload = count_reload
+
+    models.get_model(model, '{}', 0)
+    start_rss = peak_rss = rss_bytes()
+    start = time.time()
+    count = 0
+    for iteration in range(iterations):
+        for doc in parse_texts(models, model, load_data(), iterations=1):
+            count += 1
+        peak_rss = max(peak_rss, rss_bytes())
+        if iteration % 10 == 0:
+            print("%-40s %6d docs %8.1f MB" % (policy, count, rss_bytes() / 1024 / 1024))
+            sys.stdout.flush()
+    elapsed = time.time() - start
+    report.put({'policy': policy, 'docs/s': count / elapsed, 'reloads': len(reloaded),
+                'start MB': start_rss / 1024 / 1024, 'peak MB': peak_rss / 1024 / 1024,
+                'end MB': rss_bytes() / 1024 / 1024})
+
+
 @plac.annotations(
-    iterations=("Number of iterations", "option", "n", int),
-    model=("spaCy model to load", "positional", None, str)
+    iterations=("Number of iterations of 1000 documents per policy", "option", "n", int),
+    model=("spaCy model to load", "positional", None, str),
+    policies=("Reload policies to compare, as in RELOAD_POLICY", "positional", None, str)
 )
-def main(model='en_core_web_sm', iterations=10_000):
-    texts = load_data()
-    reloadable = ReloadableNlp(model)
-    for i, doc in enumerate(parse_texts(reloadable, texts, iterations=iterations)):
-        if i % 10_000 == 0:
-            print(i, psutil.virtual_memory().percent)
-            sys.stdout.flush()
+def main(model='en_core_web_sm', iterations=100, *policies):
+    """Compare the throughput and memory of reload policies, each one in a fresh process."""
+    policies = policies or ('none', 'count:1000', 'strings:100000', 'rss:268435456', 'age:60')
+    context = multiprocessing.get_context('spawn')
+    report = context.Queue()
+    results = []
+    for policy in policies:
+        process = context.Process(target=soak, args=(policy, model, iterations, report))
+        process.start()
+        results.append(report.get())
+        process.join()
+    columns = ['policy', 'docs/s', 'reloads', 'start MB', 'peak MB', 'end MB']
+    print("".join("%-40s" % c if c == 'policy' else "%10s" % c for c in columns))
+    for result in results:
+        print("".join("%-40s" % result[c] if c == 'policy' else "%10.1f" % result[c] for c in columns))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,47 @@
+import time
+from functools import partial
+
+import plac
+
+from app.schema import schema
+from app.schema.pool import NlpPool
+from app.schema.reload import parse_reload_policy
+from app.tests.bench import load_data
+
+
+def timed(setup, nlp, nlp_args, texts, batch_size):
+    start = time.time()
+    count = sum(1 for doc in schema.process_batch(nlp, nlp_args, [], texts, batch_size))
+    elapsed = time.time() - start
+    print("%-20s %10.3f %10.1f" % (setup, elapsed, count / elapsed))
+
+
+@plac.annotations(
+    texts=("Number of texts of the batch", "option", "n", int),
+    batch_size=("batch_size of the request", "option", "b", int),
+    model=("spaCy model to load", "positional", None, str),
+    processes=("Numbers of processes to compare", "positional", None, int)
+)
+def main(model='en_core_web_sm', texts=10_000, batch_size=1000, *processes):
+    """Compare the throughput of a large batch in the web process and spread over pools of processes."""
+    nlp_args = {'model': model, 'cfg': '{}'}
+    nlp = schema.spacy_models.get_model(model, '{}', 0)
+    data = load_data(min(texts, 10_000))
+    data = (data * (texts // len(data) + 1))[:texts]
+    print("%-20s %10s %10s" % ("setup", "seconds", "docs/s"))
+    timed("in-process", nlp, nlp_args, data, batch_size)
+    for n in [int(n) for n in processes] or [1, 2, 4]:
+        pool = NlpPool(n, partial(schema.SpacyModels, reload=parse_reload_policy("none")), [(model, '{}')])
+        try:
+            # Started and warmed up before being timed
+            for future in [pool.submit(model, '{}', [], ["Warm up"]) for i in range(n)]:
+                future.result()
+            schema.nlp_pool = pool
+            timed("%d processes" % n, nlp, nlp_args, data, batch_size)
+        finally:
+            schema.nlp_pool = None
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    plac.call(main)
@@ -0,0 +1,59 @@
+import random
+import time
+from functools import partial
+
+import plac
+
+from app.memory import rss_bytes
+from app.schema import schema
+from app.schema.pool import NlpPool
+from app.tests.bench_sentencizer import random_text
+
+
+def long_text(n_chars, seed=0):
+    random.seed(seed)
+    paragraphs = []
+    size = 0
+    while size < n_chars:
+        paragraph = random_text(random.randrange(50, 300), seed=random.randrange(1 << 30))
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:n_chars]
+
+
+def timed(setup, fn):
+    start_rss = rss_bytes()
+    start = time.time()
+    doc = fn()
+    print("%-25s %10.3f %10d %10.1f" % (setup, time.time() - start, len(doc), (rss_bytes() - start_rss) / 1024 / 1024))
+    return doc
+
+
+@plac.annotations(
+    chars=("Number of characters of the text", "option", "c", int),
+    chunk_size=("Maximum number of characters per chunk", "option", "s", int),
+    processes=("Number of processes of the pool", "option", "p", int),
+    model=("spaCy model to load", "positional", None, str)
+)
+def main(model='en_core_web_sm', chars=500_000, chunk_size=20_000, processes=4):
+    """Compare the time to annotate a long text in one go, by chunks in-process and by chunks in a process pool."""
+    text = long_text(chars)
+    nlp_args = {'model': model, 'cfg': '{}'}
+    nlp = schema.spacy_models.get_model(model, '{}', 0)
+    print("%-25s %10s %10s %10s" % ("setup", "seconds", "tokens", "RSS +MB"))
+    if len(text) <= nlp.max_length:
+        timed("whole text", lambda: nlp(text))
+    timed("chunks", lambda: schema.process_chunked_doc(nlp, nlp_args, [], text, chunk_size))
+    pool = NlpPool(processes, partial(schema.SpacyModels, reload=1000), [(model, '{}')])
+    try:
+        # Started and warmed up before being timed
+        pool.submit(model, '{}', [], ["Warm up"]).result()
+        schema.nlp_pool = pool
+        timed("chunks, %d processes" % processes, lambda: schema.process_chunked_doc(nlp, nlp_args, [], text, chunk_size))
+    finally:
+        schema.nlp_pool = None
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    plac.call(main)
@@ -0,0 +1,54 @@
+import time
+
+import plac
+from graphql import parse
+from graphql.execution import execute
+
+from app.compiler import doc_schema, SelectionCompiler
+from app.schema import schema
+from app.tests.bench import load_data
+
+# Selection set of the docs of a batch query
+DOC_QUERY = """{
+  text
+  tokens { id text lemma pos tag dep head { id } }
+  ents { text label start end }
+}"""
+
+
+def best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+@plac.annotations(
+    texts=("Number of texts", "option", "n", int),
+    repeat=("Number of runs, the best one is reported", "option", "r", int),
+    model=("spaCy model to load", "positional", None, str)
+)
+def main(model='en_core_web_sm', texts=1000, repeat=5):
+    """Compare the cost per token of the serialization of Docs by the graphene executor and by a compiled serializer."""
+    nlp = schema.spacy_models.get_model(model, '{}', 0)
+    nlp_time, docs = best_time(lambda: list(nlp.pipe(load_data(texts))), 1)
+    n_tokens = sum(len(doc) for doc in docs)
+    document = parse(DOC_QUERY)
+    serialize = SelectionCompiler(doc_schema, {}).compile_object(doc_schema.get_query_type(),
+                                                                 [document.definitions[0].selection_set])
+    print("%d docs, %d tokens" % (len(docs), n_tokens))
+    print("%-10s %10s %10s" % ("setup", "seconds", "µs/token"))
+    print("%-10s %10.3f %10.2f" % ("nlp", nlp_time, nlp_time / n_tokens * 1e6))
+    graphene_time, expected = best_time(lambda: [execute(doc_schema, document, root_value=doc).data for doc in docs],
+                                        repeat)
+    print("%-10s %10.3f %10.2f" % ("graphene", graphene_time, graphene_time / n_tokens * 1e6))
+    compiled_time, result = best_time(lambda: [serialize(doc) for doc in docs], repeat)
+    print("%-10s %10.3f %10.2f" % ("compiled", compiled_time, compiled_time / n_tokens * 1e6))
+    assert result == expected
+
+
+if __name__ == '__main__':
+    plac.call(main)
@@ -0,0 +1,41 @@
+import tempfile
+import time
+
+import plac
+
+from app.schema import schema
+
+
+def timed_loads(model, cfg, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        schema.load_model(model, cfg)
+        timings.append(time.time() - start)
+    return timings
+
+
+@plac.annotations(
+    repeat=("Number of loads per setup", "option", "n", int),
+    cfg=("JSON cfg of the model", "option", "c", str),
+    model=("spaCy model to load", "positional", None, str)
+)
+def main(model='en_core_web_sm', repeat=5, cfg='{}'):
+    """Compare the time to (re)load a model with spacy.load and from its snapshot in memory or on disk."""
+    with tempfile.TemporaryDirectory() as directory:
+        setups = [
+            ("spacy.load", None),
+            ("memory snapshot", schema.ModelSnapshots(True)),
+            ("disk snapshot", schema.ModelSnapshots(False, directory)),
+        ]
+        print("%-20s %10s %10s %10s" % ("setup", "first", "min", "mean"))
+        for name, snapshots in setups:
+            schema.model_snapshots = snapshots
+            # The first load takes the snapshot, the next ones are reloads
+            first = timed_loads(model, cfg, 1)[0]
+            timings = timed_loads(model, cfg, repeat)
+            print("%-20s %10.3f %10.3f %10.3f" % (name, first, min(timings), sum(timings) / len(timings)))
+
+
+if __name__ == '__main__':
+    plac.call(main)
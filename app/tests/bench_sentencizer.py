@@ -0,0 +1,88 @@
+import random
+import sys
+import time
+
+import plac
+import spacy
+import yaml
+
+from app.pipeline.RuleSentencizer import RuleSentencizer
+
+
+class TokenRuleSentencizer(RuleSentencizer):
+    """Always sets the boundaries token by token."""
+    array_min_tokens = sys.maxsize
+
+
+class ArrayRuleSentencizer(RuleSentencizer):
+    """Always computes the boundaries on arrays."""
+    array_min_tokens = 0
+
+
+class TimedMatcher:
+    """Measures the time spent in a matcher, the same for both implementations."""
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.elapsed = 0
+
+    def __len__(self):
+        return len(self.matcher)
+
+    def __call__(self, doc):
+        start = time.time()
+        matches = self.matcher(doc)
+        self.elapsed += time.time() - start
+        return matches
+
+
+WORDS = ["MM", ".", "Sarkozy", "a", "dit", "Pr", "Hollande", "!", "?", "100", "000", "Frs", "\n\n", " ", "\n \n",
+         "Av", "de", "la", "Grande", "Armée", "Mais", "je", "veux", "croire", ",", "3"]
+
+
+def random_text(n_words, seed=0):
+    rnd = random.Random(seed)
+    return " ".join(rnd.choice(WORDS) for i in range(n_words))
+
+
+def sent_starts(doc):
+    return [token.is_sent_start for token in doc], doc.is_parsed
+
+
+@plac.annotations(
+    model=("spaCy model or language to use, blank if it starts with blank:", "option", "m", str),
+    words=("Number of words per document", "option", "w", int),
+    docs=("Number of documents", "option", "n", int),
+    rules=("YAML file of rules", "option", "r", str),
+    batch_size=("Batch size of the pipe", "option", "b", int)
+)
+def main(model="blank:fr", words=5000, docs=20, rules="app/pipeline/example.yaml", batch_size=1000):
+    """Check that both implementations set the same boundaries and compare their speed with the default threshold."""
+    nlp = spacy.blank(model[len("blank:"):]) if model.startswith("blank:") else spacy.load(model)
+    with open(rules) as rules_file:
+        cfg = yaml.safe_load(rules_file)
+    texts = [random_text(words, seed) for seed in range(docs)]
+    timings = {}
+    results = {}
+    components = [(type(component).__name__, component, False)
+                  for component in (TokenRuleSentencizer(nlp, **cfg), ArrayRuleSentencizer(nlp, **cfg),
+                                    RuleSentencizer(nlp, **cfg))]
+    components.append(("RuleSentencizer.pipe", RuleSentencizer(nlp, **cfg), True))
+    for name, component, pipe in components:
+        matchers = [TimedMatcher(m) if m else None for m in (component.split_matcher, component.join_matcher)]
+        component.split_matcher, component.join_matcher = matchers
+        docs_ = list(nlp.pipe(texts))
+        start = time.time()
+        docs_ = list(component.pipe(docs_, batch_size=batch_size)) if pipe else [component(doc) for doc in docs_]
+        total = time.time() - start
+        matching = sum(m.elapsed for m in matchers if m)
+        timings[name] = (total, matching, total - matching)
+        results[name] = [sent_starts(doc) for doc in docs_]
+    for name in results:
+        assert results[name] == results["TokenRuleSentencizer"], "Different sentence boundaries for %s" % name
+    print("%-25s %10s %10s %10s" % ("implementation", "total", "matching", "boundaries"))
+    for name, timing in timings.items():
+        print("%-25s %9.3fs %9.3fs %9.3fs" % ((name,) + timing))
+
+
+if __name__ == '__main__':
+    plac.call(main)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import random
 from string import Template
@@ -171,4 +172,67 @@ def batchQuery(docsClause: str,
 
 # def test_leak():
 #     for i in range(100_000):
-#         test_bulk_tag()
\ No newline at end of file
+#         test_bulk_tag()
+
+
+def test_stream():
+    texts = ["This is test number %d." % i for i in range(5)]
+    query = """query StreamQuery {
+              nlp(model: "en") {
+                batch(texts: %s) {
+                    docs {
+                        text
+                        tokens {
+                            id
+                            pos
+                        }
+                    }
+                }
+              }
+            }""" % json.dumps(texts)
+    response = client.post('/stream', query, headers={"Content-Type": "application/graphql"})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["id"] for line in lines] == list(range(5))
+    assert [line["data"]["text"] for line in lines] == texts
+    assert len(lines[0]["data"]["tokens"]) == 6
+
+    response = client.post('/stream', query, headers={"Content-Type": "application/graphql",
+                                                      "Accept": "text/event-stream"})
+    events = [event for event in response.text.split("\n\n") if event]
+    assert len(events) == 6
+    assert events[0].startswith("event: doc\ndata: ")
+    assert events[-1] == "event: end\ndata: {}"
+
+
+def test_stream_gzip():
+    # Driven at the ASGI level: the test client only returns the response once it is complete
+    texts = ["This is test number %d." % i for i in range(3)]
+    body = ('{ nlp(model: "en") { batch(texts: %s) { docs { text } } } }' % json.dumps(texts)).encode()
+    scope = {"type": "http", "http_version": "1.1", "method": "POST", "path": "/stream", "root_path": "",
+             "scheme": "http", "query_string": b"", "server": ("testserver", 80), "client": ("testclient", 50000),
+             "headers": [(b"content-type", b"application/graphql"), (b"accept-encoding", b"gzip")]}
+    messages = []
+    requests = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        # The client disconnects once the response is complete
+        while not requests and not (messages and not messages[-1].get("more_body", True)):
+            await asyncio.sleep(0.01)
+        return requests.pop() if requests else {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+    start = messages[0]
+    assert start["status"] == 200
+    assert b"content-encoding" not in dict(start["headers"])
+    # The first document is sent on its own, before the end of the stream
+    first = next(message for message in messages[1:] if message.get("body"))
+    assert first["more_body"]
+    assert json.loads(first["body"])["data"]["text"] == texts[0]
@@ -0,0 +1,84 @@
+from app.schema import schema as schema_module
+from app.schema.cache import DiskDocCache, DocCache, TieredDocCache, doc_key
+from app.schema.schema import spacy_models
+from app.schema.serialization import deserialize_doc, serialize_doc
+
+
+def test_doc_key():
+    assert doc_key("en", '{"a": 1, "b": 2}', ["ner", "parser"], "Hello") == \
+           doc_key("en", '{ "b" : 2, "a" : 1 }', ["parser", "ner"], "Hello")
+    assert doc_key("en", '{}', ["ner"], "Hello") != doc_key("en", '{}', [], "Hello")
+    assert doc_key("en", '{}', [], "Hello", "2.1.0") != doc_key("en", '{}', [], "Hello", "2.2.0")
+    assert doc_key("en", '{"rule_sentencizer": "fr"}', [], "Hello", "2.1.0", "a1") != \
+           doc_key("en", '{"rule_sentencizer": "fr"}', [], "Hello", "2.1.0", "b2")
+
+
+def test_lru_eviction():
+    cache = DocCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.get("a") == b"12345"
+    cache.put("c", b"12345")
+    # b was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.nbytes == 10
+
+
+def test_serialization():
+    nlp = spacy_models.get_model("en", "{}")
+    doc = nlp("How are you Bob? What time is it in London?")
+    cached = deserialize_doc(nlp.vocab, serialize_doc(doc))
+    assert [(t.text, t.lemma_, t.tag_, t.dep_, t.head.i, t.ent_type_) for t in cached] == \
+           [(t.text, t.lemma_, t.tag_, t.dep_, t.head.i, t.ent_type_) for t in doc]
+    assert [s.text for s in cached.sents] == [s.text for s in doc.sents]
+
+    # Without the tagger the single whitespace tokens are still tagged by the special cases of the tokenizer
+    doc = nlp("Hello\n\nworld\nagain  and\tagain", disable=['tagger', 'parser', 'ner'])
+    cached = deserialize_doc(nlp.vocab, serialize_doc(doc))
+    assert [t.text for t in doc if t.tag_ == "_SP" and t.pos_ == "SPACE"] == ["\n", " ", "\t"]
+    assert [(t.text, t.lemma_, t.tag_, t.pos_) for t in cached] == [(t.text, t.lemma_, t.tag_, t.pos_) for t in doc]
+    assert cached.is_tagged == doc.is_tagged and cached.is_parsed == doc.is_parsed
+
+
+def test_batch_only_pipes_misses(monkeypatch):
+    monkeypatch.setattr(schema_module, "doc_cache", DocCache(max_bytes=10_000_000))
+    nlp = spacy_models.get_model("en", "{}")
+    nlp_args = {'model': "en", 'cfg': "{}"}
+    texts = ["This is a test.", "This is another test."]
+    docs = list(schema_module.process_batch(nlp, nlp_args, [], texts[:1], 10))
+    piped = []
+    pipe = nlp.pipe
+    monkeypatch.setattr(nlp, "pipe", lambda texts, **kwargs: pipe(piped.extend(texts) or texts, **kwargs))
+    docs = list(schema_module.process_batch(nlp, nlp_args, [], texts, 10))
+    assert [doc.text for doc in docs] == texts
+    assert piped == texts[1:]
+    # Another version of the model doesn't read the entries of the previous one
+    monkeypatch.setitem(nlp.meta, "version", "0.0.0")
+    list(schema_module.process_batch(nlp, nlp_args, [], texts, 10))
+    assert piped == texts[1:] + texts
+
+
+def test_disk_cache(tmp_path):
+    path = tmp_path / "docs.sqlite"
+    cache = DiskDocCache(path, max_bytes=1000)
+    cache.put("a", b"x" * 300)
+    # Another worker sees the same store
+    assert DiskDocCache(path, max_bytes=1000).get("a") == b"x" * 300
+    for i in range(5):
+        cache.put(str(i), b"y" * 300)
+    cache.compact()
+    assert cache.get("a") is None
+    assert cache.get("4") == b"y" * 300
+    total = cache.connection().execute("SELECT SUM(size) FROM docs").fetchone()[0]
+    assert total <= 900
+
+
+def test_tiered_cache(tmp_path):
+    memory = DocCache(max_bytes=1000)
+    disk = DiskDocCache(tmp_path / "docs.sqlite", max_bytes=1000)
+    disk.put("a", b"12345")
+    cache = TieredDocCache([memory, disk])
+    assert cache.get("a") == b"12345"
+    # Promoted to the in-memory cache
+    assert memory.get("a") == b"12345"
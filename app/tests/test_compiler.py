@@ -0,0 +1,95 @@
+import json
+
+from graphql import parse
+from graphql.error import format_error
+
+from app.compiler import compile_query
+from app.schema.schema import schema
+
+TEXT = "Apple is looking at buying U.K. startup for $1 billion. It rains in Paris."
+
+QUERIES = [
+    """fragment PosTagger on Token {
+      id
+      pos
+      tag
+    }
+    query Tagger($text: String!) {
+      nlp(model: "en") {
+        doc(text: $text) {
+          __typename
+          text
+          words: tokens {
+            ...PosTagger
+            lemma
+            dep
+            head { id text }
+            children { id }
+            subtree { id }
+            is_stop
+            ent_type
+            ent_iob
+            whitespace
+            vector_norm
+          }
+          sents { text start end label lemma root { text } tokens { id } ents { text } }
+          ents { text label start end }
+          noun_chunks { text }
+          cats { start end label score }
+          vector_b64(dtype: float16)
+          vector_matrix(dtype: float32) { rows dims dtype data }
+          token_table { size head id is_stop pos { labels codes } }
+          tokens { text }
+          ... on Container { text_with_ws }
+        }
+      }
+    }""",
+    """{
+      nlp(model: "en") {
+        batch(texts: ["Hello world", "Apple buys a company in London"]) {
+          docs { text ents { label text } tokens { text ...on Token { pos } } }
+        }
+      }
+    }""",
+    # Errors of the spaCy attributes: executed by graphene
+    """{
+      nlp(model: "en", disable: ["parser", "rule_sentencizer"]) {
+        doc(text: "Hello world. Bye.") { text sents { text } noun_chunks { text } tokens { text } }
+      }
+    }""",
+]
+
+
+def formatted(result):
+    return json.dumps(result.data), [format_error(error) for error in result.errors or []]
+
+
+def test_compiled_queries():
+    for query in QUERIES:
+        document = parse(query)
+        compiled = compile_query(schema, document)
+        assert compiled is not None
+        expected = schema.execute(query, variables={"text": TEXT})
+        assert formatted(compiled.execute(variables={"text": TEXT})) == formatted(expected)
+
+
+def test_uncompiled_queries():
+    # Dynamic selections of the Doc fields are left to graphene
+    assert compile_query(schema, parse("""query ($dtype: VectorDtype) {
+      nlp(model: "en") { doc(text: "Hello") { vector_b64(dtype: $dtype) } }
+    }""")) is None
+    assert compile_query(schema, parse("""query ($pos: Boolean!) {
+      nlp(model: "en") { doc(text: "Hello") { tokens { text pos @include(if: $pos) } } }
+    }""")) is None
+    assert compile_query(schema, parse('{ nlp(model: "en") { meta { lang } } }')) is None
+
+
+def test_merged_doc_fields():
+    query = """{
+      nlp(model: "en") {
+        doc(text: "Hello world") { text }
+        ... on Nlp { doc(text: "Hello world") { tokens { text } text } }
+      }
+    }"""
+    compiled = compile_query(schema, parse(query))
+    assert formatted(compiled.execute()) == formatted(schema.execute(query))
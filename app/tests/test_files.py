@@ -0,0 +1,26 @@
+import threading
+
+import pytest
+
+from app.files import write_atomic
+
+
+def test_write_atomic(tmp_path):
+    path = tmp_path / "data"
+    write_atomic(path, b"first")
+    write_atomic(path, b"second")
+    assert path.read_bytes() == b"second"
+    # Concurrent writers of the same path each use their own temporary file
+    threads = [threading.Thread(target=write_atomic, args=(path, b"%d" % i * 100000)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert path.read_bytes() in {b"%d" % i * 100000 for i in range(10)}
+    assert [p.name for p in tmp_path.iterdir()] == ["data"]
+
+
+def test_write_atomic_failure(tmp_path):
+    with pytest.raises(TypeError):
+        write_atomic(tmp_path / "data", "not bytes")
+    assert list(tmp_path.iterdir()) == []
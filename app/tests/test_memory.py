@@ -0,0 +1,23 @@
+from threading import Event
+
+from app.memory import RssMonitor, rss_bytes
+
+
+def test_rss_bytes():
+    before = rss_bytes()
+    assert before > 0
+    buffer = bytearray(64 * 1024 * 1024)
+    assert rss_bytes() - before >= 32 * 1024 * 1024
+    del buffer
+
+
+def test_rss_monitor():
+    exceeded = Event()
+    monitor = RssMonitor(32 * 1024 * 1024, 0.01, exceeded.set)
+    monitor.start()
+    assert not exceeded.wait(0.1)
+    buffer = bytearray(64 * 1024 * 1024)
+    assert exceeded.wait(5)
+    monitor.join(5)
+    assert not monitor.is_alive()
+    del buffer
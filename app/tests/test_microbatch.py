@@ -0,0 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import REGISTRY
+
+from app.schema.microbatch import MicroBatcher
+from app.schema.schema import spacy_models
+
+
+def test_microbatch():
+    microbatcher = MicroBatcher(spacy_models, max_wait_ms=200, max_size=8)
+    batches_before = REGISTRY.get_sample_value('gracyql_microbatch_size_count', {'model': 'en'}) or 0
+    texts = ["This is test number %d." % i for i in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = list(executor.map(lambda text: microbatcher.submit("en", "{}", ["ner"], text), texts))
+        docs = [future.result(timeout=10) for future in futures]
+    assert [doc.text for doc in docs] == texts
+    batches_after = REGISTRY.get_sample_value('gracyql_microbatch_size_count', {'model': 'en'})
+    # All the requests arrived within the window and fit in a single batch
+    assert batches_after == batches_before + 1
@@ -0,0 +1,112 @@
+import json
+
+from prometheus_client import REGISTRY
+from starlette.applications import Starlette
+from starlette.testclient import TestClient
+
+from app.persisted import load_allowlist, PersistedGraphQLApp, query_hash, QueryDocuments
+from app.schema.schema import schema
+
+QUERY = """fragment PosTagger on Token {
+  id
+  pos
+}
+query Tagger($text: String!) {
+  nlp(model: "en") {
+    doc(text: $text) {
+      tokens {
+        ...PosTagger
+      }
+    }
+  }
+}"""
+
+
+def client_for(documents):
+    app = Starlette()
+    app.add_route("/", PersistedGraphQLApp(schema, documents))
+    return TestClient(app)
+
+
+def persisted(hash_):
+    return {"persistedQuery": {"version": 1, "sha256Hash": hash_}}
+
+
+def documents_count(result):
+    return REGISTRY.get_sample_value('gracyql_query_documents_total', {'result': result}) or 0
+
+
+def test_automatic_persisted_queries():
+    documents = QueryDocuments(schema, 10, compile_queries=True)
+    client = client_for(documents)
+    hash_ = query_hash(QUERY)
+    variables = {"text": "Hello world"}
+
+    # Unknown hash: the client must send the query along with it
+    response = client.post("/", json={"variables": variables, "extensions": persisted(hash_)})
+    assert response.status_code == 200
+    assert response.json()["errors"][0]["extensions"]["code"] == "PERSISTED_QUERY_NOT_FOUND"
+
+    response = client.post("/", json={"query": QUERY, "variables": variables, "extensions": persisted(hash_)})
+    assert response.status_code == 200
+    assert len(response.json()["data"]["nlp"]["doc"]["tokens"]) == 2
+    assert documents.documents[hash_].compiled is not None
+
+    # Then the hash is enough, the document is neither parsed nor validated again
+    hits = documents_count('hit')
+    misses = documents_count('miss')
+    response = client.get("/", params={"variables": json.dumps(variables), "extensions": json.dumps(persisted(hash_))})
+    assert response.status_code == 200
+    assert len(response.json()["data"]["nlp"]["doc"]["tokens"]) == 2
+    assert documents_count('hit') == hits + 1 and documents_count('miss') == misses
+
+    response = client.post("/", json={"query": QUERY, "variables": variables, "extensions": persisted("0" * 64)})
+    assert response.status_code == 400
+
+    # Invalid queries are reported and not cached
+    response = client.post("/", json={"query": "{ nlp { unknown } }"})
+    assert response.status_code == 400
+    assert len(documents.documents) == 1
+
+
+def test_allowlist(tmp_path):
+    path = tmp_path / "allowlist.json"
+    path.write_text(json.dumps([QUERY]))
+    documents = QueryDocuments(schema, 10, load_allowlist(str(path)), allowlist_only=True)
+    client = client_for(documents)
+    response = client.post("/", json={"variables": {"text": "Hello"}, "extensions": persisted(query_hash(QUERY))})
+    assert response.status_code == 200
+    assert response.json()["data"]["nlp"]["doc"]["tokens"][0]["id"] == 0
+    response = client.post("/", json={"query": '{ nlp(model: "en") { meta { lang } } }'})
+    assert response.status_code == 400
+    assert "not allowed" in response.json()["errors"][0]["message"]
+
+
+def test_query_seconds():
+    def observed(phase):
+        return REGISTRY.get_sample_value('gracyql_query_seconds_count', {'phase': phase}) or 0
+    client = client_for(QueryDocuments(schema, 10))
+    nlp_before, graphql_before = observed('nlp'), observed('graphql')
+    response = client.post("/", json={"query": QUERY, "variables": {"text": "Hello there"}})
+    assert response.status_code == 200
+    assert observed('nlp') == nlp_before + 1 and observed('graphql') == graphql_before + 1
+    assert REGISTRY.get_sample_value('gracyql_query_seconds_sum', {'phase': 'nlp'}) > 0
+
+
+def test_compiled_batch_pages():
+    # The arguments of the fields don't collide with the ones of the compiled queries middleware
+    documents = QueryDocuments(schema, 10, compile_queries=True)
+    client = client_for(documents)
+    query = """query ($texts: [String], $next: Int) {
+      nlp(model: "en") { batch(texts: $texts, next: $next) { batch_id docs { text tokens { pos } } } }
+    }"""
+    texts = ["Hello world", "Apple buys a company", "It rains"]
+    response = client.post("/", json={"query": query, "variables": {"texts": texts, "next": 2}})
+    assert response.status_code == 200, response.text
+    batch = response.json()["data"]["nlp"]["batch"]
+    assert [doc["text"] for doc in batch["docs"]] == texts[:2]
+    assert documents.documents[query_hash(query)].compiled is not None
+    response = client.post("/", json={"query": '{ nlp(model: "en") { batch(batch_id: "%s", next: 1) '
+                                               '{ docs { text tokens { pos } } } } }' % batch["batch_id"]})
+    assert response.status_code == 200, response.text
+    assert [doc["text"] for doc in response.json()["data"]["nlp"]["batch"]["docs"]] == texts[2:]
@@ -0,0 +1,50 @@
+from functools import partial
+
+from prometheus_client import REGISTRY
+
+from app.schema import schema as schema_module
+from app.schema.microbatch import MicroBatcher
+from app.schema.pool import NlpPool
+from app.schema.schema import SpacyModels, spacy_models
+from app.schema.serialization import deserialize_doc
+
+
+def test_pool(monkeypatch):
+    pool = NlpPool(2, partial(SpacyModels, reload=1000))
+    try:
+        nlp = spacy_models.get_model("en", "{}", 0)
+        texts = ["How are you Bob?", "What time is it in London?", "I live in Grenoble, France"]
+        docs = [deserialize_doc(nlp.vocab, data) for data in pool.submit("en", "{}", [], texts).result(timeout=120)]
+        expected = list(nlp.pipe(texts))
+        assert [doc.text for doc in docs] == texts
+        for doc, other in zip(docs, expected):
+            assert [(t.tag_, t.dep_, t.head.i, t.ent_type_) for t in doc] == \
+                   [(t.tag_, t.dep_, t.head.i, t.ent_type_) for t in other]
+        assert REGISTRY.get_sample_value('gracyql_nlp_pool_queue') == 0
+
+        # Batches are spread over the processes by chunks of at most batch_size texts, and read in order
+        monkeypatch.setattr(schema_module, 'nlp_pool', pool)
+        submitted = []
+        submit = pool.submit
+        monkeypatch.setattr(pool, 'submit', lambda *args: submitted.append(args[3]) or submit(*args))
+        batch = texts * 4
+        docs = list(schema_module.process_batch(nlp, {'model': "en", 'cfg': "{}"}, ["ner"], batch, 100))
+        assert [doc.text for doc in docs] == batch
+        assert submitted == [batch[i:i + 2] for i in range(0, len(batch), 2)]
+        # Below the threshold they stay in the web process
+        monkeypatch.setattr(schema_module, 'BATCH_PARALLEL_THRESHOLD', 100)
+        submitted.clear()
+        docs = list(schema_module.process_batch(nlp, {'model': "en", 'cfg': "{}"}, ["ner"], batch, 100))
+        assert [doc.text for doc in docs] == batch and not submitted
+
+        # Chunks of a long text are processed in parallel and merged back in order
+        text = " ".join(texts * 20)
+        doc = schema_module.process_chunked_doc(nlp, {'model': "en", 'cfg': "{}"}, [], text, 100)
+        assert doc.text == text
+        assert [token.text for token in doc] == [token.text for token in nlp(text)]
+
+        # Micro-batches too
+        microbatcher = MicroBatcher(spacy_models, max_wait_ms=50, max_size=8, pool=pool)
+        assert microbatcher.submit("en", "{}", [], texts[0]).result(timeout=120).text == texts[0]
+    finally:
+        pool.shutdown()
@@ -1,9 +1,30 @@
+import base64
 import json
+import threading
+import time
 
+import numpy
+import pytest
+import spacy
 from graphene.test import Client
+from spacy.attrs import DEP, HEAD
+from spacy.symbols import conj
+from spacy.tokens import Doc
+from graphql import GraphQLError
 from munch import munchify
+from prometheus_client import REGISTRY
 
-from app.schema.schema import schema
+from app.metrics import cfg_label
+from app.schema import schema as schema_module
+from app.schema.cache import normalize_cfg
+from app.schema.chunking import split_text
+from app.schema.reload import parse_reload_policy
+from app.schema.rules import RuleFiles
+from app.schema.schema import BatchSlice, batch_docs, parse_models, schema, SpacyModels, spacy_models
+from app.schema import snapshot as snapshot_module
+from app.schema.snapshot import ModelSnapshots, snapshot_model
+from app.schema.tree import span_relatives, span_root, token_relatives
+from app.schema.vectors import doc_vectors
 
 
 def test_ping():
@@ -258,6 +279,45 @@ def test_batch():
     assert total == 103
 
 
+def test_batch_pruned_pages():
+    client = Client(schema)
+    texts = ["Apple buys a startup in London number %d." % i for i in range(4)]
+    executed = client.execute("""query ($texts: [String]) {
+      nlp(model: "en") { batch(texts: $texts, next: 1) { batch_id docs { tokens { pos } } } }
+    }""", variables={"texts": texts})
+    batch_id = executed["data"]["nlp"]["batch"]["batch_id"]
+    page = """{ nlp(model: "en") { batch(batch_id: "%s", next: 1) { docs { %s } } } }"""
+    # The docs are processed without the parser and the ner pruned for the first query
+    executed = client.execute(page % (batch_id, "ents { label }"))
+    assert "ner" in executed["errors"][0]["message"] and "parser" not in executed["errors"][0]["message"]
+    executed = client.execute(page % (batch_id, "tokens { lemma }"))
+    assert "errors" not in executed
+    assert len(executed["data"]["nlp"]["batch"]["docs"]) == 1
+    executed = client.execute("""query ($texts: [String]) {
+      nlp(model: "en", prune: false) { batch(texts: $texts, next: 1) { batch_id docs { text } } }
+    }""", variables={"texts": texts})
+    executed = client.execute(page % (executed["data"]["nlp"]["batch"]["batch_id"], "ents { label }"))
+    assert "errors" not in executed
+
+
+def test_streamed_batch_size():
+    def processed():
+        return REGISTRY.get_sample_value('gracyql_processed_docs_total', {'model': 'en'}) or 0
+
+    texts = ["This is streamed test number %d." % i for i in range(300)]
+    context = {"stream": {}}
+    before = processed()
+    executed = schema.execute("""query ($texts: [String]) {
+      nlp(model: "en") { batch(texts: $texts) { docs { tokens { pos } } } }
+    }""", variables={"texts": texts}, context_value=context)
+    assert not executed.errors
+    docs = context["stream"]["docs"]
+    # The first doc is yielded once its minibatch is processed, not the whole batch
+    assert next(docs).text == texts[0]
+    assert processed() - before <= schema_module.STREAM_BATCH_SIZE
+    docs.close()
+
+
 def test_disable():
     client = Client(schema)
     text = "This is a test"
@@ -284,3 +344,459 @@ def test_disable():
     doc = nlp.doc
     assert doc.tokens[0].dep == ""
     assert len(doc.ents) == 0
+
+
+def test_pruned_pipeline():
+    client = Client(schema)
+    def pruned(component):
+        return REGISTRY.get_sample_value('gracyql_pruned_components_total',
+                                         {'model': 'en', 'component': component}) or 0
+    parser_before, ner_before = pruned('parser'), pruned('ner')
+    executed = client.execute(
+        """query TokensOnly {
+              nlp(model: "en") {
+                doc(text: "I live in Grenoble, France") {
+                  tokens {
+                     id
+                     lemma
+                  }
+                  ents {
+                      label
+                  }
+                }
+              }
+        }""")
+    nlp = munchify(executed["data"]).nlp
+    assert len(nlp.doc.tokens) == 6
+    assert pruned('parser') == parser_before + 1
+    assert pruned('ner') == ner_before
+
+
+def test_token_filters():
+    client = Client(schema)
+    text = "Apple is looking at buying U.K. startup for $1 billion. It rains in Paris and in London, again."
+    executed = client.execute(
+        """query Filters($text: String!) {
+              nlp(model: "en") {
+                doc(text: $text) {
+                  tokens { id pos is_stop is_punct ent_type }
+                  nouns: tokens(pos_in: ["NOUN", "PROPN"], is_stop: false) { id }
+                  page: tokens(is_punct: false, offset: 2, limit: 3) { id }
+                  places: tokens(ent_type_in: ["GPE"]) { id }
+                  sents { text tokens { id } ents { text label } }
+                  paged_sents: sents(limit: 1) { text tokens(limit: 2) { id } ents(label_in: ["GPE"], limit: 1) { text } }
+                  ents { text label }
+                  paged_ents: ents(label_in: ["GPE", "ORG"], offset: 1, limit: 2) { text label }
+                }
+              }
+        }""", variables={"text": text})
+    doc = munchify(executed["data"]).nlp.doc
+    tokens = doc.tokens
+    assert [t.id for t in doc.nouns] == [t.id for t in tokens if t.pos in ("NOUN", "PROPN") and not t.is_stop]
+    assert doc.nouns
+    assert [t.id for t in doc.page] == [t.id for t in tokens if not t.is_punct][2:5]
+    assert [t.id for t in doc.places] == [t.id for t in tokens if t.ent_type == "GPE"] != []
+    assert [sent.text for sent in doc.paged_sents] == [sent.text for sent in doc.sents[:1]] != []
+    for sent, paged in zip(doc.sents, doc.paged_sents):
+        assert [t.id for t in paged.tokens] == [t.id for t in sent.tokens][:2]
+        assert [ent.text for ent in paged.ents] == [ent.text for ent in sent.ents if ent.label == "GPE"][:1]
+    assert doc.paged_ents == [ent for ent in doc.ents if ent.label in ("GPE", "ORG")][1:3]
+    executed = client.execute('{ nlp(model: "en") { doc(text: "Hello") { tokens(limit: -1) { id } } } }')
+    assert executed["errors"]
+
+
+def test_filters_pruning():
+    client = Client(schema)
+    def pruned(component):
+        return REGISTRY.get_sample_value('gracyql_pruned_components_total',
+                                         {'model': 'en', 'component': component}) or 0
+    tagger_before, parser_before = pruned('tagger'), pruned('parser')
+    executed = client.execute(
+        """{
+              nlp(model: "en") {
+                doc(text: "I live in Grenoble, France") { tokens(pos_in: ["PROPN"]) { id } }
+              }
+        }""")
+    assert [token.id for token in munchify(executed["data"]).nlp.doc.tokens] == [3, 5]
+    assert pruned('tagger') == tagger_before
+    assert pruned('parser') == parser_before + 1
+
+
+def test_component_metrics():
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, dict(model='en', **labels)) or 0
+    tagged = sample('gracyql_component_seconds_count', component='tagger')
+    sentencized = sample('gracyql_component_seconds_count', component='rule_sentencizer')
+    tokenized = sample('gracyql_component_seconds_count', component='tokenizer')
+    docs, tokens, chars = (sample('gracyql_processed_%s_total' % name) for name in ('docs', 'tokens', 'chars'))
+    nlp = spacy_models.get_model("en", "{}")
+    assert nlp("Hello world!").text == "Hello world!"
+    assert sample('gracyql_component_seconds_count', component='tagger') == tagged + 1
+    assert sample('gracyql_component_seconds_count', component='rule_sentencizer') == sentencized + 1
+    # One observation per component and per batch with nlp.pipe
+    assert len(list(nlp.pipe(["Hello world!", "Bye."], disable=['ner']))) == 2
+    assert sample('gracyql_component_seconds_count', component='tagger') == tagged + 2
+    assert sample('gracyql_component_seconds_count', component='ner') > 0
+    assert sample('gracyql_component_seconds_count', component='tokenizer') == tokenized + 3
+    assert sample('gracyql_processed_docs_total') == docs + 3
+    assert sample('gracyql_processed_tokens_total') == tokens + 8
+    assert sample('gracyql_processed_chars_total') == chars + 28
+    assert REGISTRY.get_sample_value('gracyql_model_load_seconds_count', {'model': 'en', 'kind': 'load'}) > 0
+
+
+def test_background_reload():
+    reloads = REGISTRY.get_sample_value('gracyql_model_reloads_total', {'model': 'en', 'reason': 'count'}) or 0
+    models = SpacyModels(reload=2)
+    nlp = models.get_model("en", "{}")
+    assert models.get_model("en", "{}") is nlp
+    for thread in threading.enumerate():
+        if thread.name.startswith("reload-"):
+            thread.join()
+    reloaded = models.get_model("en", "{}")
+    assert reloaded is not nlp
+    # The previous instance remains usable by in-flight requests
+    assert nlp("Hello world!").text == "Hello world!"
+    assert REGISTRY.get_sample_value('gracyql_model_reloads_total', {'model': 'en', 'reason': 'count'}) == reloads + 1
+
+
+def test_reload_policy():
+    with pytest.raises(ValueError):
+        parse_reload_policy("docs:10")
+    assert parse_reload_policy("none").policies == []
+    models = SpacyModels(reload=parse_reload_policy("count:1000000, strings:50, age:3600"))
+    nlp = models.get_model("en", "{}")
+    entry = models.models[("en", "{}")]
+    assert models.reload.reason(entry) is None
+    nlp(" ".join("word%d" % i for i in range(100)))
+    assert models.reload.reason(entry) == "strings"
+    entry.loaded_at -= 3600
+    assert parse_reload_policy("age:3600").reason(entry) == "age"
+    assert parse_reload_policy("rss:%d" % (1024 * 1024 * 1024)).reason(entry) is None
+    spacy_models.get_model("en", "{}", 0)
+    assert REGISTRY.get_sample_value('gracyql_model_strings', {'model': 'en', 'cfg': 'default'}) > 0
+    cfg = '{"rule_sentencizer": {"split": [[{"TEXT": ";"}]]}}'
+    spacy_models.get_model("en", cfg, 0)
+    label = cfg_label(normalize_cfg(cfg))
+    assert len(label) == 8 and label == cfg_label(normalize_cfg('{ "rule_sentencizer":{"split":[[{"TEXT":";"}]]} }'))
+    assert REGISTRY.get_sample_value('gracyql_model_strings', {'model': 'en', 'cfg': label}) > 0
+
+
+def test_preload_models():
+    assert parse_models("") == []
+    assert parse_models("en, fr") == [("en", "{}"), ("fr", "{}")]
+    assert parse_models('["en", ["fr", {"disable": ["ner"]}]]') == [("en", "{}"), ("fr", '{"disable": ["ner"]}')]
+    models = SpacyModels(reload=1000)
+    models.preload(parse_models("en"))
+    entry = models.models[("en", "{}")]
+    # Loaded once
+    models.preload(parse_models("en"))
+    assert models.models[("en", "{}")] is entry
+    assert models.get_model("en", "{}") is entry.nlp
+
+
+def test_shared_base_models(monkeypatch):
+    models = SpacyModels(reload=1000)
+    semicolon = '{"rule_sentencizer": {"split": [[{"TEXT": ";"}, {}]]}}'
+    nlp = models.get_model("en", semicolon)
+    # Same cfg once normalized
+    assert models.get_model("en", '{ "rule_sentencizer" : {"split": [[{"TEXT": ";"}, {}]]} }') is nlp
+    other = models.get_model("en", "{}")
+    assert other is not nlp
+    assert other.vocab is nlp.vocab and other.get_pipe("tagger") is nlp.get_pipe("tagger")
+    assert other.get_pipe("rule_sentencizer") is not nlp.get_pipe("rule_sentencizer")
+    assert len(models.bases) == 1
+    assert len(list(nlp("One; two").sents)) == 2
+
+    # A reload moves all the variants to a new base model
+    entry = models.models[("en", "{}")]
+    models.reload_model(("en", "{}"), entry)
+    reloaded = models.get_model("en", "{}")
+    assert reloaded.vocab is not nlp.vocab
+    assert models.get_model("en", semicolon).vocab is reloaded.vocab
+
+    # Beyond the memory budget the least recently used models are evicted
+    for entry in models.models.values():
+        entry.base.nbytes = 100
+    models.max_bytes = 50
+    models.get_model("en", '{"disable": ["ner"]}')
+    assert list(models.models) == [("en", '{"disable":["ner"]}')]
+
+
+def test_model_snapshot(monkeypatch, tmp_path):
+    snapshots = ModelSnapshots(True, tmp_path)
+    monkeypatch.setattr(schema_module, 'model_snapshots', snapshots)
+    cfg = '{"rule_sentencizer": {"split": [[{"TEXT": ";"}, {}]]}}'
+    assert snapshots.load(("en", "{}")) is None
+    loaded = schema_module.load_model("en", cfg)
+    # The snapshot is the one of the base model, without the sentencizer
+    assert snapshots.memory[("en", "{}")] == snapshots.path(("en", "{}")).read_bytes()
+    restored = schema_module.load_model("en", cfg)
+    assert restored is not loaded
+    assert restored.pipe_names == loaded.pipe_names
+    # Also from the disk only, as another worker would
+    monkeypatch.setattr(schema_module, 'model_snapshots', ModelSnapshots(False, tmp_path))
+    from_disk = schema_module.load_model("en", cfg)
+    text = "I live in Grenoble; Bob lives in London."
+    expected = [(t.tag_, t.dep_, t.head.i, t.ent_type_, t.is_sent_start) for t in loaded(text)]
+    for nlp in (restored, from_disk):
+        assert [(t.tag_, t.dep_, t.head.i, t.ent_type_, t.is_sent_start) for t in nlp(text)] == expected
+    # Another version of the model package doesn't restore the snapshot
+    assert snapshot_module.model_version("en") == spacy.load("en").meta["version"]
+    monkeypatch.setattr(snapshot_module, 'model_version', lambda model: "0.0.0")
+    assert ModelSnapshots(False, tmp_path).load(("en", "{}")) is None
+
+
+def test_snapshot_memory_size():
+    nlp = spacy.load("en")
+    data_size = len(snapshot_model(nlp))
+    snapshots = ModelSnapshots(True, max_bytes=int(data_size * 1.5))
+    snapshots.save(("en", "{}"), nlp)
+    snapshots.save(("en", '{"a":1}'), nlp)
+    # Only the most recent snapshot fits
+    assert list(snapshots.memory) == [("en", '{"a":1}')] and snapshots.nbytes == data_size
+    assert snapshots.load(("en", "{}")) is None
+
+
+def test_expired_batch(monkeypatch):
+    client = Client(schema)
+    texts = ["This is a test. "] * 5
+    executed = client.execute("""query Parser {
+              nlp(model: "en") {
+                batch(texts: %s, batch_size : 5, next : 2 ) {
+                    batch_id
+                    docs {
+                      text
+                    }
+                }
+              }
+            }""" % json.dumps(texts))
+    batch_id = munchify(executed["data"]).nlp.batch.batch_id
+    monkeypatch.setattr(batch_docs, "ttl", 0)
+    executed = client.execute("""query Parser {
+              nlp(model: "en") {
+                batch(batch_id : "%s", next : 2 ) {
+                    docs {
+                      text
+                    }
+                }
+              }
+            }""" % batch_id)
+    assert "has expired" in executed["errors"][0]["message"]
+
+
+def test_batch_lookahead(monkeypatch):
+    monkeypatch.setattr(schema_module, "batch_docs", schema_module.BatchDocs(60, 10, 1 << 30, lookahead=2))
+
+    def processed():
+        return REGISTRY.get_sample_value('gracyql_processed_docs_total', {'model': 'en'}) or 0
+
+    texts = ["This is lookahead test number %d." % i for i in range(400)]
+    before = processed()
+    executed = Client(schema).execute("""query ($texts: [String]) {
+      nlp(model: "en") { batch(texts: $texts, next: 1) { batch_id docs { text tokens { pos } } } }
+    }""", variables={"texts": texts})
+    batch = executed["data"]["nlp"]["batch"]
+    assert [doc["text"] for doc in batch["docs"]] == texts[:1]
+    time.sleep(0.5)
+    # Annotated, not only buffered: about lookahead docs ahead of the client, not the whole batch
+    assert processed() - before <= 1 + 2 * 2
+    schema_module.batch_docs.remove(schema_module.batch_docs.get(batch["batch_id"]))
+
+
+def test_token_table():
+    client = Client(schema)
+    executed = client.execute(
+        '''fragment Columns on TokenTable {
+              size
+              id
+              start
+              end
+              head
+              pos { labels codes }
+              dep { labels codes }
+              ent_iob { labels codes }
+              whitespace { labels codes }
+              is_punct
+            }
+            query TokenTable {
+              nlp(model: "en") {
+                doc(text: "How are you Bob? What time is it in London?") {
+                  tokens {
+                    id
+                    start
+                    end
+                    head { id }
+                    pos
+                    dep
+                    ent_iob
+                    whitespace
+                    is_punct
+                  }
+                  token_table { ...Columns }
+                  sents {
+                    token_table { ...Columns }
+                  }
+                }
+              }
+            }''')
+    doc = munchify(executed["data"]).nlp.doc
+    table = doc.token_table
+    assert table.size == len(doc.tokens)
+    assert table.id == [token.id for token in doc.tokens]
+    assert table.start == [token.start for token in doc.tokens]
+    assert table.end == [token.end for token in doc.tokens]
+    assert table.head == [token.head.id for token in doc.tokens]
+    assert table.is_punct == [token.is_punct for token in doc.tokens]
+    for name in ('pos', 'dep', 'ent_iob', 'whitespace'):
+        column = table[name]
+        assert [column.labels[code] for code in column.codes] == [token[name] for token in doc.tokens]
+    sent_tables = doc.sents
+    assert sum(sent.token_table.size for sent in sent_tables) == table.size
+    assert [i for sent in sent_tables for i in sent.token_table.id] == table.id
+    assert [i for sent in sent_tables for i in sent.token_table.head] == table.head
+
+
+def test_vector_b64():
+    client = Client(schema)
+    executed = client.execute(
+        '''query Vectors {
+              nlp(model: "en") {
+                doc(text: "How are you Bob?") {
+                  tokens {
+                    vector
+                    vector_b64
+                    half: vector_b64(dtype: float16)
+                  }
+                  vector_matrix { rows dims dtype data }
+                }
+              }
+            }''')
+    doc = munchify(executed["data"]).nlp.doc
+    vectors = numpy.array([token.vector for token in doc.tokens], dtype='<f4')
+    for token, vector in zip(doc.tokens, vectors):
+        assert numpy.array_equal(numpy.frombuffer(base64.b64decode(token.vector_b64), dtype='<f4'), vector)
+        assert numpy.allclose(numpy.frombuffer(base64.b64decode(token.half), dtype='<f2'), vector, atol=1e-2)
+    matrix = doc.vector_matrix
+    assert (matrix.rows, matrix.dims, matrix.dtype) == (vectors.shape[0], vectors.shape[1], "float32")
+    assert numpy.array_equal(numpy.frombuffer(base64.b64decode(matrix.data), dtype='<f4').reshape(vectors.shape),
+                             vectors)
+
+
+def test_doc_vectors():
+    nlp = spacy.blank("en")
+    nlp.vocab.set_vector("hello", numpy.ones((3,), dtype='f'))
+    nlp.vocab.set_vector("world", numpy.arange(3, dtype='f'))
+    doc = nlp("hello big world")
+    assert numpy.array_equal(doc_vectors(doc), numpy.array([token.vector for token in doc]))
+
+
+def test_doc_tree():
+    nlp = spacy_models.get_model("en", "{}", 0)
+    docs = list(nlp.pipe(["Apple and Google are looking at buying U.K. and French startups for $1 billion.",
+                          "It rains in Paris, London and Rome. I like red, green and blue apples!", "", "Hello"]))
+    # Non projective: the head of "b" is on the other side of the root "c"
+    doc = Doc(nlp.vocab, words=["a", "b", "c", "d", "e"])
+    doc.from_array([HEAD, DEP], numpy.array([[1, 0], [3, 0], [0, 0], [-1, conj], [-2, conj]], dtype='uint64'))
+    docs.append(doc)
+    for doc in docs:
+        for token in doc:
+            for name in ('children', 'lefts', 'rights', 'subtree', 'ancestors', 'conjuncts'):
+                assert [t.i for t in token_relatives(token, name)] == [t.i for t in getattr(token, name)], name
+        spans = list(doc.sents) + list(doc.ents) + [doc[i:j] for i in range(len(doc)) for j in range(i + 1, len(doc))]
+        for span in spans:
+            assert span_root(span).i == span.root.i
+            for name in ('lefts', 'rights', 'subtree', 'conjuncts'):
+                assert [t.i for t in span_relatives(span, name)] == [t.i for t in getattr(span, name)], name
+
+
+def test_named_rules(monkeypatch, tmp_path):
+    (tmp_path / "semicolon.yaml").write_text('rule_sentencizer:\n  split:\n    - - TEXT: ";"\n      - {}\n')
+    monkeypatch.setattr(schema_module, 'rule_files', RuleFiles(tmp_path))
+    client = Client(schema)
+    query = '''query Sents($rules: String) {
+                  nlp(model: "en", rules: $rules) {
+                    doc(text: "One; two") { sents { text } }
+                  }
+                }'''
+    executed = client.execute(query, variables={"rules": "semicolon"})
+    assert [sent.text for sent in munchify(executed["data"]).nlp.doc.sents] == ["One;", "two"]
+    for name in ("missing", "../semicolon"):
+        executed = client.execute(query, variables={"rules": name})
+        assert executed["errors"]
+
+
+def test_chunked_doc():
+    text = "\n\n".join("Paragraph %d is about Bob who lives in London. He likes tea. Really!" % i for i in range(10))
+    client = Client(schema)
+    query = '''query Chunks($text: String!, $chunk_size: Int) {
+                  nlp(model: "en") {
+                    doc(text: $text, chunk_size: $chunk_size) {
+                      text
+                      tokens { id start end text }
+                      sents { start end }
+                      ents { start end label }
+                    }
+                  }
+                }'''
+    executed = client.execute(query, variables={"text": text, "chunk_size": 200})
+    doc = munchify(executed["data"]).nlp.doc
+    assert doc.text == text
+    assert [token.id for token in doc.tokens] == list(range(len(doc.tokens)))
+    assert all(text[token.start:token.end] == token.text for token in doc.tokens)
+    # Each chunk starts a sentence
+    chunks = split_text(text, 200)
+    assert len(chunks) > 1
+    starts = set(sum(len(chunk) for chunk in chunks[:i]) for i in range(len(chunks)))
+    assert starts <= set(sent.start for sent in doc.sents)
+    assert all(0 <= ent.start < ent.end <= len(text) for ent in doc.ents)
+    unchunked = munchify(client.execute(query, variables={"text": text})["data"]).nlp.doc
+    assert [token.text for token in doc.tokens] == [token.text for token in unchunked.tokens]
+    assert client.execute(query, variables={"text": text, "chunk_size": 0})["errors"]
+
+
+def test_split_text():
+    text = "One. Two three.\n\nFour five six seven. Eight"
+    chunks = split_text(text, 21)
+    assert "".join(chunks) == text
+    assert chunks == ["One. Two three.\n\n", "Four five six seven. ", "Eight"]
+    assert split_text("a" * 10 + " " + "b" * 10, 8) == ["aaaaaaaa", "aa bbbbb", "bbbbb"]
+    assert split_text(text, len(text)) == [text]
+
+
+def test_batch_prefetch():
+    nlp = spacy_models.get_model("en", "{}", 0)
+    produced = []
+    closed = threading.Event()
+
+    def docs(texts):
+        try:
+            for doc in nlp.pipe(texts):
+                produced.append(doc.text)
+                yield doc
+        finally:
+            closed.set()
+
+    texts = ["This is test number %d." % i for i in range(6)]
+    batch = BatchSlice(docs(texts), len(texts))
+    batch.prefetch(2)
+    assert [doc.text for doc in batch.next(3)] == texts[:3]
+    # Backpressure: at most lookahead documents are processed ahead of the client
+    deadline = time.monotonic() + 10
+    while len(produced) < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert produced == texts[:5]
+    assert batch.remaining_bytes() > 0
+    # Closing the batch (e.g. when it expires) stops its producer
+    batch.close()
+    assert closed.wait(10)
+    assert produced == texts[:5]
+
+    def failing():
+        yield nlp("A test.")
+        raise ValueError("broken")
+
+    batch = BatchSlice(failing(), 2)
+    batch.prefetch(10)
+    with pytest.raises(GraphQLError, match="broken"):
+        batch.next(2)
@@ -0,0 +1,80 @@
+import spacy
+import yaml
+
+from app.pipeline.RuleSentencizer import RuleSentencizer
+from app.tests.bench_sentencizer import ArrayRuleSentencizer, random_text, sent_starts, TokenRuleSentencizer
+
+CFG = {
+    "rule_sentencizer": {
+        "split": [
+            [{"IS_SPACE": True, "TEXT": {"REGEX": "[\n]{2,}"}}, {}],
+            [{"IS_PUNCT": True, "TEXT": {"IN": [".", "!", "?"]}}, {}],
+            [{"TEXT": ";"}],
+        ],
+        "join": [
+            [{"IS_DIGIT": True}, {"IS_SENT_START": True, "IS_PUNCT": True}, {"IS_DIGIT": True}],
+            [{"IS_DIGIT": True}, {"IS_PUNCT": True}, {"IS_SENT_START": True, "IS_DIGIT": True}],
+        ]
+    }
+}
+
+
+def compare(nlp, cfg, texts):
+    for text in texts:
+        expected = sent_starts(TokenRuleSentencizer(nlp, **cfg)(nlp(text)))
+        assert sent_starts(ArrayRuleSentencizer(nlp, **cfg)(nlp(text))) == expected, text
+        assert sent_starts(RuleSentencizer(nlp, **cfg)(nlp(text))) == expected, text
+
+
+def test_same_boundaries():
+    nlp = spacy.blank("fr")
+    texts = [
+        "",
+        "Bonjour",
+        "\n\n",
+        "Une indemnité de 100. 000 Frs. \n\n Le 3. 4 ; ensuite ? Oui !",
+        "  Des espaces au début. \n\n\n  Et ailleurs ; ici.",
+    ] + [random_text(500, seed) for seed in range(20)] + [random_text(1500, seed) for seed in range(3)]
+    compare(nlp, CFG, texts)
+    with open("app/pipeline/example.yaml") as rules:
+        compare(nlp, yaml.safe_load(rules), texts)
+    compare(nlp, {}, texts)
+
+
+def test_parsed_doc():
+    nlp = spacy.load("en")
+    texts = ["How are you Bob? What time is it in London?", "It costs 100. 000 dollars; I paid it.\n\nThanks."]
+    compare(nlp, CFG, texts)
+
+
+def test_pipe():
+    nlp = spacy.blank("fr")
+    nlp.add_pipe(RuleSentencizer(nlp, **CFG))
+    docs = list(nlp.pipe(["Un. Deux.", "Trois ; quatre"], batch_size=2))
+    assert [[sent.text for sent in doc.sents] for doc in docs] == [["Un.", "Deux."], ["Trois", "; quatre"]]
+
+
+def test_pipe_batches():
+    nlp = spacy.blank("fr")
+    texts = ["", "Bonjour", "\n\n", "  Des espaces au début. \n\n\n  Et ailleurs ; ici."] + \
+        [random_text(n_words, seed) for seed, n_words in enumerate([1, 2, 10, 50, 200, 1000] * 3)]
+    expected = [sent_starts(TokenRuleSentencizer(nlp, **CFG)(nlp(text))) for text in texts]
+    # Whole batches on arrays, mixed batches and batches of single docs
+    for sentencizer in (ArrayRuleSentencizer(nlp, **CFG), RuleSentencizer(nlp, **CFG)):
+        for batch_size in (1, 3, 7, 1000):
+            docs = list(sentencizer.pipe((nlp(text) for text in texts), batch_size=batch_size))
+            assert [sent_starts(doc) for doc in docs] == expected, batch_size
+
+
+def test_shared_matchers():
+    nlp, other = spacy.blank("fr"), spacy.blank("fr")
+    strings = len(nlp.vocab.strings)
+    sentencizer = RuleSentencizer(nlp, **CFG)
+    # Same rules in another key order, on another model
+    reordered = {"rule_sentencizer": dict(reversed(list(CFG["rule_sentencizer"].items())))}
+    shared = RuleSentencizer(other, **reordered)
+    assert shared.split_matcher is sentencizer.split_matcher
+    assert shared.join_matcher is sentencizer.join_matcher
+    # The pattern strings are not added to the vocab of the models
+    assert len(nlp.vocab.strings) == strings
+    compare(other, CFG, ["Un ; deux. Trois 100. 000 quatre"])
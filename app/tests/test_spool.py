@@ -0,0 +1,62 @@
+import time
+
+from app.schema.schema import BatchSlice, spacy_models
+from app.schema.spool import SpoolBatchDocs
+
+
+def test_spool_pagination(tmp_path):
+    texts = ["This is test number %d." % i for i in range(7)]
+    nlp = spacy_models.get_model("en", "{}")
+    producer = SpoolBatchDocs(tmp_path, spacy_models, ttl=60, lookahead=2)
+    batch = producer.add(BatchSlice(nlp.pipe(texts), len(texts), model="en", cfg="{}", pruned=["ner"]))
+    # Pages are served by another worker sharing the spool directory
+    consumer = SpoolBatchDocs(tmp_path, spacy_models, ttl=60, lookahead=2)
+    docs = []
+    while True:
+        batch = consumer.get(str(batch.uuid_))
+        assert batch.pruned == ["ner"]
+        docs.extend(batch.next(3))
+        if not batch.has_next():
+            consumer.remove(batch)
+            break
+    assert [doc.text for doc in docs] == texts
+    assert consumer.get(str(batch.uuid_)) is None
+
+
+def test_spool_expiry(tmp_path):
+    nlp = spacy_models.get_model("en", "{}")
+    store = SpoolBatchDocs(tmp_path, spacy_models, ttl=60, lookahead=2)
+    batch = store.add(BatchSlice(nlp.pipe(["A test."] * 3), 3, model="en", cfg="{}"))
+    store.ttl = 0
+    assert store.get(str(batch.uuid_)) is None
+    assert store.dropped_reason(str(batch.uuid_)) == 'expired'
+
+
+def test_spool_eviction(tmp_path):
+    nlp = spacy_models.get_model("en", "{}")
+    closed = []
+
+    def docs(texts):
+        try:
+            yield from nlp.pipe(texts)
+        finally:
+            closed.append(texts[0])
+
+    # The limits are shared by the workers of the host: another store on the same directory sees the batches
+    store = SpoolBatchDocs(tmp_path, spacy_models, ttl=60, lookahead=2, max_batches=2, max_bytes=1000)
+    other = SpoolBatchDocs(tmp_path, spacy_models, ttl=60, lookahead=2, max_batches=2, max_bytes=1000)
+    first = store.add(BatchSlice(docs(["First."] * 5), 5, 100, model="en", cfg="{}"))
+    second = other.add(BatchSlice(docs(["Second."] * 5), 5, 100, model="en", cfg="{}"))
+    third = store.add(BatchSlice(docs(["Third."] * 5), 5, 100, model="en", cfg="{}"))
+    assert store.get(str(first.uuid_)) is None
+    assert other.dropped_reason(str(first.uuid_)) == 'evicted'
+    assert [doc.text for doc in other.get(str(second.uuid_)).next(5)] == ["Second."] * 5
+    # The producer of an evicted batch stops
+    deadline = time.monotonic() + 10
+    while "First." not in closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert "First." in closed
+    # Beyond max_bytes, only the batch being added is kept
+    store.add(BatchSlice(docs(["Large."] * 5), 5, 2000, model="en", cfg="{}"))
+    assert store.dropped_reason(str(third.uuid_)) == 'evicted'
+    assert [batch.max for batch in store.open_batches()] == [5]